@@ -3,7 +3,7 @@
 from logging import info, warn, error
 import logging
 import subprocess
-from lbu_common import cli_func, BadArgumentsError
+from lbu_common import cli_func, BadArgumentsError, sfs_catalog
 
 logging.getLogger().setLevel(logging.INFO)
 
@@ -36,11 +36,13 @@ if __name__ == '__main__':
     except KeyError:
         error("Unknown command: %s", command)
         raise SystemExit(1)
-    try: ret=cmd_func.cli_call(args)
-    except BadArgumentsError as e:
-        error("Execution error: %s", e)
-        info("Usage: %s %s %s", arg0, command, cmd_func.__doc__)
-        raise SystemExit(1)
+    served, ret=sfs_catalog.try_call(command, args)
+    if not served:
+        try: ret=cmd_func.cli_call(args)
+        except BadArgumentsError as e:
+            error("Execution error: %s", e)
+            info("Usage: %s %s %s", arg0, command, cmd_func.__doc__)
+            raise SystemExit(1)
     if ret is not None:
         if isinstance(ret, list):
             for e in ret: print(e)
@@ -5,18 +5,36 @@ import sys
 import struct
 import time
 import functools
+import itertools
+import collections
 import fnmatch
 import glob
-import re
 import fcntl
+import re
+import stat
+import codecs
 import errno
+import io
 import select
+import shlex
+import signal
+import selectors
+import socket
 import subprocess
+import http.client
 import urllib.request
 import urllib.error
 import urllib.parse
 import datetime
 import pwd
+import json
+import queue
+import mmap
+import zlib
+import lzma
+import atexit
+import threading
+import concurrent.futures
 
 import hashlib
 from logging import warning, info, debug
@@ -72,6 +90,10 @@ class NotSFS(ValueError):
     pass
 
 
+class CompressorUnavailable(NotSFS):
+    pass
+
+
 class BadArgumentsError(ValueError):
     pass
 
@@ -88,10 +110,31 @@ try:
         ctypes.c_ulong,
         ctypes.c_char_p,
     )
+    libc.sync_file_range.argtypes = (
+        ctypes.c_int,
+        ctypes.c_int64,
+        ctypes.c_int64,
+        ctypes.c_uint,
+    )
 except Exception as e:
     warning(f"could not import libc: {e}")
     libc = None
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.block
+except ImportError:
+    lz4 = None
+
+try:
+    import lzo
+except ImportError:
+    lzo = None
+
 
 class UTC(datetime.tzinfo):
     def utcoffset(self, dt):
@@ -276,6 +319,17 @@ class CLIProgressReporter(object):
                 self.report_buckets.pop(0)
         self.output_stream.flush()
 
+    def report_stats(self, stats):
+        info(
+            "%.1f MiB in %.1fs (%.1f MiB/s), stalled: read %.1fs, hash %.1fs, write %.1fs",
+            stats["bytes"] / 1048576.0,
+            stats["seconds"],
+            stats["bytes"] / 1048576.0 / max(stats["seconds"], 0.001),
+            stats["read_wait"],
+            stats["hash_wait"],
+            stats["write_wait"],
+        )
+
 
 pr_cls = CLIProgressReporter
 
@@ -300,6 +354,10 @@ class TemplatedString(object):
 class LXC(object):
     auto_remove = False
     init_cmd = []
+    stop_timeout = int(os.environ.get("LXC_STOP_TIMEOUT", "30"))
+    # apt-get in build containers shares the host's archive and list caches
+    apt_lock = threading.Lock()
+    _parts_lock = threading.Lock()
 
     class BindEntry(object):
         @classmethod
@@ -566,6 +624,9 @@ lxc.net.%(netnum)d.link = %(link)s
         if name is None:
             name = "lxc-%d-%s" % (os.getpid(), time.time())
         self.name = name
+        self._start_lock = threading.Lock()
+        # (pid, start time) of the container init, once seen running
+        self._init_proc = None
         for k in attrs:
             setattr(self, k, attrs[k])
 
@@ -573,10 +634,6 @@ lxc.net.%(netnum)d.link = %(link)s
         if self.auto_remove:
             if self.is_running:
                 self.shutdown()
-                while True:
-                    time.sleep(0.1)
-                    if not self.is_running:
-                        break
             run_command(["lxc-destroy", "-n", self.name], as_user="root")
 
     @repr_wrap
@@ -600,12 +657,60 @@ lxc.net.%(netnum)d.link = %(link)s
                 ret[k] = v
         return ret
 
+    @staticmethod
+    def _proc_start_time(pid):
+        try:
+            with open("/proc/%d/stat" % (pid,)) as stat_f:
+                return stat_f.read().rsplit(")", 1)[1].split()[19]
+        except (IOError, IndexError):
+            return
+
+    @classmethod
+    def _proc_alive(cls, init_proc):
+        return cls._proc_start_time(init_proc[0]) == init_proc[1]
+
+    def _query_init_proc(self):
+        self._init_proc = None
+        try:
+            pid = run_command(
+                ["lxc-info", "-n", self.name, "-p", "-H"], as_user="root"
+            ).strip()
+        except CommandFailed:
+            return
+        if pid.isdigit():
+            start_time = self._proc_start_time(int(pid))
+            if start_time is not None:
+                self._init_proc = (int(pid), start_time)
+        return self._init_proc
+
+    @property
+    def init_proc(self):
+        if self._init_proc is not None and self._proc_alive(self._init_proc):
+            return self._init_proc
+        return self._query_init_proc()
+
     @property
     def is_running(self):
+        return self.init_proc is not None
+
+    def _wait_exit(self, init_proc, timeout):
         try:
-            return self.get_status()["State"] == "RUNNING"
-        except CommandFailed:
-            return False
+            pid_fd = os.pidfd_open(init_proc[0])
+        except (AttributeError, OSError):
+            pid_fd = None
+        if pid_fd is None:
+            deadline = time.time() + timeout
+            while self._proc_alive(init_proc) and time.time() < deadline:
+                time.sleep(0.1)
+            return
+        try:
+            if self._proc_alive(init_proc):
+                poller = select.poll()
+                poller.register(pid_fd, select.POLLIN)
+                if not poller.poll(timeout * 1000):
+                    warning("Timeout waiting for %s to stop", self.name)
+        finally:
+            os.close(pid_fd)
 
     @classmethod
     def from_sfs_ext(cls, name, sfs_parts, extra_parts=[], bind_dirs=[], **attrs):
@@ -633,33 +738,39 @@ lxc.net.%(netnum)d.link = %(link)s
             attrs["auto_remove"] = True
         return cls(name, **attrs)
 
+    @classmethod
+    def resolve_parts(cls, sfs_parts):
+        all_parts = []
+        with cls._parts_lock:
+            for part in sfs_parts:
+                if isinstance(part, FSPath):
+                    all_parts.append(part)
+                elif FSPath(part).exists:
+                    all_parts.append(FSPath(part))
+                else:
+                    found_part = None
+                    for part_s in part.split(","):
+                        try:
+                            found_part = sfs_finder[part_s]
+                        except KeyError:
+                            pass
+                        else:
+                            break
+                    if found_part is None:
+                        raise KeyError("Cannot find LXC part %r" % (part,))
+                    all_parts.append(found_part)
+
+            for part in all_parts:
+                if isinstance(part, SFSFile):
+                    if part.mounted_path is None:
+                        part.mount()
+        return all_parts
+
     @classmethod
     def from_sfs(
         cls, name, sfs_parts, bind_dirs=None, veth=None, vlan=None, nonet=False, **attrs
     ):
-        all_parts = attrs["all_parts"] = []
-        for part in sfs_parts:
-            if isinstance(part, FSPath):
-                all_parts.append(part)
-            elif FSPath(part).exists:
-                all_parts.append(FSPath(part))
-            else:
-                found_part = None
-                for part_s in part.split(","):
-                    try:
-                        found_part = sfs_finder[part_s]
-                    except KeyError:
-                        pass
-                    else:
-                        break
-                if found_part is None:
-                    raise KeyError("Cannot find LXC part %r" % (part,))
-                all_parts.append(found_part)
-
-        for part in all_parts:
-            if isinstance(part, SFSFile):
-                if part.mounted_path is None:
-                    part.mount()
+        all_parts = attrs["all_parts"] = cls.resolve_parts(sfs_parts)
         cfg = LXC.Config(name, all_parts=all_parts)
         if "devices_allow" in attrs:
             cfg.devices_allow = attrs.pop("devices_allow")
@@ -688,6 +799,7 @@ lxc.net.%(netnum)d.link = %(link)s
         if init:
             cmd.append("--")
             cmd.extend(init)
+        self._init_proc = None
         try:
             return run_command(
                 cmd,
@@ -708,21 +820,29 @@ lxc.net.%(netnum)d.link = %(link)s
             raise
 
     def apt_install(self, packages):
-        self.run(
-            [
-                "sh",
-                "-x",
-                "-c",
-                'dpkg -s "$@" >/dev/null || (apt-get update || apt-get update && apt-get install -y "$@" )',
-                "_",
-            ]
-            + packages,
-            show_output=True,
-        )
+        with self.apt_lock:
+            self.run(
+                [
+                    "sh",
+                    "-x",
+                    "-c",
+                    'dpkg -s "$@" >/dev/null || (apt-get update || apt-get update && apt-get install -y "$@" )',
+                    "_",
+                ]
+                + packages,
+                show_output=True,
+            )
+
+    def run_many(self, cmds, **args):
+        """runs the commands one after another in a single attach session,
+        stopping at the first one that fails"""
+        script = "\n".join(" ".join(shlex.quote(c) for c in cmd) for cmd in cmds)
+        return self.run(["sh", "-e", "-c", script], **args)
 
     def run(self, cmd, **args):
-        if not self.is_running:
-            self.start()
+        with self._start_lock:
+            if not self.is_running:
+                self.start()
         try:
             return run_command(
                 ["lxc-attach", "-e", "-n", self.name, "--"] + cmd,
@@ -747,7 +867,124 @@ lxc.net.%(netnum)d.link = %(link)s
             raise
 
     def shutdown(self):
+        init_proc = self.init_proc
         run_command(["lxc-stop", "-k", "-n", self.name], as_user="root")
+        self._init_proc = None
+        if init_proc is not None:
+            self._wait_exit(init_proc, self.stop_timeout)
+
+
+class LXCPool(object):
+    """started build containers kept for later builds with the same parts;
+    a released container is stopped, its overlay upper dir and destdir are
+    emptied, its setup dir is set up afresh and it is started again in the
+    background"""
+
+    size = int(os.environ.get("LXC_POOL_SIZE", "2"))
+
+    class Slot(object):
+        def __init__(self, key, lxc, dest_dir, rw_d, setup_d, setup_paths, mounts):
+            self.key = key
+            self.lxc = lxc
+            self.dest_dir = dest_dir
+            self.rw_d = rw_d
+            self.setup_d = setup_d
+            self.setup_paths = setup_paths
+            # auto-removed mounts live as long as the slot
+            self.mounts = mounts
+
+        def reset(self):
+            if self.lxc.is_running:
+                self.lxc.shutdown()
+            run_command(
+                [
+                    "find",
+                    self.dest_dir.path,
+                    self.rw_d.path,
+                    self.setup_d.path,
+                    "-mindepth",
+                    "1",
+                    "-delete",
+                ],
+                as_user="root",
+            )
+            run_command(
+                ["mkdir", self.rw_d.join("data").path, self.rw_d.join("work").path],
+                as_user="root",
+            )
+            SFSBuilder.init_setup_d(self.setup_d, self.setup_paths)
+            self.lxc.start()
+
+        def close(self):
+            if self.lxc.is_running:
+                self.lxc.shutdown()
+            run_command(["lxc-destroy", "-n", self.lxc.name], as_user="root")
+            self.lxc.auto_remove = False
+            self.mounts = []
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._idle = []
+        self._resetting = []
+        self._threads = []
+
+    def checkout(self, key):
+        with self._cond:
+            while True:
+                for slot in self._idle:
+                    if slot.key == key:
+                        self._idle.remove(slot)
+                        debug("Reusing container %s", slot.lxc.name)
+                        return slot
+                if key not in self._resetting:
+                    return
+                self._cond.wait()
+
+    def release(self, slot):
+        with self._cond:
+            if not self._threads:
+                atexit.register(self.clear)
+            self._resetting.append(slot.key)
+            thread = threading.Thread(target=self._reset, args=(slot,), daemon=True)
+            self._threads.append(thread)
+        thread.start()
+
+    def _reset(self, slot):
+        keep = False
+        try:
+            slot.reset()
+        except (CommandFailed, OSError) as e:
+            warning("Dropping pooled container %s: %s", slot.lxc.name, e)
+        else:
+            keep = True
+        with self._cond:
+            self._resetting.remove(slot.key)
+            if keep and len(self._idle) < self.size:
+                self._idle.append(slot)
+                slot = None
+            self._cond.notify_all()
+        if slot is not None:
+            self._close(slot)
+
+    @staticmethod
+    def _close(slot):
+        try:
+            slot.close()
+        except (CommandFailed, OSError) as e:
+            warning("Failed to remove container %s: %s", slot.lxc.name, e)
+
+    def clear(self):
+        with self._cond:
+            threads, self._threads = self._threads, []
+        for thread in threads:
+            thread.join()
+        with self._cond:
+            idle, self._idle = self._idle, []
+        for slot in idle:
+            self._close(slot)
+
+
+lxc_pool = LXCPool()
 
 
 def uniq_list(lst):
@@ -769,7 +1006,7 @@ class SFSFinder(object):
         else:
             dirlist = [
                 FSPath(MountPoint(e["mnt"]).loop_backend).parent_directory.path
-                for e in [e for e in global_mountinfo if e["fs_type"] == "squashfs"]
+                for e in global_mountinfo.find_fs_type("squashfs")
             ]
         return dict(
             [
@@ -792,8 +1029,9 @@ class SFSFinder(object):
         self.sfs_list.insert(0, sfs)
 
     def __getitem__(self, name):
+        match = SFSFile.SFSBasename.matcher(name)
         for sfs in self.sfs_list:
-            if sfs.basename == name and sfs.exists:
+            if match(sfs.basename) and sfs.exists:
                 debug("SFSFinder(regs): %r -> %r", name, sfs.path)
                 return sfs
         sfs = self.search_dirs(name)
@@ -817,6 +1055,8 @@ class SFSBuilder(object):
     GIT_COMMIT_PATH = os.path.join(SFS_SRC_D, ".git-commit")
     SQFS_EXCLUDE = os.path.join(SFS_SRC_D, ".sqfs-exclude")
     BUILD_ENV_PATH = os.path.join(SFS_SRC_D, ".env")
+    BUILD_PROFILE_PATH = os.path.join(SFS_SRC_D, ".build-profile")
+    MANIFEST_PATH = os.path.join(SFS_SRC_D, ".manifest")
 
     LXC_PARTS_FILE = os.path.join(SFS_SRC_D, ".lxc-build-parts")
     LXC_DESTDIR = "/destdir"
@@ -836,6 +1076,25 @@ class SFSBuilder(object):
         "LXC_USRMERGE_DIRS", "lib bin sbin lib32 lib64 libx32"
     ).split()
 
+    # mksquashfs options per build profile, selected with SFS_BUILD_PROFILE
+    # in the build env (.env) or the environment
+    build_profiles = {
+        "default": [],
+        "fast-dev": ["-comp", "lz4"],
+        "release": ["-comp", "xz", "-b", "1M", "-Xdict-size", "100%"],
+        # blocks below the 128K default: less to read and decompress per
+        # random access over the network
+        "netboot": ["-comp", "zstd", "-b", "64K", "-Xcompression-level", "19"],
+    }
+    build_mem_percent = int(os.environ.get("SFS_BUILD_MEM_PERCENT", "25"))
+    # write the default profile natively when the destdir is an overlay over
+    # the previous generation of the target (cp2sfs), reusing the compressed
+    # data of the files not in its upper dir; full rebuilds touch every file
+    # and are left to the multi-threaded mksquashfs
+    sfs_incremental = os.environ.get("SFS_INCREMENTAL", "1") != "0"
+
+    _name_seq = itertools.count()
+
     def __init__(self, target_sfs, source=None):
         if not isinstance(target_sfs, SFSFile):
             target_sfs = SFSFile(target_sfs)
@@ -844,9 +1103,7 @@ class SFSBuilder(object):
             source = target_sfs.git_source
             try:
                 self.run_env.update(
-                    _load_build_env(
-                        target_sfs.open_file(self.BUILD_ENV_PATH, "r").read()
-                    )
+                    _load_build_env(target_sfs.read_meta_file(self.BUILD_ENV_PATH))
                 )
             except IOError:
                 pass
@@ -868,7 +1125,11 @@ class SFSBuilder(object):
 
     @cached_property
     def name(self):
-        return "rebuild-%s.%d" % (self.target.basename.strip_down(), os.getpid())
+        name = "rebuild-%s.%d" % (self.target.basename.strip_down(), os.getpid())
+        seq = next(self._name_seq)
+        if seq:
+            name += "-%d" % (seq,)
+        return name
 
     @cached_property
     def dest_base(self):
@@ -881,6 +1142,8 @@ class SFSBuilder(object):
 
     @cached_property
     def dest_dir(self):
+        if self.pool_slot is not None:
+            return self._export_source(self.pool_slot.dest_dir)
         dest_dir = MountPoint(self.dest_base.join("destdir"), auto_remove=True)
         if dest_dir.is_mounted:
             return dest_dir
@@ -891,24 +1154,29 @@ class SFSBuilder(object):
             dest_dir = FSPath(os.environ["LXC_DESTDIR"])
         else:
             dest_dir.mount("destdir", fs_type="tmpfs", mode="0755")
-        if self.source is not None:
-            if not isinstance(self.source, GitRepo):
-                raise ValueError("Source is not GitRepo")
-            git_tar_out = (
-                'cd "$SRC";git archive HEAD | tar x -C "$DESTDIR";'
-                'P="$(readlink -f .)" git submodule --quiet foreach '
-                '\'git archive --prefix="${PWD#$P/}/" HEAD | tar x -C "$DESTDIR"\''
-            )
-            src_uid = os.stat(self.source.path).st_uid
-            run_command(
-                ["sh", "-c", git_tar_out],
-                env=dict(
-                    SUDO_UID="%d" % (src_uid),
-                    DESTDIR=dest_dir.path,
-                    SRC=self.source.path,
-                ),
-                as_user="root",
-            )
+        return self._export_source(dest_dir)
+
+    def _export_source(self, dest_dir):
+        if not isinstance(self.source, GitRepo):
+            raise ValueError("Source is not GitRepo")
+        if os.getuid() == 0:
+            self.source.export_tree(dest_dir.path)
+            return dest_dir
+        git_tar_out = (
+            'cd "$SRC";git archive HEAD | tar x -C "$DESTDIR";'
+            'P="$(readlink -f .)" git submodule --quiet foreach '
+            '\'git archive --prefix="${PWD#$P/}/" HEAD | tar x -C "$DESTDIR"\''
+        )
+        src_uid = os.stat(self.source.path).st_uid
+        run_command(
+            ["sh", "-c", git_tar_out],
+            env=dict(
+                SUDO_UID="%d" % (src_uid),
+                DESTDIR=dest_dir.path,
+                SRC=self.source.path,
+            ),
+            as_user="root",
+        )
         return dest_dir
 
     @cached_property
@@ -917,15 +1185,26 @@ class SFSBuilder(object):
 
     @cached_property
     def lxc_setup_d(self):
+        # a pooled container only sees the setup dir it was started with
+        if self.pool_slot is not None:
+            return self.pool_slot.setup_d
         d = MountPoint(self.dest_base.join("lxc-setup"), auto_remove=True)
         if d.is_mounted:
             return d
         d.mount("lxc-setup", fs_type="tmpfs", mode="0755")
+        self.init_setup_d(d, self.setup_paths)
+        return d
+
+    @cached_property
+    def setup_paths(self):
         paths = [self.LXC_LBU, self.LXC_DL_CACHE, self.LXC_DESTDIR]
         paths.extend([h_l[1].lstrip("/") for h_l in self.deb_mappings])
+        return paths
+
+    @staticmethod
+    def init_setup_d(d, paths):
         run_command(["mkdir", "-p"] + [d.join(sd).path for sd in paths], as_user="root")
         run_command(["cp", "--parents", "/etc/resolv.conf", d.path], as_user="root")
-        return d
 
     @cached_property
     def lxc_rw_d(self):
@@ -968,23 +1247,73 @@ class SFSBuilder(object):
 
     @cached_property
     def bind_dirs(self):
+        return [LXC.BindEntry(self.dest_dir, self.LXC_DESTDIR)] + self.cache_bind_dirs
+
+    @cached_property
+    def cache_bind_dirs(self):
         return [
-            LXC.BindEntry(self.dest_dir, self.LXC_DESTDIR),
             LXC.BindEntry(dl.cache_dir, self.LXC_DL_CACHE),
             LXC.BindEntry(self.lbu_d, self.LXC_LBU, True),
         ] + [LXC.BindEntry(h_l1[0], h_l1[1]) for h_l1 in self.deb_mappings]
 
+    @cached_property
+    def lxc_pooled(self):
+        return (
+            lxc_pool.size > 0
+            and isinstance(self.source, GitRepo)
+            and not any(
+                os.environ.get(k)
+                for k in ("LXC_DESTDIR", "LXC_RW_D", "BUILD_EXTRA_BINDS")
+            )
+        )
+
+    @cached_property
+    def pool_parts(self):
+        return LXC.resolve_parts(self.commit_lxc_parts)
+
+    @cached_property
+    def pool_key(self):
+        return (
+            tuple(p.realpath().path for p in self.pool_parts),
+            tuple(str(b) for b in self.cache_bind_dirs),
+        )
+
+    @cached_property
+    def pool_slot(self):
+        if self.lxc_pooled:
+            return lxc_pool.checkout(self.pool_key)
+
     @cached_property
     def lxc(self):
+        if self.pool_slot is not None:
+            return self.pool_slot.lxc
         lxc = LXC.from_sfs(
             self.name,
-            self.lxc_parts + [d.path for d in [self.lxc_setup_d, self.lxc_rw_d]],
+            (self.pool_parts if self.lxc_pooled else self.lxc_parts)
+            + [d.path for d in [self.lxc_setup_d, self.lxc_rw_d]],
             self.bind_dirs,
             init_cmd=self.LXC_INIT_CMD,
             auto_remove=True,
         )
         return lxc
 
+    def release(self):
+        if not (self.lxc_pooled and hasattr(self, "__cached__lxc")):
+            return
+        slot = self.pool_slot
+        if slot is None:
+            slot = LXCPool.Slot(
+                self.pool_key,
+                self.lxc,
+                self.dest_dir,
+                self.lxc_rw_d,
+                self.lxc_setup_d,
+                self.setup_paths,
+                [self.dest_base, self.dest_dir, self.lxc_setup_d, self.lxc_rw_d],
+            )
+        del self.lxc
+        lxc_pool.release(slot)
+
     @cached_property
     def _run_env_def(self):
         return dict(
@@ -1014,6 +1343,75 @@ class SFSBuilder(object):
                 ret[k] = ""
         return ret
 
+    @cached_property
+    def commit_lxc_parts(self):
+        # same as lxc_parts, but read from the commit so cache lookups and
+        # build scheduling do not need the exported tree
+        try:
+            ret = run_command(
+                ["git", "show", "HEAD:" + self.LXC_PARTS_FILE.lstrip("/")],
+                cwd=self.source.path,
+            ).split()
+        except CommandFailed:
+            ret = None
+        if not ret:
+            return self.default_lxc_parts[:]
+        return ret
+
+    @staticmethod
+    def _cache_part_id(part):
+        if os.path.isfile(part):
+            sfs = SFSFile(part)
+        elif os.path.exists(part):
+            return
+        else:
+            for part_s in part.split(","):
+                try:
+                    sfs = sfs_finder[part_s]
+                except KeyError:
+                    pass
+                else:
+                    break
+            else:
+                return
+        return [part, str(sfs.basename), sfs.create_stamp]
+
+    def build_cache_key(self):
+        if not isinstance(self.source, GitRepo):
+            return
+        parts = []
+        for part in self.commit_lxc_parts:
+            part_id = self._cache_part_id(part)
+            if part_id is None:
+                debug("Not caching build of %s: LXC part %r", self.target, part)
+                return
+            parts.append(part_id)
+        try:
+            submodules = run_command(
+                ["git", "submodule", "status"], cwd=self.source.path
+            )
+        except CommandFailed:
+            submodules = ""
+        files = {}
+        for path in (".git-facls", self.SQFS_EXCLUDE):
+            src_file = self.source.join(path)
+            if src_file.exists:
+                files[path] = _file_digest(src_file.path)
+        inputs = dict(
+            version=SFSBuildCache.key_version,
+            target=self.target.basename.strip_down(),
+            profile=self.build_profile,
+            commit=self.source.last_commit,
+            submodules=submodules,
+            env=sorted(self.run_env_mod.items()),
+            parts=parts,
+            files=files,
+        )
+        debug("Build cache inputs for %s: %r", self.target, inputs)
+        return hashlib.sha256(
+            json.dumps(inputs, sort_keys=True).encode("utf8")
+        ).hexdigest()
+
     def run_in_dest(self, cmd, **args):
         if "env" not in args:
             args["env"] = self.run_env
@@ -1085,7 +1483,8 @@ class SFSBuilder(object):
             self.sfs_src_d.walk(pattern="[0-9][0-9]-*"), key=lambda p: p.basename
         ):
             if not apt_updated:
-                self.run_in_dest(["apt-get", "update"], show_output=True)
+                with LXC.apt_lock:
+                    self.run_in_dest(["apt-get", "update"], show_output=True)
                 apt_updated = True
             before_build_script = os.environ.get(
                 "BEFORE_BUILD_{0}".format(
@@ -1109,7 +1508,8 @@ class SFSBuilder(object):
                 raise BuildAborted()
 
         if not apt_updated and self.sfs_src_d.join(".pkgs").exists:
-            self.run_in_dest(["apt-get", "update"], show_output=True)
+            with LXC.apt_lock:
+                self.run_in_dest(["apt-get", "update"], show_output=True)
             apt_updated = True
             with self.sfs_src_d.join(".pkgs").open("r") as pkgs_f:
                 pkgs = []
@@ -1119,11 +1519,12 @@ class SFSBuilder(object):
                     pkgs.extend((p for p in line.split() if p))
                 if pkgs:
                     try:
-                        self.run_in_dest(
-                            [self.LXC_LBU + "/scripts/apt-sfs.sh", self.LXC_DESTDIR]
-                            + pkgs,
-                            show_output=True,
-                        )
+                        with LXC.apt_lock:
+                            self.run_in_dest(
+                                [self.LXC_LBU + "/scripts/apt-sfs.sh", self.LXC_DESTDIR]
+                                + pkgs,
+                                show_output=True,
+                            )
                     except CommandFailed as e:
                         warning(
                             "Installing packages %r failed with %d", pkgs, e.args[1]
@@ -1161,9 +1562,43 @@ class SFSBuilder(object):
             self.build_shell()
         self.make_sfs()
 
+    @property
+    def build_profile(self):
+        profile = self.run_env.get(
+            "SFS_BUILD_PROFILE", os.environ.get("SFS_BUILD_PROFILE", "default")
+        )
+        if profile not in self.build_profiles:
+            raise ValueError(
+                "Unknown build profile %r (known: %s)"
+                % (profile, ", ".join(sorted(self.build_profiles)))
+            )
+        return profile
+
+    def mksquashfs_opts(self, profile):
+        opts = self.build_profiles[profile][:]
+        if profile == "default":
+            return opts
+        try:
+            opts.extend(["-processors", str(len(os.sched_getaffinity(0)))])
+        except AttributeError:
+            pass
+        try:
+            with open("/proc/meminfo") as meminfo:
+                for line in meminfo:
+                    if line.startswith("MemAvailable:"):
+                        mem_mb = int(line.split()[1]) * self.build_mem_percent // 102400
+                        opts.extend(["-mem", "%dM" % (max(mem_mb, 64),)])
+                        break
+        except IOError:
+            pass
+        return opts
+
     def make_sfs(self):
         dst_temp = "%s.NEW.%s" % (self.target.path, os.getpid())
-        cmd = ["mksquashfs", self.dest_dir.path, dst_temp, "-noappend"]
+        profile = self.build_profile
+        profile_opts = self.mksquashfs_opts(profile)
+        info("Build profile: %s %s", profile, " ".join(profile_opts))
+        cmd = ["mksquashfs", self.dest_dir.path, dst_temp, "-noappend"] + profile_opts
         if self.source is not None:
             git_source_url = self.source.source_url
             if git_source_url is not None:
@@ -1181,14 +1616,21 @@ class SFSBuilder(object):
             sqfs_excl = self.source.join(self.SQFS_EXCLUDE)
             if sqfs_excl.exists:
                 cmd.extend(["-wildcards", "-ef", sqfs_excl.path])
+        self.dest_dir.join(self.SFS_SRC_D).makedirs()
+        self.dest_dir.open_file(self.BUILD_PROFILE_PATH, "w").write(
+            "%s\n%s\n" % (profile, " ".join(profile_opts))
+        )
         env_mod = list(self.run_env_mod.items())
         if env_mod:
             self.dest_dir.open_file(self.BUILD_ENV_PATH, "w").write(
                 "\n".join(["%s=%s" % (k_v[0], k_v[1]) for k_v in env_mod])
             )
+        manifest = SFSManifest.from_dir(self.dest_dir.path, self.sqfs_exclude_patterns)
+        manifest.save(self.dest_dir.join(self.MANIFEST_PATH).path)
         remount_ro = False
         try:
-            run_command(cmd, show_output=True)
+            if not (profile == "default" and self.make_sfs_incremental(dst_temp)):
+                run_command(cmd, show_output=True)
         except CommandFailed as e:
             warning("Command failed with: %s", e.stderr)
             if e.stderr.endswith("Read-only file system") and sys.stdin.isatty():
@@ -1210,10 +1652,134 @@ class SFSBuilder(object):
             else:
                 raise
         self.target.replace_file(dst_temp)
+        manifest.mkfs_time = sfs_stamp_file(self.target.path)
+        manifest.save(self.target.path + SFSManifest.suffix)
         if remount_ro:
             run_command(["mount", "-o", "remount,ro", target_mnt.path])
         sfs_finder.register_sfs(self.target)
 
+    @property
+    def sqfs_exclude_patterns(self):
+        if self.source is None:
+            return []
+        sqfs_excl = self.source.join(self.SQFS_EXCLUDE)
+        if not sqfs_excl.exists:
+            return []
+        with sqfs_excl.open_file("r") as excl_f:
+            return [line.strip() for line in excl_f if line.strip()]
+
+    def make_sfs_incremental(self, dst_temp):
+        upper_dir = getattr(self.dest_dir, "upper_dir", None)
+        if (
+            not self.sfs_incremental
+            or upper_dir is None
+            or os.getuid() != 0
+            or not self.target.exists
+        ):
+            return False
+        if self.source is not None and self.source.join(self.SQFS_EXCLUDE).exists:
+            return False
+        try:
+            with SquashFSImage(self.target.path) as old_sfs:
+                writer = SquashFSWriter(dst_temp, reuse=old_sfs, upper_dir=upper_dir)
+                stats = writer.write(self.dest_dir.path)
+        except (NotSFS, ValueError, OSError) as e:
+            warning("Incremental build failed, running mksquashfs: %s", e)
+            try:
+                os.unlink(dst_temp)
+            except OSError:
+                pass
+            return False
+        info(
+            "Incremental build: %d files reused, %d compressed",
+            stats["reused"],
+            stats["compressed"],
+        )
+        return True
+
+
+class SFSBuildCache(object):
+    """finished images keyed by the inputs of their build, shared between
+    build hosts through a local directory or an HTTP/WebDAV URL"""
+
+    key_version = 1
+    cache_max = int(os.environ.get("LBU_BUILD_CACHE_MAX", "0"))
+
+    def __init__(self, location):
+        self.location = location.rstrip("/") if location else None
+
+    @property
+    def enabled(self):
+        return self.location is not None
+
+    @property
+    def is_url(self):
+        return urllib.parse.splittype(self.location)[0] in ("http", "https")
+
+    def entry(self, key):
+        return SFSFile("%s/%s.sfs" % (self.location, key))
+
+    def lookup(self, key):
+        entry = self.entry(key)
+        try:
+            if entry.exists:
+                return entry
+        except (urllib.error.URLError, OSError) as e:
+            warning("Build cache lookup of %s failed: %s", entry.path, e)
+
+    def fetch(self, key, target):
+        entry = self.lookup(key)
+        if entry is None:
+            debug("Build cache miss: %s", key)
+            return False
+        if target.exists and not entry.create_stamp > target.create_stamp:
+            info("Build cache entry %s is not newer than %s", entry.path, target)
+            return False
+        info("Build cache hit: %s -> %s", entry.path, target)
+        # reflinked or copied, a hard link would let the mode and owner of
+        # the target change the entry and its mtime, which orders pruning
+        target.replace_with(entry, pr_cls(entry.file_size))
+        if not self.is_url:
+            os.utime(entry.path)
+        return True
+
+    def store(self, key, sfs):
+        entry = self.entry(key)
+        try:
+            if self.is_url:
+                if entry.exists:
+                    return
+                entry.replace_with(sfs)
+            else:
+                if not os.path.isdir(self.location):
+                    os.makedirs(self.location, 0o755)
+                entry_temp = "%s.NEW.%s" % (entry.path, os.getpid())
+                run_command(["cp", "--reflink=auto", sfs.realpath().path, entry_temp])
+                os.rename(entry_temp, entry.path)
+        except (IOError, OSError, urllib.error.URLError, CommandFailed) as e:
+            warning("Could not store %s in build cache: %s", sfs, e)
+            return
+        info("Stored %s in build cache as %s", sfs, entry.path)
+        self._prune()
+
+    def _prune(self):
+        if self.is_url or not self.cache_max:
+            return
+        try:
+            entries = [
+                os.path.join(self.location, n)
+                for n in os.listdir(self.location)
+                if n.endswith(".sfs")
+            ]
+            entries.sort(key=lambda p: os.stat(p).st_mtime, reverse=True)
+            for old_entry in entries[self.cache_max :]:
+                os.unlink(old_entry)
+        except OSError as e:
+            debug("Could not prune build cache: %s", e)
+
+
+build_cache = SFSBuildCache(os.environ.get("LBU_BUILD_CACHE"))
+
 
 class SFSDirectory(object):
     sfs_search_depth = int(os.environ.get("SFS_SEARCH_DEPTH", "3"))
@@ -1256,40 +1822,86 @@ class SFSDirectory(object):
     def join(self, *args, **kwargs):
         return self.backend.join(*args, **kwargs)
 
+    glob_chars_re = re.compile(r"[*?[]")
+
+    @cached_property
+    def sfs_index(self):
+        by_name, by_without_sfs = {}, {}
+        for idx, sfs in enumerate(self.all_sfs):
+            fields = sfs.basename.fields
+            rec = (idx, fields.prio, sfs)
+            by_name.setdefault(fields.stem, []).append(rec)
+            by_without_sfs.setdefault(fields.name, []).append(rec)
+        return by_name, by_without_sfs
+
+    def _match_sfs(self, name):
+        # same matching as SFSFile.SFSBasename.__eq__, resolved via the index
+        name = SFSFile.SFSBasename(name)
+        name_prio = name.fields.prio
+        by_name, by_without_sfs = self.sfs_index
+        found = {}
+
+        def add(recs):
+            for idx, prio, sfs in recs:
+                if name_prio is None or prio is None or prio == name_prio:
+                    found[idx] = sfs
+
+        add(by_name.get(name.fields.stem, []))
+        if self.glob_chars_re.search(name):
+            name_match = re.compile(fnmatch.translate(name)).match
+            for without_sfs, recs in by_without_sfs.items():
+                if name_match(without_sfs):
+                    add(recs)
+        else:
+            add(by_without_sfs.get(str(name), []))
+        return [found[idx] for idx in sorted(found)]
+
     def find_sfs(self, name):
-        for sfs in self.all_sfs:
-            if sfs.basename == name:
-                return sfs
+        found = self._match_sfs(name)
+        if found:
+            return found[0]
 
     def find_all_sfs(self, name):
-        for sfs in self.all_sfs:
-            if sfs.basename == name:
-                yield sfs
+        return iter(self._match_sfs(name))
 
     def prune_old_sfs(self):
         to_be_unlinked = {}
-        cur_sfs_lst = list(self.backend.walk(pattern="*.sfs", depth=0))
-        for old_sfs in self.backend.walk(pattern="*.sfs.OLD*"):
-            if old_sfs.exists:
-                for cur_sfs in cur_sfs_lst:
-                    if os.path.samefile(cur_sfs.path, old_sfs.path):
+        cur_keys = {}
+
+        def is_current(f):
+            d = f.parent_directory
+            if d.path not in cur_keys:
+                keys = cur_keys[d.path] = set()
+                for cur_sfs in d.walk(pattern="*.sfs", depth=0):
+                    try:
+                        st = os.stat(cur_sfs.path)
+                    except OSError:
                         continue
+                    keys.add((st.st_dev, st.st_ino))
+            try:
+                st = os.stat(f.path)
+            except OSError:
+                return False
+            return (st.st_dev, st.st_ino) in cur_keys[d.path]
+
+        def in_use(f):
+            if loop_devs.find_backing(f.path, offset=None) is None:
+                return False
+            info("Keeping, still in use: %s", f.path)
+            return True
+
+        for old_sfs in self.backend.walk(pattern="*.sfs.OLD*"):
             try:
                 link_target = old_sfs.symlink_target
             except OSError:
-                pass
+                if in_use(old_sfs):
+                    continue
             else:
                 if "/" not in link_target:
-                    is_current = False
                     old_tgt = old_sfs.parent_directory.join(link_target)
-                    if old_tgt.exists:
-                        for cur_sfs in old_sfs.parent_directory.walk(
-                            pattern="*.sfs", depth=0
-                        ):
-                            if os.path.samefile(cur_sfs.path, old_tgt.path):
-                                is_current = True
-                                break
-                    if not is_current:
+                    if not is_current(old_tgt):
+                        if in_use(old_tgt):
+                            continue
                         info("Unlinking: %s", old_tgt.path)
                         to_be_unlinked[old_tgt.path] = old_tgt
             info("Unlinking: %s", old_sfs.path)
@@ -1649,32 +2261,21 @@ class FSPath(object):
         os.unlink(self.path)
 
     @property
-    def loop_dev(self):
-        try:
-            alt_path = self.aufs_original.path
-        except NotAufs:
-            alt_path = self.path
-        for devname in os.listdir("/sys/block"):
-            if not devname.startswith("loop"):
-                continue
+    def loop_entry(self):
+        entry = loop_devs.find_backing(self.path)
+        if entry is None:
             try:
-                bfile = (
-                    open("/sys/block/%s/loop/backing_file" % (devname,)).read().strip()
-                )
-            except IOError:
-                continue
-            if not os.path.exists(bfile):
-                continue
-            if not os.path.samefile(bfile, self.path) and not os.path.samefile(
-                bfile, alt_path
-            ):
-                continue
-            if (
-                not int(open("/sys/block/%s/loop/offset" % (devname,)).read().strip())
-                == 0
-            ):
-                continue
-            return "/dev/%s" % (devname,)
+                alt_path = self.aufs_original.path
+            except NotAufs:
+                return
+            entry = loop_devs.find_backing(alt_path)
+        return entry
+
+    @property
+    def loop_dev(self):
+        entry = self.loop_entry
+        if entry is not None:
+            return entry["dev"]
 
     def __del__(self):
         if self._remove_on_del and self.exists:
@@ -1693,65 +2294,267 @@ class FSPath(object):
                 raise ValueError("Refuse auto-remove files", self)
 
 
-class FSPathURLMixin:
-    _href_re = re.compile(rb"<a\b[^>]*\bhref=([^\s>]+)[^>]*>")
-    _proto_re = re.compile(r"^\w+:")
-    _write_pid = None
+class HTTPPooledResponse(object):
+    def __init__(self, pool, key, conn, resp, url):
+        self._pool = pool
+        self._key = key
+        self._conn = conn
+        self._resp = resp
+        self.url = url
+        self.status = self.code = resp.status
+        self.msg = self.reason = resp.reason
+        self.headers = resp.headers
 
-    @property
-    def exists(self):
-        req = urllib.request.Request(self.path, method="HEAD")
-        try:
-            resp = urllib.request.urlopen(req)
-        except urllib.request.HTTPError as e:
-            if e.code == 404:
-                return False
-        return resp.code == 200
+    def __getattr__(self, name):
+        return getattr(self._resp, name)
 
-    def open(self, mode="rb"):
-        if mode == "rb":
-            return urllib.request.urlopen(self.path)
-        elif mode == "wb":
-            fd_r, fd_w = os.pipe()
-            req = urllib.request.Request(
-                self.path, data=os.fdopen(fd_r, "rb"), method="PUT"
-            )
-            self._write_pid = os.fork()
-            if not self._write_pid:
-                os.close(fd_w)
-                resp = urllib.request.urlopen(req).read()
-                debug("PUT response: %r", resp)
-                os.close(fd_r)
-                exit(0)
-            return os.fdopen(fd_w, "wb")
-        raise ValueError(f"Unknown mode: {mode}")
+    def __enter__(self):
+        return self
 
-    @classmethod
-    def _rename_as_move(cls, dst, src):
-        dst_path = dst.path if isinstance(dst, FSPath) else dst
-        my_url = urllib.parse.urlparse(src.path)
-        dst_url = urllib.parse.urlparse(dst_path)
-        if dst_url.netloc != my_url.netloc or dst_url.scheme != my_url.scheme:
-            raise ValueError(
-                f"Not same server: {dst_path} not in {my_url.scheme}://{my_url.netloc}"
-            )
-        req = urllib.request.Request(
-            src.path,
-            method="MOVE",
-            headers={"Destination": dst_url.path},
-        )
-        if src._write_pid:
-            debug("waiting for writing to be finished")
-            os.waitpid(src._write_pid, 0)
-            debug("ok")
-            src._write_pid = None
-        resp = urllib.request.urlopen(req).read()
-        debug("MOVE response: %r", resp)
+    def __exit__(self, *exc_info):
+        self.close()
 
-    def rename(self, dst):
-        return self._rename_as_move(dst, self)
+    def __iter__(self):
+        return iter(self._resp)
 
-    def rename_from(self, src):
+    def info(self):
+        return self.headers
+
+    def getcode(self):
+        return self.status
+
+    def geturl(self):
+        return self.url
+
+    def _check_done(self, ret):
+        # a kept-alive connection never reaches EOF, read1() also does not
+        # close the response when the announced length is exhausted
+        if not self._resp.isclosed() and self._resp.length == 0:
+            self._resp.read()
+        if self._resp.isclosed():
+            self.release()
+        return ret
+
+    def settimeout(self, timeout):
+        """select() does not see data already buffered by the response, so
+        stalls of pooled connections are detected with a socket timeout, which
+        leaves the response unusable"""
+        if self._conn is not None and self._conn.sock is not None:
+            self._conn.sock.settimeout(timeout)
+
+    def read(self, *args):
+        return self._check_done(self._resp.read(*args))
+
+    def read1(self, *args):
+        return self._check_done(self._resp.read1(*args))
+
+    def readinto(self, b):
+        return self._check_done(self._resp.readinto(b))
+
+    def readline(self, *args):
+        return self._check_done(self._resp.readline(*args))
+
+    def release(self):
+        conn, self._conn = self._conn, None
+        if conn is None:
+            return
+        if self._resp.isclosed() and not self._resp.will_close:
+            if conn.sock is not None:
+                conn.sock.settimeout(socket.getdefaulttimeout())
+            self._pool.put(self._key, conn)
+        else:
+            conn.close()
+
+    def close(self):
+        if not self._resp.isclosed() and self._resp.length == 0:
+            self._resp.read()
+        self.release()
+        self._resp.close()
+
+
+class HTTPConnectionPool(object):
+    max_idle = int(os.environ.get("LBU_HTTP_POOL_SIZE", "8"))
+    max_redirects = 10
+    max_drain_size = 0x10000
+    redirect_codes = (301, 302, 303, 307, 308)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._pid = os.getpid()
+        self._idle = {}
+
+    def get(self, key):
+        with self.lock:
+            # sockets must not be shared with a forked parent
+            if not self._pid == os.getpid():
+                self._pid = os.getpid()
+                self._idle = {}
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop(), True
+        scheme, netloc = key
+        if scheme == "https":
+            return http.client.HTTPSConnection(netloc), False
+        return http.client.HTTPConnection(netloc), False
+
+    def put(self, key, conn):
+        with self.lock:
+            if self._pid == os.getpid():
+                idle = self._idle.setdefault(key, [])
+                if len(idle) < self.max_idle:
+                    idle.append(conn)
+                    return
+        conn.close()
+
+    def clear(self):
+        with self.lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+    @staticmethod
+    def _use_urllib(url_p):
+        if url_p.scheme not in ("http", "https"):
+            return True
+        proxies = urllib.request.getproxies()
+        return url_p.scheme in proxies and not urllib.request.proxy_bypass(
+            url_p.hostname or ""
+        )
+
+    def _request_once(self, method, url_p, body, headers):
+        key = (url_p.scheme, url_p.netloc)
+        path = url_p.path or "/"
+        if url_p.query:
+            path += "?" + url_p.query
+        while True:
+            conn, reused = self.get(key)
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                resp = conn.getresponse()
+            except (ConnectionResetError, BrokenPipeError, http.client.BadStatusLine):
+                conn.close()
+                # the server may have dropped an idle keep-alive connection
+                if reused and (body is None or isinstance(body, bytes)):
+                    continue
+                raise
+            except BaseException:
+                conn.close()
+                raise
+            return HTTPPooledResponse(self, key, conn, resp, url_p.geturl())
+
+    def request(self, method, url, body=None, headers={}):
+        req_headers = {"User-Agent": lbu_http_agent}
+        req_headers.update(headers)
+        for _ in range(self.max_redirects + 1):
+            url_p = urllib.parse.urlsplit(url)
+            if self._use_urllib(url_p):
+                return urllib.request.urlopen(
+                    urllib.request.Request(
+                        url, data=body, headers=req_headers, method=method
+                    )
+                )
+            try:
+                resp = self._request_once(method, url_p, body, req_headers)
+            except http.client.HTTPException as e:
+                raise urllib.error.URLError(e)
+            except OSError as e:
+                raise urllib.error.URLError(e)
+            if 200 <= resp.status < 300:
+                return resp
+            location = resp.headers.get("Location")
+            if (
+                resp.status in self.redirect_codes
+                and location
+                and method in ("GET", "HEAD")
+            ):
+                self._drain(resp)
+                url = urllib.parse.urljoin(url, location)
+                continue
+            raise urllib.error.HTTPError(
+                url,
+                resp.status,
+                resp.reason,
+                resp.headers,
+                io.BytesIO(self._drain(resp)),
+            )
+        raise urllib.error.HTTPError(
+            url, resp.status, "Too many redirects", resp.headers, None
+        )
+
+    def _drain(self, resp):
+        length = resp.length
+        data = b""
+        if length is not None and length <= self.max_drain_size:
+            data = resp.read()
+        resp.close()
+        return data
+
+
+http_pool = HTTPConnectionPool()
+
+
+class FSPathURLMixin:
+    _href_re = re.compile(rb"<a\b[^>]*\bhref=([^\s>]+)[^>]*>")
+    _proto_re = re.compile(r"^\w+:")
+    _write_thread = None
+    _write_error = None
+
+    @property
+    def exists(self):
+        try:
+            with http_pool.request("HEAD", self.path) as resp:
+                return resp.code == 200
+        except urllib.error.HTTPError as e:
+            if e.code == 404:
+                return False
+            raise
+
+    def open(self, mode="rb"):
+        if mode == "rb":
+            return http_pool.request("GET", self.path)
+        elif mode == "wb":
+            fd_r, fd_w = os.pipe()
+
+            def put():
+                try:
+                    with os.fdopen(fd_r, "rb") as body:
+                        with http_pool.request("PUT", self.path, body=body) as resp:
+                            debug("PUT response: %r", resp.read())
+                except Exception as e:
+                    self._write_error = e
+
+            self._write_error = None
+            self._write_thread = threading.Thread(target=put, daemon=True)
+            self._write_thread.start()
+            return os.fdopen(fd_w, "wb")
+        raise ValueError(f"Unknown mode: {mode}")
+
+    @classmethod
+    def _rename_as_move(cls, dst, src):
+        dst_path = dst.path if isinstance(dst, FSPath) else dst
+        my_url = urllib.parse.urlparse(src.path)
+        dst_url = urllib.parse.urlparse(dst_path)
+        if dst_url.netloc != my_url.netloc or dst_url.scheme != my_url.scheme:
+            raise ValueError(
+                f"Not same server: {dst_path} not in {my_url.scheme}://{my_url.netloc}"
+            )
+        if src._write_thread:
+            debug("waiting for writing to be finished")
+            src._write_thread.join()
+            debug("ok")
+            src._write_thread = None
+            if src._write_error is not None:
+                raise src._write_error
+        with http_pool.request(
+            "MOVE", src.path, headers={"Destination": dst_url.path}
+        ) as resp:
+            debug("MOVE response: %r", resp.read())
+
+    def rename(self, dst):
+        return self._rename_as_move(dst, self)
+
+    def rename_from(self, src):
         if self.exists:
             self.rename(self.path + f".OLD.{int(time.time())}")
         return self._rename_as_move(
@@ -1759,14 +2562,19 @@ class FSPathURLMixin:
         )
 
     def _walk_func(self, path):
-        resp = urllib.request.urlopen(path)
-        if not resp.code == 200:
-            raise BadArgumentsError("Status code not OK: %s %s" % (resp.code, resp.msg))
-        if not resp.headers.get_content_type() == "text/html":
-            raise BadArgumentsError("not text/html: %r" % (resp.type))
+        with http_pool.request("GET", path) as resp:
+            if not resp.code == 200:
+                raise BadArgumentsError(
+                    "Status code not OK: %s %s" % (resp.code, resp.msg)
+                )
+            if not resp.headers.get_content_type() == "text/html":
+                raise BadArgumentsError(
+                    "not text/html: %r" % (resp.headers.get_content_type())
+                )
+            listing = resp.read()
         dir_names = []
         file_names = []
-        for href in self._href_re.findall(resp.read()):
+        for href in self._href_re.findall(listing):
             href = href.decode("utf8")
             if href.startswith('"') or href.startswith("'"):
                 href = href[1:-1]
@@ -1783,22 +2591,60 @@ class FSPathURLMixin:
                 file_names.append(href)
         yield path, dir_names, file_names
 
+    probe_size = 96
+
+    def read_range(self, start, size, ranged_only=False):
+        """returns (data, total file size) using one ranged GET, with
+        ranged_only a server ignoring the range raises IOError instead of
+        being read from the start"""
+        with http_pool.request(
+            "GET",
+            self.path,
+            headers={"Range": "bytes=%d-%d" % (start, start + size - 1)},
+        ) as resp:
+            if resp.status == 206:
+                cr_m = Downloader.content_range_re.match(
+                    resp.headers.get("Content-Range", "")
+                )
+                if not cr_m or not int(cr_m.group("start")) == start:
+                    raise IOError(
+                        "Unexpected Content-Range for %s: %r"
+                        % (self.path, resp.headers.get("Content-Range"))
+                    )
+                length = cr_m.group("length")
+                return resp.read(size), None if length == "*" else int(length)
+            if ranged_only:
+                raise IOError("%s does not serve byte ranges" % (self.path,))
+            # no range support, take what is needed from the full body
+            clen = resp.headers.get("Content-Length")
+            return (
+                resp.read(start + size)[start:],
+                None if clen is None else int(clen),
+            )
+
+    @cached_property
+    def head_probe(self):
+        return self.read_range(0, self.probe_size)
+
     @cached_property
     def file_size(self):
-        clen = self.fobj.headers.get("Content-Length")
-        if clen is not None:
-            return int(clen)
+        return self.head_probe[1]
+
 
 class MountInfo(object):
     def __init__(self, mountinfo="/proc/self/mountinfo"):
         self.minfo = mountinfo
-        self._mnt_cache = {}
+        self.generation = 0
+        self.lock = threading.RLock()
+        self._minfo_fobj = None
+        self._entries = []
+        self._by_st_dev = {}
+        self._by_source = {}
+        self._by_fs_type = {}
+        self._by_mnt_key = None
 
     def __iter__(self):
-        with open(self.minfo) as minfo_fobj:
-            for line in minfo_fobj:
-                ret = self.proc_mountinfo_line(line)
-                yield ret
+        return iter(self.entries)
 
     @staticmethod
     def decode_escapes(s):
@@ -1815,9 +2661,7 @@ class MountInfo(object):
         ret = dict(
             mount_id=int(parts[0]),
             parent_id=int(parts[1]),
-            st_dev=reduce(
-                lambda a, b: (a << 8) + b, list(map(int, parts[2].split(":")))
-            ),
+            st_dev=os.makedev(*map(int, parts[2].split(":"))),
             root=MountInfo.decode_escapes(parts[3]),
             mnt=MountInfo.decode_escapes(parts[4]),
             opts_mnt=set(parts[5].split(",")),
@@ -1832,21 +2676,169 @@ class MountInfo(object):
         ret["opts"] = set(parts[idx + 3].split(","))
         return ret
 
-    @cached_property
+    def _changed(self):
+        if self._minfo_fobj is None:
+            return True
+        poller = select.poll()
+        poller.register(self._minfo_fobj, select.POLLPRI | select.POLLERR)
+        return any(ev & (select.POLLPRI | select.POLLERR) for _, ev in poller.poll(0))
+
+    def refresh(self, force=False):
+        with self.lock:
+            if not force and not self._changed():
+                return
+            if self._minfo_fobj is None:
+                # kept open: the kernel flags POLLPRI on it when mounts change
+                self._minfo_fobj = open(self.minfo)
+            else:
+                self._minfo_fobj.seek(0)
+            entries = [
+                self.proc_mountinfo_line(line)
+                for line in self._minfo_fobj.read().split("\n")
+                if line
+            ]
+            by_st_dev, by_source, by_fs_type = {}, {}, {}
+            for entry in entries:
+                by_st_dev.setdefault(entry["st_dev"], entry)
+                by_source.setdefault(entry["dev"], []).append(entry)
+                by_fs_type.setdefault(entry["fs_type"], []).append(entry)
+            self._entries = entries
+            self._by_st_dev = by_st_dev
+            self._by_source = by_source
+            self._by_fs_type = by_fs_type
+            self._by_mnt_key = None
+            self.generation += 1
+
+    @property
     def entries(self):
-        return list(self)
+        self.refresh()
+        return self._entries
 
     def find_dev(self, dev_name=None, dev_id=None):
         if dev_id is None:
             dev_id = os.stat(dev_name).st_rdev
-        for entry in self.entries:
-            if entry["st_dev"] == dev_id:
-                return entry
+        self.refresh()
+        return self._by_st_dev.get(dev_id)
+
+    def find_source(self, source):
+        self.refresh()
+        return self._by_source.get(source, [])
+
+    def find_fs_type(self, fs_type):
+        self.refresh()
+        return self._by_fs_type.get(fs_type, [])
+
+    def find_mnt(self, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return
+        with self.lock:
+            self.refresh()
+            if self._by_mnt_key is None:
+                by_mnt_key = {}
+                for entry in self._entries:
+                    try:
+                        mnt_st = os.stat(entry["mnt"])
+                    except OSError:
+                        continue
+                    by_mnt_key.setdefault((mnt_st.st_dev, mnt_st.st_ino), entry)
+                self._by_mnt_key = by_mnt_key
+            return self._by_mnt_key.get((st.st_dev, st.st_ino))
 
 
 global_mountinfo = MountInfo()
 
 
+class LoopDevTable(object):
+    sys_block = "/sys/block"
+
+    def __init__(self, mountinfo=global_mountinfo):
+        self.mountinfo = mountinfo
+        self.lock = threading.RLock()
+        self._generation = None
+        self._by_name = {}
+        self._by_backing = {}
+
+    @staticmethod
+    def _read_sys(path):
+        with open(path) as fobj:
+            return fobj.read().rstrip("\n")
+
+    def refresh(self, force=False):
+        with self.lock:
+            self.mountinfo.refresh()
+            # loop devices come and go with their mounts, so a mount table
+            # change event is what makes the table stale
+            if not force and self._generation == self.mountinfo.generation:
+                return
+            by_name, by_backing = {}, {}
+            for devname in os.listdir(self.sys_block):
+                if not devname.startswith("loop"):
+                    continue
+                loop_dir = os.path.join(self.sys_block, devname)
+                try:
+                    bfile = self._read_sys(os.path.join(loop_dir, "loop/backing_file"))
+                    offset = int(self._read_sys(os.path.join(loop_dir, "loop/offset")))
+                    st_rdev = os.makedev(
+                        *map(
+                            int,
+                            self._read_sys(os.path.join(loop_dir, "dev")).split(":"),
+                        )
+                    )
+                except (IOError, ValueError):
+                    continue
+                entry = dict(
+                    name=devname,
+                    dev="/dev/%s" % (devname,),
+                    st_rdev=st_rdev,
+                    backing_file=bfile,
+                    offset=offset,
+                )
+                by_name[devname] = entry
+                try:
+                    st = os.stat(bfile)
+                except OSError:
+                    continue
+                by_backing.setdefault((st.st_dev, st.st_ino), []).append(entry)
+            self._by_name = by_name
+            self._by_backing = by_backing
+            self._generation = self.mountinfo.generation
+
+    def __iter__(self):
+        self.refresh()
+        return iter(list(self._by_name.values()))
+
+    def _lookup(self, lookup):
+        self.refresh()
+        entry = lookup()
+        if entry is None:
+            # losetup and autoclear after a lazy umount attach or detach
+            # devices without a mount table change, rescan before giving up
+            self.refresh(force=True)
+            entry = lookup()
+        return entry
+
+    def find_name(self, loop_name):
+        return self._lookup(lambda: self._by_name.get(loop_name))
+
+    def find_backing(self, path, offset=0):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return
+
+        def lookup():
+            for entry in self._by_backing.get((st.st_dev, st.st_ino), []):
+                if offset is None or entry["offset"] == offset:
+                    return entry
+
+        return self._lookup(lookup)
+
+
+loop_devs = LoopDevTable()
+
+
 class GitRepo(FSPath):
     @cached_property
     def last_commit(self):
@@ -1871,6 +2863,163 @@ class GitRepo(FSPath):
     def last_stamp(self):
         return int(run_command(["git", "log", "-1", "--format=%ct"], cwd=self.path))
 
+    export_jobs = int(os.environ.get("GIT_EXPORT_JOBS", "4"))
+    # same modes as "git archive | tar x" with the default tar.umask
+    export_umask = 0o002
+
+    @cached_property
+    def _git_env(self):
+        return dict(os.environ, SUDO_UID="%d" % (os.stat(self.path).st_uid,))
+
+    def _git_popen(self, args, **kwargs):
+        return subprocess.Popen(
+            ["git"] + args, cwd=self.path, env=self._git_env, **kwargs
+        )
+
+    def _ls_tree(self):
+        proc = self._git_popen(
+            ["ls-tree", "-r", "-z", "--full-tree", "HEAD"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        out, err = proc.communicate()
+        if proc.returncode:
+            raise CommandFailed(["git", "ls-tree"], proc.returncode, err, out)
+        ret = []
+        for entry in out.split(b"\0"):
+            if not entry:
+                continue
+            info_part, path = entry.split(b"\t", 1)
+            mode, obj_type, sha = info_part.split()
+            ret.append((int(mode, 8), obj_type, sha, os.fsdecode(path)))
+        return ret
+
+    def _needs_archive(self, entries):
+        # attributes (export-ignore, export-subst, filters) are only applied by
+        # git archive itself
+        if any(path.rsplit("/", 1)[-1] == ".gitattributes" for *_, path in entries):
+            return True
+        try:
+            git_dir = run_command(
+                ["git", "rev-parse", "--absolute-git-dir"],
+                cwd=self.path,
+                env=dict(SUDO_UID=self._git_env["SUDO_UID"]),
+            )
+        except CommandFailed:
+            return True
+        return os.path.exists(os.path.join(git_dir, "info", "attributes"))
+
+    def _archive_to(self, dest):
+        run_command(
+            [
+                "sh",
+                "-c",
+                'mkdir -p "$DESTDIR";cd "$SRC";git archive HEAD | tar x -C "$DESTDIR"',
+            ],
+            env=dict(SUDO_UID=self._git_env["SUDO_UID"], DESTDIR=dest, SRC=self.path),
+            as_user="root",
+        )
+
+    def _write_blobs(self, blobs):
+        proc = self._git_popen(
+            ["cat-file", "--batch"], stdin=subprocess.PIPE, stdout=subprocess.PIPE
+        )
+
+        def feed():
+            try:
+                for _, sha, _ in blobs:
+                    proc.stdin.write(sha + b"\n")
+                proc.stdin.close()
+            except BrokenPipeError:
+                pass
+
+        feeder = threading.Thread(target=feed, daemon=True)
+        feeder.start()
+        stamp = (self.last_stamp, self.last_stamp)
+        try:
+            for mode, sha, path in blobs:
+                header = proc.stdout.readline().split()
+                if len(header) != 3 or not header[0] == sha:
+                    raise IOError("git cat-file: unexpected reply %r" % (header,))
+                size = int(header[2])
+                if mode == 0o120000:
+                    os.symlink(proc.stdout.read(size), path)
+                    os.utime(path, stamp, follow_symlinks=False)
+                else:
+                    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+                    try:
+                        while size:
+                            data = proc.stdout.read(min(size, 0x100000))
+                            if not data:
+                                raise IOError("git cat-file: short read of %s" % path)
+                            os.write(fd, data)
+                            size -= len(data)
+                        os.fchmod(
+                            fd, (0o777 if mode & 0o111 else 0o666) & ~self.export_umask
+                        )
+                        os.utime(fd, stamp)
+                    finally:
+                        os.close(fd)
+                proc.stdout.read(1)
+        except BaseException:
+            proc.kill()
+            raise
+        finally:
+            proc.stdout.close()
+            feeder.join()
+            proc.wait()
+
+    def _write_tree(self, dest, entries):
+        dirs = set()
+
+        def make_dir(path):
+            if not path or path in dirs:
+                return
+            make_dir(os.path.dirname(path))
+            try:
+                os.mkdir(os.path.join(dest, path))
+            except FileExistsError:
+                pass
+            os.chmod(os.path.join(dest, path), 0o777 & ~self.export_umask)
+            dirs.add(path)
+
+        blobs = []
+        for mode, obj_type, sha, path in entries:
+            make_dir(os.path.dirname(path))
+            if obj_type == b"commit":
+                make_dir(path)
+            elif obj_type == b"blob":
+                blobs.append((mode, sha, os.path.join(dest, path)))
+        self._write_blobs(blobs)
+        for path in sorted(dirs, reverse=True):
+            os.utime(os.path.join(dest, path), (self.last_stamp, self.last_stamp))
+
+    def _export(self, dest):
+        entries = self._ls_tree()
+        if self._needs_archive(entries):
+            self._archive_to(dest)
+        else:
+            self._write_tree(dest, entries)
+        return [path for _, obj_type, _, path in entries if obj_type == b"commit"]
+
+    def export_tree(self, dest):
+        """writes HEAD of this repository and of its checked out submodules to
+        dest, like git archive | tar x for each of them"""
+        submodules = [
+            GitRepo(self.join(path))
+            for path in self._export(dest)
+            if os.path.exists(os.path.join(self.path, path, ".git"))
+        ]
+
+        def export_submodule(repo):
+            sub_dest = os.path.join(dest, os.path.relpath(repo.path, self.path))
+            repo._export(sub_dest)
+            os.utime(sub_dest, (repo.last_stamp, repo.last_stamp))
+
+        with concurrent.futures.ThreadPoolExecutor(self.export_jobs) as pool:
+            for fut in [pool.submit(export_submodule, r) for r in submodules]:
+                fut.result()
+
 
 def parse_time(s, fmt, tz="GMT"):
     parsed_time = time.strptime(s, fmt)
@@ -1891,7 +3040,8 @@ class Downloader(object):
     http_url_re = re.compile(r"^https?://.*")
 
     http_recv_tmout = 10
-    http_read_size = 8192
+    http_read_size = int(os.environ.get("DL_READ_SIZE", "65536"))
+    http_read_size_max = int(os.environ.get("DL_READ_SIZE_MAX", str(4 << 20)))
     http_time_format = "%a, %d %b %Y %H:%M:%S GMT"
 
     _env_proxy_vars = " ".join(
@@ -1957,49 +3107,300 @@ class Downloader(object):
             run_command(cmd, env=git_env)
             return GitRepo(dest_path)
 
-    def dl_file_url(self, source, dest_path):
-        opener = urllib.request.build_opener()
-        if os.path.exists(dest_path):
-            dest_st = os.stat(dest_path)
-            if dest_st.st_size > 0:
-                opener.addheaders.append(
-                    (
-                        "If-Modified-Since",
-                        time.strftime(
-                            self.http_time_format, time.gmtime(dest_st.st_mtime)
-                        ),
-                    )
-                )
+    dl_part_suffix = ".dlpart"
+    content_range_re = re.compile(
+        r"^bytes (?P<start>[0-9]+)-[0-9]+/(?P<length>[0-9]+|\*)$"
+    )
+
+    @staticmethod
+    def _read_dl_state(state_path):
         try:
-            url_f = opener.open(source)
-        except urllib.error.HTTPError as e:
-            if e.code == 304:
-                return FSPath(dest_path)
-            raise
+            with open(state_path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    @staticmethod
+    def _write_dl_state(state_path, state):
+        state_path_tmp = "%s.%d.tmp" % (state_path, os.getpid())
+        with open(state_path_tmp, "w") as f:
+            json.dump(state, f)
+        os.rename(state_path_tmp, state_path)
+
+    @staticmethod
+    def _range_validator(headers):
+        # If-Range only accepts strong ETags
+        etag = headers.get("ETag")
+        if etag and not etag.startswith("W/"):
+            return etag
+        return headers.get("Last-Modified")
+
+    def _open_part(self, source, part_path):
+        while True:
+            part_fd = os.open(part_path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(part_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                info("Waiting for concurrent download of %s", source)
+                fcntl.flock(part_fd, fcntl.LOCK_EX)
+            # the previous lock holder may have completed and renamed the file
+            try:
+                part_st = os.stat(part_path)
+            except OSError:
+                part_st = None
+            fd_st = os.fstat(part_fd)
+            if part_st is not None and (part_st.st_dev, part_st.st_ino) == (
+                fd_st.st_dev,
+                fd_st.st_ino,
+            ):
+                return part_fd
+            os.close(part_fd)
+
+    def _finish_part(self, dest_path, part_path, state_path, lm_hdr):
+        if lm_hdr:
+            mtime = parse_time(lm_hdr, self.http_time_format, "GMT")
+            os.utime(part_path, (time.time(), mtime))
+        os.rename(part_path, dest_path)
+        try:
+            os.unlink(state_path)
+        except OSError:
+            pass
+        return FSPath(dest_path)
 
-        dest_path_tmp = "%s.%d.dltemp" % (dest_path, os.getpid())
-        dest_f = open(dest_path_tmp, "wb")
+    def _copy_response(self, url_f, dest_f):
+        read_size = self.http_read_size
+        read = getattr(url_f, "read1", url_f.read)
+        pooled = isinstance(url_f, HTTPPooledResponse)
+        if pooled:
+            url_f.settimeout(self.http_recv_tmout)
         while True:
             try:
                 url_f.fileno()
             except AttributeError:
                 pass
             else:
-                r_in = select.select([url_f], [], [], self.http_recv_tmout)[0]
+                r_in = pooled or select.select([url_f], [], [], self.http_recv_tmout)[0]
                 if not r_in:
                     info("No data in %s seconds, stalled?", self.http_recv_tmout)
                     continue
-            d = url_f.read(self.http_read_size)
+            try:
+                d = read(read_size)
+            except socket.timeout:
+                raise IOError(
+                    "No data in %s seconds, giving up" % (self.http_recv_tmout,)
+                )
             if not d:
                 break
             dest_f.write(d)
-        dest_f.close()
-        lm_hdr = url_f.headers.get("Last-Modified")
-        if lm_hdr:
-            mtime = parse_time(lm_hdr, self.http_time_format, "GMT")
-            os.utime(dest_path_tmp, (time.time(), mtime))
-        os.rename(dest_path_tmp, dest_path)
-        return FSPath(dest_path)
+            # a full buffer means the link keeps up, so ask for more next time
+            if len(d) == read_size and read_size < self.http_read_size_max:
+                read_size *= 2
+
+    dl_segments = int(os.environ.get("DL_SEGMENTS", "1"))
+    dl_segment_min = int(os.environ.get("DL_SEGMENT_MIN", str(16 << 20)), 0)
+
+    def probe_ranges(self, source):
+        with http_pool.request("HEAD", source) as resp:
+            headers = resp.headers
+        length = headers.get("Content-Length")
+        if not headers.get("Accept-Ranges") == "bytes" or length is None:
+            return
+        return dict(
+            source=source,
+            validator=self._range_validator(headers),
+            last_modified=headers.get("Last-Modified"),
+            length=int(length),
+        )
+
+    def dl_segmented(self, source, fd, progress_cb=None, probe=None):
+        """fetch source into fd using parallel range requests
+        returns the probed state, or None if the file is not worth splitting or
+        the server does not support it"""
+        if self.dl_segments < 2:
+            return
+        if probe is None:
+            probe = self.probe_ranges(source)
+        if probe is None or not probe["validator"]:
+            return
+        length = probe["length"]
+        nr_segments = min(self.dl_segments, length // max(self.dl_segment_min, 1))
+        if nr_segments < 2:
+            return
+        try:
+            os.posix_fallocate(fd, 0, length)
+        except OSError:
+            os.ftruncate(fd, length)
+        segment_size = -(-length // nr_segments)
+        progress_lock = threading.Lock()
+        done = [0]
+
+        def fetch_segment(start):
+            end = min(start + segment_size, length) - 1
+            with http_pool.request(
+                "GET",
+                source,
+                headers={
+                    "Range": "bytes=%d-%d" % (start, end),
+                    "If-Range": probe["validator"],
+                },
+            ) as resp:
+                cr_m = self.content_range_re.match(
+                    resp.headers.get("Content-Range", "")
+                )
+                if (
+                    not resp.status == 206
+                    or not cr_m
+                    or not int(cr_m.group("start")) == start
+                ):
+                    raise IOError(
+                        "%s changed or does not serve byte ranges" % (source,)
+                    )
+                pos = start
+                while pos <= end:
+                    d = resp.read1(min(self.http_read_size_max, end + 1 - pos))
+                    if not d:
+                        raise IOError(
+                            "Short read of %s at %d (segment %d-%d)"
+                            % (source, pos, start, end)
+                        )
+                    written = 0
+                    while written < len(d):
+                        written += os.pwrite(fd, d[written:], pos + written)
+                    pos += len(d)
+                    if progress_cb:
+                        with progress_lock:
+                            done[0] += len(d)
+                            progress_cb(done[0])
+
+        info("Downloading %s in %d segments", source, nr_segments)
+        if progress_cb:
+            progress_cb(0)
+        with concurrent.futures.ThreadPoolExecutor(nr_segments) as pool:
+            futures = [
+                pool.submit(fetch_segment, start)
+                for start in range(0, length, segment_size)
+            ]
+            for future in futures:
+                future.result()
+        if progress_cb:
+            progress_cb(None)
+        return probe
+
+    def dl_file_url(self, source, dest_path):
+        part_path = dest_path + self.dl_part_suffix
+        state_path = part_path + ".json"
+        part_fd = self._open_part(source, part_path)
+        try:
+            return self._dl_file_url(source, dest_path, part_fd, part_path, state_path)
+        finally:
+            self._drop_empty_part(part_fd, part_path, state_path)
+            os.close(part_fd)
+
+    @staticmethod
+    def _drop_empty_part(part_fd, part_path, state_path):
+        # nothing to resume from (not modified, errors), do not leave it behind
+        fd_st = os.fstat(part_fd)
+        if fd_st.st_size > 0:
+            return
+        try:
+            part_st = os.stat(part_path)
+        except OSError:
+            return
+        # renamed to dest_path, another download may own part_path by now
+        if not (part_st.st_dev, part_st.st_ino) == (fd_st.st_dev, fd_st.st_ino):
+            return
+        for path in (part_path, state_path):
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+    def _dl_file_url(self, source, dest_path, part_fd, part_path, state_path):
+        headers = {}
+        if os.path.exists(dest_path):
+            dest_st = os.stat(dest_path)
+            if dest_st.st_size > 0:
+                headers["If-Modified-Since"] = time.strftime(
+                    self.http_time_format, time.gmtime(dest_st.st_mtime)
+                )
+        part_size = os.fstat(part_fd).st_size
+        state = self._read_dl_state(state_path)
+        if part_size == 0 and self.dl_segments > 1 and self.http_url_re.match(source):
+            probe = self.probe_ranges(source)
+            if (
+                probe is not None
+                and os.path.exists(dest_path)
+                and os.stat(dest_path).st_size > 0
+                and probe["last_modified"]
+                and parse_time(probe["last_modified"], self.http_time_format, "GMT")
+                <= os.stat(dest_path).st_mtime
+            ):
+                return FSPath(dest_path)
+            try:
+                probe = self.dl_segmented(source, part_fd, probe=probe)
+            except BaseException:
+                # holes cannot be resumed with a single range, start over next time
+                os.ftruncate(part_fd, 0)
+                raise
+            if probe is not None:
+                return self._finish_part(
+                    dest_path, part_path, state_path, probe["last_modified"]
+                )
+        if part_size > 0 and state.get("source") == source and state.get("validator"):
+            headers["Range"] = "bytes=%d-" % (part_size,)
+            headers["If-Range"] = state["validator"]
+        else:
+            part_size = 0
+        try:
+            url_f = http_pool.request("GET", source, headers=headers)
+        except urllib.error.HTTPError as e:
+            if e.code == 304:
+                os.ftruncate(part_fd, 0)
+                return FSPath(dest_path)
+            if e.code == 416 and part_size and part_size == state.get("length"):
+                info("Download of %s was already complete", source)
+                return self._finish_part(
+                    dest_path, part_path, state_path, state.get("last_modified")
+                )
+            raise
+
+        with url_f:
+            offset = 0
+            if getattr(url_f, "status", None) == 206:
+                cr_m = self.content_range_re.match(
+                    url_f.headers.get("Content-Range", "")
+                )
+                if not cr_m or not int(cr_m.group("start")) == part_size:
+                    raise IOError(
+                        "Unexpected Content-Range for %s: %r"
+                        % (source, url_f.headers.get("Content-Range"))
+                    )
+                offset = part_size
+                info("Resuming download of %s at %d bytes", source, offset)
+            length = url_f.headers.get("Content-Length")
+            if length is not None:
+                length = offset + int(length)
+            state = dict(
+                source=source,
+                validator=self._range_validator(url_f.headers),
+                last_modified=url_f.headers.get("Last-Modified"),
+                length=length,
+            )
+            os.ftruncate(part_fd, offset)
+            self._write_dl_state(state_path, state)
+            with open(part_fd, "r+b", closefd=False) as dest_f:
+                dest_f.seek(offset)
+                self._copy_response(url_f, dest_f)
+
+        part_size = os.fstat(part_fd).st_size
+        if length is not None and not part_size == length:
+            raise IOError(
+                "Download of %s incomplete (%d of %d bytes), will resume next time"
+                % (source, part_size, length)
+            )
+        return self._finish_part(
+            dest_path, part_path, state_path, state["last_modified"]
+        )
 
     def dl_file(self, source, fname=None, dest_dir=None):
         if dest_dir is None:
@@ -2013,45 +3414,1845 @@ class Downloader(object):
                 fname = fname[:-4]
         dest = os.path.join(dest_dir, fname)
 
-        if self.git_url_re.match(source):
-            return self.dl_file_git(source, dest)
-        return self.dl_file_url(source, dest)
+        with self._dest_lock(dest):
+            if self.git_url_re.match(source):
+                return self.dl_file_git(source, dest)
+            return self.dl_file_url(source, dest)
+
+    _dest_locks_lock = threading.Lock()
+
+    @cached_property
+    def _dest_locks(self):
+        return {}
+
+    def _dest_lock(self, dest_path):
+        with self._dest_locks_lock:
+            return self._dest_locks.setdefault(dest_path, threading.Lock())
 
 
 dl = Downloader()
 
 
+def _file_digest(path, algo="sha256", **kwargs):
+    checksum = hashlib.new(algo, **kwargs)
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size:
+            with mmap.mmap(f.fileno(), 0, prot=mmap.PROT_READ) as mm:
+                mm.madvise(mmap.MADV_SEQUENTIAL)
+                checksum.update(mm)
+    return checksum.hexdigest()
+
+
 class ChecksumFile(FSPath):
     std_name = "sha256sum.txt"
+    checksum_algo = hashlib.sha256
+    verify_jobs = int(os.environ.get("SFS_VERIFY_JOBS", str(os.cpu_count() or 1)))
+    _update_lock = threading.RLock()
+    _instances = {}
+    _flush_registered = False
 
-    def update(self, target, checksum):
-        relpath = os.path.relpath(target.path, self.parent_directory.path)
-        with self.open("r+") as f:
-            while True:
-                pos = f.tell()
-                line = f.readline()
-                if line == "":
-                    print(f"{checksum}  {relpath}", file=f)
-                    break
-                f_checksum, f_name = line.split()
-                if f_name == relpath:
-                    if f_checksum != checksum:
-                        f.seek(pos)
-                        f.write(checksum)
-                    break
+    @classmethod
+    def shared(cls, path):
+        key = os.path.realpath(path)
+        with cls._update_lock:
+            try:
+                return cls._instances[key]
+            except KeyError:
+                ret = cls._instances[key] = cls(path)
+                return ret
 
     @classmethod
-    def find_in_parents_of(cls, target):
+    def flush_all(cls):
+        with cls._update_lock:
+            instances = list(cls._instances.values())
+        for cksum_file in instances:
+            cksum_file.flush()
+
+    @staticmethod
+    def parse(path):
+        entries = {}
+        try:
+            f = open(path)
+        except FileNotFoundError:
+            return entries
+        with f:
+            for line in f:
+                parts = line.rstrip("\n").split(None, 1)
+                if not len(parts) == 2:
+                    continue
+                checksum, name = parts
+                entries[name[1:] if name.startswith("*") else name] = checksum
+        return entries
+
+    @cached_property
+    def entries(self):
+        return self.parse(self.path)
+
+    @cached_property
+    def pending(self):
+        return {}
+
+    def relpath(self, target):
+        return os.path.relpath(target.path, self.parent_directory.path)
+
+    def get(self, target):
+        return self.entries.get(self.relpath(target))
+
+    def update(self, target, checksum):
+        name = self.relpath(target)
+        with self._update_lock:
+            if self.entries.get(name) == checksum:
+                return
+            self.entries[name] = checksum
+            self.pending[name] = checksum
+            if not ChecksumFile._flush_registered:
+                ChecksumFile._flush_registered = True
+                atexit.register(ChecksumFile.flush_all)
+
+    def flush(self):
+        with self._update_lock:
+            if not self.pending:
+                return
+            # merge into what is on disk now, other runs may have written it
+            entries = self.parse(self.path)
+            entries.update(self.pending)
+            path_tmp = "%s.%d.tmp" % (self.path, os.getpid())
+            with open(path_tmp, "w") as f:
+                for name, checksum in entries.items():
+                    f.write("%s  %s\n" % (checksum, name))
+                f.flush()
+                os.fsync(f.fileno())
+            try:
+                os.chmod(path_tmp, stat.S_IMODE(os.stat(self.path).st_mode))
+            except OSError:
+                pass
+            os.rename(path_tmp, self.path)
+            try:
+                dir_fd = os.open(self.parent_directory.path, os.O_RDONLY)
+            except OSError:
+                pass
+            else:
+                try:
+                    os.fsync(dir_fd)
+                finally:
+                    os.close(dir_fd)
+            debug("Wrote %d checksum updates to %s", len(self.pending), self.path)
+            self.entries = entries
+            self.pending = {}
+
+    def digests(self, paths, jobs=None):
+        """returns {path: hexdigest}, reusing digests cached in the SFS index by
+        (inode, mtime, size) and hashing the rest in a process pool"""
+        algo = self.checksum_algo().name
+        ret = {}
+        todo = {}
+        for path in paths:
+            st = os.stat(path)
+            cached = sfs_meta_index.cached_digest(st, algo)
+            if cached is None:
+                todo[path] = st
+            else:
+                ret[path] = cached
+        if todo:
+            with concurrent.futures.ProcessPoolExecutor(
+                min(jobs or self.verify_jobs, len(todo))
+            ) as pool:
+                for path, digest in zip(
+                    todo, pool.map(_file_digest, todo, [algo] * len(todo))
+                ):
+                    ret[path] = digest
+                    st = os.stat(path)
+                    if SFSMetaIndex.stat_key(st) == SFSMetaIndex.stat_key(todo[path]):
+                        sfs_meta_index.store_digest(st, algo, digest)
+        return ret
+
+    def verify(self, names=None, jobs=None):
+        """returns {name: True if matching, False if not, None if missing}"""
+        if names is None:
+            names = list(self.entries)
+        base_dir = self.parent_directory.path
+        present = dict(
+            (name, os.path.join(base_dir, name))
+            for name in names
+            if self.entries.get(name) is not None
+            and os.path.isfile(os.path.join(base_dir, name))
+        )
+        digests = self.digests(list(present.values()), jobs)
+        return dict(
+            (
+                name,
+                digests[present[name]] == self.entries[name]
+                if name in present
+                else None,
+            )
+            for name in names
+        )
+
+    @classmethod
+    def find_in_parents_of(cls, target):
         fs_dir = target.parent_directory
         while True:
             test_file = fs_dir.join(cls.std_name)
             if test_file.exists:
-                return cls(test_file.path)
+                return cls.shared(test_file.path)
             fs_dir = fs_dir.parent_directory
             if not fs_dir.path or fs_dir.path == "/":
                 break
 
 
+class SquashFSImage(object):
+    MAGIC = b"hsqs"
+    SUPERBLOCK_FMT = "<IIIIIHHHHHHQQQQQQQQ"
+    SUPERBLOCK_SIZE = struct.calcsize(SUPERBLOCK_FMT)
+    SUPERBLOCK_FIELDS = (
+        "magic",
+        "inode_count",
+        "mkfs_time",
+        "block_size",
+        "fragment_count",
+        "compression_id",
+        "block_log",
+        "flags",
+        "id_count",
+        "version_major",
+        "version_minor",
+        "root_inode_ref",
+        "bytes_used",
+        "id_table_start",
+        "xattr_id_table_start",
+        "inode_table_start",
+        "directory_table_start",
+        "fragment_table_start",
+        "export_table_start",
+    )
+
+    COMPRESSORS = {1: "gzip", 2: "lzma", 3: "lzo", 4: "xz", 5: "lz4", 6: "zstd"}
+
+    METADATA_SIZE = 8192
+    METADATA_UNCOMPRESSED = 0x8000
+    BLOCK_UNCOMPRESSED = 0x1000000
+    NO_FRAGMENT = 0xFFFFFFFF
+    FLAG_NO_XATTRS = 0x200
+    FLAG_COMPRESSOR_OPTIONS = 0x400
+    FRAGMENT_ENTRY_FMT = "<QII"
+    FRAGMENT_ENTRY_SIZE = struct.calcsize(FRAGMENT_ENTRY_FMT)
+
+    INODE_HEADER_FMT = "<HHHHII"
+    INODE_DIR, INODE_FILE, INODE_SYMLINK = 1, 2, 3
+    INODE_BLKDEV, INODE_CHRDEV, INODE_FIFO, INODE_SOCKET = 4, 5, 6, 7
+    INODE_LDIR, INODE_LFILE, INODE_LSYMLINK = 8, 9, 10
+    INODE_LBLKDEV, INODE_LCHRDEV, INODE_LFIFO, INODE_LSOCKET = 11, 12, 13, 14
+
+    DIR_HEADER_FMT = "<III"
+    DIR_ENTRY_FMT = "<HhHH"
+
+    class Inode(object):
+        def __init__(self, **attrs):
+            for k in attrs:
+                setattr(self, k, attrs[k])
+
+        @property
+        def is_dir(self):
+            return self.type in (SquashFSImage.INODE_DIR, SquashFSImage.INODE_LDIR)
+
+        @property
+        def is_file(self):
+            return self.type in (SquashFSImage.INODE_FILE, SquashFSImage.INODE_LFILE)
+
+        @property
+        def is_symlink(self):
+            return self.type in (
+                SquashFSImage.INODE_SYMLINK,
+                SquashFSImage.INODE_LSYMLINK,
+            )
+
+        @repr_wrap(as_str=True)
+        def __repr__(self):
+            return "#%d type=%d" % (self.inode_number, self.type)
+
+    class MetadataCursor(object):
+        def __init__(self, image, table_start, block, offset):
+            self.image = image
+            self.pos = table_start + block
+            self.offset = offset
+
+        def read(self, size):
+            ret = []
+            while size > 0:
+                data, next_pos = self.image.metadata_block(self.pos)
+                chunk = data[self.offset : self.offset + size]
+                if not chunk:
+                    if self.offset < len(data):
+                        raise NotSFS("Truncated metadata block", self.pos)
+                    self.pos, self.offset = next_pos, 0
+                    continue
+                ret.append(chunk)
+                size -= len(chunk)
+                self.offset += len(chunk)
+            return b"".join(ret)
+
+        def unpack(self, fmt):
+            return struct.unpack(fmt, self.read(struct.calcsize(fmt)))
+
+    def __init__(self, path, fobj=None):
+        self.path = path
+        if fobj is None:
+            fobj = open(path, "rb")
+        self.fobj = fobj
+        self._md_cache = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.fobj.close()
+
+    @repr_wrap
+    def __repr__(self):
+        return self.path
+
+    def pread(self, size, offset):
+        data = os.pread(self.fobj.fileno(), size, offset)
+        if len(data) < size:
+            raise NotSFS("Short read at offset %d" % (offset,), self.path)
+        return data
+
+    @classmethod
+    def parse_superblock(cls, data):
+        if data[:4] != cls.MAGIC:
+            raise NotSFS("file does not have sqsh signature")
+        if len(data) < cls.SUPERBLOCK_SIZE:
+            raise NotSFS("Truncated squashfs superblock")
+        return dict(
+            zip(
+                cls.SUPERBLOCK_FIELDS,
+                struct.unpack(cls.SUPERBLOCK_FMT, data[: cls.SUPERBLOCK_SIZE]),
+            )
+        )
+
+    @cached_property
+    def superblock(self):
+        sb = self.parse_superblock(self.pread(self.SUPERBLOCK_SIZE, 0))
+        if sb["version_major"] != 4:
+            raise NotSFS(
+                "Unsupported squashfs version %d.%d"
+                % (sb["version_major"], sb["version_minor"]),
+                self.path,
+            )
+        return sb
+
+    @cached_property
+    def compression(self):
+        return self.COMPRESSORS.get(self.superblock["compression_id"])
+
+    @cached_property
+    def compressor_options(self):
+        """raw metadata block with the compressor options, if present"""
+        if not self.superblock["flags"] & self.FLAG_COMPRESSOR_OPTIONS:
+            return None
+        (hdr,) = struct.unpack("<H", self.pread(2, self.SUPERBLOCK_SIZE))
+        return self.pread(2 + (hdr & ~self.METADATA_UNCOMPRESSED), self.SUPERBLOCK_SIZE)
+
+    def decompress(self, data, size):
+        comp = self.compression
+        try:
+            if comp == "gzip":
+                return zlib.decompress(data)
+            elif comp == "xz":
+                return lzma.decompress(data, format=lzma.FORMAT_XZ)
+            elif comp == "lzma":
+                return lzma.decompress(data, format=lzma.FORMAT_ALONE)
+            elif comp == "zstd" and zstandard is not None:
+                return zstandard.ZstdDecompressor().decompress(
+                    data, max_output_size=size
+                )
+            elif comp == "lz4" and lz4 is not None:
+                return lz4.block.decompress(data, uncompressed_size=size)
+            elif comp == "lzo" and lzo is not None:
+                return lzo.decompress(data, False, size)
+        except (zlib.error, lzma.LZMAError) as e:
+            raise NotSFS("Corrupt %s block: %s" % (comp, e), self.path)
+        raise CompressorUnavailable(
+            "No decompressor available for %s" % (comp,), self.path
+        )
+
+    def metadata_block(self, pos):
+        try:
+            return self._md_cache[pos]
+        except KeyError:
+            pass
+        (hdr,) = struct.unpack("<H", self.pread(2, pos))
+        size = hdr & ~self.METADATA_UNCOMPRESSED
+        data = self.pread(size, pos + 2)
+        if not hdr & self.METADATA_UNCOMPRESSED:
+            data = self.decompress(data, self.METADATA_SIZE)
+        ret = self._md_cache[pos] = (data, pos + 2 + size)
+        return ret
+
+    def inode(self, ref):
+        cur = self.MetadataCursor(
+            self, self.superblock["inode_table_start"], ref >> 16, ref & 0xFFFF
+        )
+        (itype, mode, uid_idx, gid_idx, mtime, inode_number) = cur.unpack(
+            self.INODE_HEADER_FMT
+        )
+        ret = self.Inode(
+            ref=ref,
+            type=itype,
+            mode=mode,
+            uid_idx=uid_idx,
+            gid_idx=gid_idx,
+            mtime=mtime,
+            inode_number=inode_number,
+            xattr=self.NO_FRAGMENT,
+            nlink=1,
+        )
+        if itype == self.INODE_DIR:
+            (
+                ret.start_block,
+                ret.nlink,
+                ret.file_size,
+                ret.offset,
+                ret.parent,
+            ) = cur.unpack("<IIHHI")
+        elif itype == self.INODE_LDIR:
+            (
+                ret.nlink,
+                ret.file_size,
+                ret.start_block,
+                ret.parent,
+                i_count,
+                ret.offset,
+                ret.xattr,
+            ) = cur.unpack("<IIIIHHI")
+        elif itype in (self.INODE_FILE, self.INODE_LFILE):
+            if itype == self.INODE_FILE:
+                (
+                    ret.blocks_start,
+                    ret.fragment,
+                    ret.frag_offset,
+                    ret.file_size,
+                ) = cur.unpack("<IIII")
+            else:
+                (
+                    ret.blocks_start,
+                    ret.file_size,
+                    _sparse,
+                    ret.nlink,
+                    ret.fragment,
+                    ret.frag_offset,
+                    ret.xattr,
+                ) = cur.unpack("<QQQIIII")
+            block_size = self.superblock["block_size"]
+            if ret.fragment == self.NO_FRAGMENT:
+                nblocks = (ret.file_size + block_size - 1) // block_size
+            else:
+                nblocks = ret.file_size // block_size
+            ret.block_sizes = cur.unpack("<%dI" % (nblocks,))
+        elif itype in (self.INODE_SYMLINK, self.INODE_LSYMLINK):
+            ret.nlink, target_size = cur.unpack("<II")
+            ret.target = cur.read(target_size).decode("utf8", "surrogateescape")
+            if itype == self.INODE_LSYMLINK:
+                (ret.xattr,) = cur.unpack("<I")
+        elif itype in (self.INODE_BLKDEV, self.INODE_CHRDEV):
+            ret.nlink, ret.rdev = cur.unpack("<II")
+        elif itype in (self.INODE_LBLKDEV, self.INODE_LCHRDEV):
+            ret.nlink, ret.rdev, ret.xattr = cur.unpack("<III")
+        elif itype in (self.INODE_FIFO, self.INODE_SOCKET):
+            (ret.nlink,) = cur.unpack("<I")
+        elif itype in (self.INODE_LFIFO, self.INODE_LSOCKET):
+            ret.nlink, ret.xattr = cur.unpack("<II")
+        else:
+            raise NotSFS("Unknown inode type %d" % (itype,), self.path)
+        return ret
+
+    @cached_property
+    def root_inode(self):
+        return self.inode(self.superblock["root_inode_ref"])
+
+    def listdir(self, dir_inode):
+        if not dir_inode.is_dir:
+            raise NotADirectoryError(errno.ENOTDIR, "Not a directory", dir_inode)
+        cur = self.MetadataCursor(
+            self,
+            self.superblock["directory_table_start"],
+            dir_inode.start_block,
+            dir_inode.offset,
+        )
+        remaining = dir_inode.file_size - 3
+        hdr_size = struct.calcsize(self.DIR_HEADER_FMT)
+        ent_size = struct.calcsize(self.DIR_ENTRY_FMT)
+        while remaining > 0:
+            count, start, base_number = cur.unpack(self.DIR_HEADER_FMT)
+            remaining -= hdr_size
+            for _ in range(count + 1):
+                offset, number_delta, itype, name_size = cur.unpack(self.DIR_ENTRY_FMT)
+                name = cur.read(name_size + 1).decode("utf8", "surrogateescape")
+                remaining -= ent_size + name_size + 1
+                yield name, (start << 16) | offset, itype, base_number + number_delta
+
+    def lookup(self, path):
+        inode = self.root_inode
+        for name in [p for p in path.split("/") if p]:
+            for entry_name, ref, _, _ in self.listdir(inode):
+                if entry_name == name:
+                    inode = self.inode(ref)
+                    break
+            else:
+                raise FileNotFoundError(errno.ENOENT, "No such file in image", path)
+        return inode
+
+    def fragment_entry(self, index):
+        (table_pos,) = struct.unpack(
+            "<Q",
+            self.pread(8, self.superblock["fragment_table_start"] + 8 * (index // 512)),
+        )
+        cur = self.MetadataCursor(
+            self, table_pos, 0, (index % 512) * self.FRAGMENT_ENTRY_SIZE
+        )
+        start, size, _ = cur.unpack(self.FRAGMENT_ENTRY_FMT)
+        return start, size
+
+    def read_block(self, pos, size_entry, out_size):
+        size = size_entry & (self.BLOCK_UNCOMPRESSED - 1)
+        if size == 0:
+            return b"\0" * out_size
+        data = self.pread(size, pos)
+        if not size_entry & self.BLOCK_UNCOMPRESSED:
+            data = self.decompress(data, self.superblock["block_size"])
+        return data
+
+    def iter_inode_data(self, inode):
+        block_size = self.superblock["block_size"]
+        pos = inode.blocks_start
+        left = inode.file_size
+        for size_entry in inode.block_sizes:
+            data = self.read_block(pos, size_entry, min(block_size, left))[:left]
+            yield data
+            left -= len(data)
+            pos += size_entry & (self.BLOCK_UNCOMPRESSED - 1)
+        if inode.fragment != self.NO_FRAGMENT and left > 0:
+            frag_start, frag_size = self.fragment_entry(inode.fragment)
+            frag = self.read_block(frag_start, frag_size, block_size)
+            yield frag[inode.frag_offset : inode.frag_offset + left]
+
+    def read_inode_data(self, inode):
+        return b"".join(self.iter_inode_data(inode))
+
+    def read_file(self, path):
+        inode = self.lookup(path)
+        if inode.is_symlink:
+            raise OSError(errno.ELOOP, "Not following symlink in image", path)
+        if not inode.is_file:
+            raise IsADirectoryError(errno.EISDIR, "Not a regular file", path)
+        return self.read_inode_data(inode)
+
+    def walk_inodes(self):
+        seen = set()
+        dirs = [self.root_inode]
+        while dirs:
+            for _, ref, itype, number in self.listdir(dirs.pop()):
+                if number in seen:
+                    continue
+                seen.add(number)
+                inode = self.inode(ref)
+                if inode.is_dir:
+                    dirs.append(inode)
+                yield inode
+
+    def walk_paths(self):
+        dirs = [("", self.root_inode)]
+        while dirs:
+            dir_path, dir_inode = dirs.pop()
+            for name, ref, _, _ in self.listdir(dir_inode):
+                path = "%s/%s" % (dir_path, name)
+                inode = self.inode(ref)
+                if inode.is_dir:
+                    dirs.append((path, inode))
+                yield path, inode
+
+    def data_extents(self):
+        """(offset, length) of every stored data and fragment block"""
+        size_mask = self.BLOCK_UNCOMPRESSED - 1
+        extents = set()
+        for inode in self.walk_inodes():
+            if not inode.is_file:
+                continue
+            pos = inode.blocks_start
+            for size_entry in inode.block_sizes:
+                size = size_entry & size_mask
+                if size:
+                    extents.add((pos, size))
+                pos += size
+        for index in range(self.superblock["fragment_count"]):
+            start, size = self.fragment_entry(index)
+            if size & size_mask:
+                extents.add((start, size & size_mask))
+        return sorted(extents)
+
+    def block_layout(self, max_extent):
+        """extents covering the whole file: data blocks as stored, everything
+        else (superblock, tables, padding) cut into pieces of max_extent"""
+        file_size = os.fstat(self.fobj.fileno()).st_size
+        ret = []
+        pos = 0
+        for start, length in self.data_extents() + [(file_size, 0)]:
+            if start < pos:
+                continue
+            while pos < start:
+                ret.append((pos, min(max_extent, start - pos)))
+                pos += ret[-1][1]
+            if length:
+                ret.append((start, length))
+                pos = start + length
+        return ret
+
+
+class SquashFSWriter(object):
+    """Writes a squashfs 4.0 image from a directory tree. With reuse set to
+    the previous generation of the image, data of unchanged regular files is
+    copied over still compressed instead of being compressed again."""
+
+    XATTR_PREFIXES = {"user.": 0, "trusted.": 1, "security.": 2}
+    NO_XATTR = 0xFFFFFFFF
+    INVALID_BLK = 0xFFFFFFFFFFFFFFFF
+    LZ4_LEGACY = 1
+
+    class MetadataWriter(object):
+        def __init__(self, writer):
+            self.writer = writer
+            self.blocks = []
+            self.compressed_size = 0
+            self.buf = bytearray()
+
+        def tell(self):
+            return self.compressed_size, len(self.buf)
+
+        def ref(self):
+            return (self.compressed_size << 16) | len(self.buf)
+
+        def _flush_block(self, data):
+            comp = self.writer.compress(data)
+            if len(comp) < len(data):
+                block = struct.pack("<H", len(comp)) + comp
+            else:
+                block = struct.pack(
+                    "<H", len(data) | SquashFSImage.METADATA_UNCOMPRESSED
+                ) + bytes(data)
+            self.blocks.append(block)
+            self.compressed_size += len(block)
+
+        def write(self, data):
+            self.buf += data
+            while len(self.buf) >= SquashFSImage.METADATA_SIZE:
+                self._flush_block(self.buf[: SquashFSImage.METADATA_SIZE])
+                del self.buf[: SquashFSImage.METADATA_SIZE]
+
+        def finish(self):
+            if self.buf:
+                self._flush_block(self.buf)
+                self.buf = bytearray()
+            return b"".join(self.blocks)
+
+    class Node(object):
+        def __init__(self, path, name, st):
+            self.path = path
+            self.name = name
+            self.st = st
+            self.children = []
+            self.xattrs = []
+            self.link_of = None
+            self.nlink = 1
+            self.ref = None
+
+    def __init__(
+        self,
+        out_path,
+        compression="gzip",
+        block_size=131072,
+        mkfs_time=None,
+        comp_options=None,
+        reuse=None,
+        upper_dir=None,
+    ):
+        self.out_path = out_path
+        if reuse is not None:
+            compression = reuse.compression
+            block_size = reuse.superblock["block_size"]
+            comp_options = reuse.compressor_options
+        self.compression = compression
+        self.block_size = block_size
+        self.mkfs_time = int(time.time()) if mkfs_time is None else mkfs_time
+        self.comp_options = comp_options
+        self.reuse = reuse
+        # files absent from the rw branch of an overlay over the previous
+        # image are known to be unchanged, no need to compare contents
+        self.upper_dir = upper_dir
+        self.ids = {}
+        self.xattr_ids = {}
+        self.fragments = []
+        self.frag_buf = bytearray()
+        self._reused_blocks = {}
+        self.stats = dict(reused=0, compressed=0)
+
+    GZIP_STRATEGIES = (
+        (1, zlib.Z_DEFAULT_STRATEGY),
+        (2, zlib.Z_FILTERED),
+        (4, zlib.Z_HUFFMAN_ONLY),
+        (8, zlib.Z_RLE),
+        (16, zlib.Z_FIXED),
+    )
+    XZ_BCJ_FILTERS = (
+        (1, lzma.FILTER_X86),
+        (2, lzma.FILTER_POWERPC),
+        (4, lzma.FILTER_IA64),
+        (8, lzma.FILTER_ARM),
+        (16, lzma.FILTER_ARMTHUMB),
+        (32, lzma.FILTER_SPARC),
+    )
+    LZ4_HC = 1
+
+    @cached_property
+    def comp_settings(self):
+        """the compressor options block unpacked, mksquashfs defaults for
+        what an image without one was made with"""
+        opts = b""
+        if self.comp_options is not None:
+            (hdr,) = struct.unpack_from("<H", self.comp_options)
+            if not hdr & SquashFSImage.METADATA_UNCOMPRESSED:
+                raise NotSFS("Compressed compressor options are not supported")
+            opts = self.comp_options[2:]
+        comp = self.compression
+        if comp == "gzip":
+            return struct.unpack("<iHH", opts) if opts else (9, 15, 0)
+        elif comp == "xz":
+            return struct.unpack("<ii", opts) if opts else (self.block_size, 0)
+        elif comp == "zstd":
+            return struct.unpack("<i", opts) if opts else (15,)
+        elif comp == "lz4":
+            return struct.unpack("<ii", opts) if opts else (self.LZ4_LEGACY, 0)
+        return ()
+
+    @staticmethod
+    def _smallest(compressors):
+        if len(compressors) == 1:
+            return compressors[0]
+        # like mksquashfs, try each selected variant and keep the smallest
+        return lambda d: min((c(d) for c in compressors), key=len)
+
+    @cached_property
+    def _compressor(self):
+        comp = self.compression
+        if comp == "gzip":
+            level, window, strategies = self.comp_settings
+
+            def gzip_compressor(strategy):
+                def compress(d):
+                    c = zlib.compressobj(level, zlib.DEFLATED, window, 8, strategy)
+                    return c.compress(d) + c.flush()
+
+                return compress
+
+            return self._smallest(
+                [
+                    gzip_compressor(strategy)
+                    for bit, strategy in self.GZIP_STRATEGIES
+                    if strategies & bit
+                ]
+                or [gzip_compressor(zlib.Z_DEFAULT_STRATEGY)]
+            )
+        elif comp == "xz":
+            dict_size, bcj_flags = self.comp_settings
+            lzma2 = dict(id=lzma.FILTER_LZMA2, preset=6, dict_size=dict_size)
+
+            def xz_compressor(filters):
+                return lambda d: lzma.compress(
+                    d, format=lzma.FORMAT_XZ, check=lzma.CHECK_CRC32, filters=filters
+                )
+
+            return self._smallest(
+                [xz_compressor([lzma2])]
+                + [
+                    xz_compressor([dict(id=bcj), lzma2])
+                    for bit, bcj in self.XZ_BCJ_FILTERS
+                    if bcj_flags & bit
+                ]
+            )
+        elif comp == "zstd" and zstandard is not None:
+            (level,) = self.comp_settings
+            return zstandard.ZstdCompressor(level=level).compress
+        elif comp == "lz4" and lz4 is not None:
+            version, flags = self.comp_settings
+            if not version == self.LZ4_LEGACY:
+                raise NotSFS("Unsupported lz4 format version %d" % (version,))
+            if flags & self.LZ4_HC:
+                return lambda d: lz4.block.compress(
+                    d, mode="high_compression", compression=9, store_size=False
+                )
+            return lambda d: lz4.block.compress(d, store_size=False)
+        raise CompressorUnavailable("No compressor available for %s" % (comp,))
+
+    def compress(self, data):
+        return self._compressor(bytes(data))
+
+    @cached_property
+    def reuse_index(self):
+        if self.reuse is None:
+            return {}
+        return dict((p, i) for p, i in self.reuse.walk_paths() if i.is_file)
+
+    def scan(self, src_dir):
+        root = self.Node(src_dir, "", os.lstat(src_dir))
+        todo = [root]
+        while todo:
+            node = todo.pop()
+            node.xattrs = self._read_xattrs(node.path)
+            if stat.S_ISDIR(node.st.st_mode):
+                for name in sorted(os.listdir(node.path), key=os.fsencode):
+                    path = os.path.join(node.path, name)
+                    child = self.Node(path, name, os.lstat(path))
+                    node.children.append(child)
+                    todo.append(child)
+        return root
+
+    def _read_xattrs(self, path):
+        try:
+            names = os.listxattr(path, follow_symlinks=False)
+        except OSError:
+            return []
+        ret = []
+        for name in sorted(names):
+            if name.split(".", 1)[0] + "." in self.XATTR_PREFIXES:
+                ret.append((name, os.getxattr(path, name, follow_symlinks=False)))
+        return ret
+
+    def _id_index(self, uid):
+        return self.ids.setdefault(uid, len(self.ids))
+
+    def _xattr_index(self, xattrs):
+        if not xattrs:
+            return self.NO_XATTR
+        return self.xattr_ids.setdefault(tuple(xattrs), len(self.xattr_ids))
+
+    def _number(self, root):
+        counter = itertools.count(1)
+        links = {}
+
+        def walk(node):
+            for child in node.children:
+                if stat.S_ISDIR(child.st.st_mode):
+                    walk(child)
+                    continue
+                key = (child.st.st_dev, child.st.st_ino)
+                if child.st.st_nlink > 1 and key in links:
+                    child.link_of = links[key]
+                    child.link_of.nlink += 1
+                    continue
+                links[key] = child
+                child.number = next(counter)
+            node.number = next(counter)
+
+        walk(root)
+        return root.number
+
+    def _add_fragment(self, data):
+        if len(self.frag_buf) + len(data) > self.block_size:
+            self._flush_fragment()
+        offset = len(self.frag_buf)
+        self.frag_buf += data
+        return len(self.fragments), offset
+
+    def _flush_fragment(self):
+        if not self.frag_buf:
+            return
+        self.fragments.append(self._write_data_block(self.frag_buf) + (0,))
+        self.frag_buf = bytearray()
+
+    def _write_data_block(self, data):
+        pos = self.out.tell()
+        comp = self.compress(data)
+        if len(comp) < len(data):
+            self.out.write(comp)
+            return pos, len(comp)
+        self.out.write(data)
+        return pos, len(data) | SquashFSImage.BLOCK_UNCOMPRESSED
+
+    def _same_content(self, old, path):
+        pos = old.blocks_start
+        left = old.file_size
+        with open(path, "rb") as src_f:
+            for size_entry in old.block_sizes:
+                data = self.reuse.read_block(pos, size_entry, self.block_size)
+                if src_f.read(self.block_size) != data[:left]:
+                    return False
+                left -= self.block_size
+                pos += size_entry & (SquashFSImage.BLOCK_UNCOMPRESSED - 1)
+            if left > 0:
+                return src_f.read(left) == self._old_fragment_tail(old)
+        return True
+
+    def _old_fragment_tail(self, old):
+        tail = old.file_size - len(old.block_sizes) * self.block_size
+        if old.fragment == SquashFSImage.NO_FRAGMENT or tail <= 0:
+            return b""
+        frag_start, frag_size = self.reuse.fragment_entry(old.fragment)
+        frag = self.reuse.read_block(frag_start, frag_size, self.block_size)
+        return frag[old.frag_offset : old.frag_offset + tail]
+
+    def _reuse_inode(self, node, rel_path):
+        old = self.reuse_index.get(rel_path)
+        if old is None or old.file_size != node.st.st_size:
+            return None
+        if self.upper_dir is not None:
+            if os.path.lexists(self.upper_dir + rel_path):
+                return None
+        elif old.mtime != int(node.st.st_mtime) & 0xFFFFFFFF:
+            return None
+        elif not self._same_content(old, node.path):
+            return None
+        return old
+
+    def _copy_blocks(self, old):
+        key = (old.blocks_start, tuple(old.block_sizes))
+        if key in self._reused_blocks:
+            return self._reused_blocks[key]
+        start = self._reused_blocks[key] = self.out.tell()
+        length = sum(
+            s & (SquashFSImage.BLOCK_UNCOMPRESSED - 1) for s in old.block_sizes
+        )
+        pos = old.blocks_start
+        while length > 0:
+            chunk = self.reuse.pread(min(length, 1 << 20), pos)
+            self.out.write(chunk)
+            pos += len(chunk)
+            length -= len(chunk)
+        return start
+
+    def _write_file_data(self, node, rel_path):
+        node.fragment, node.frag_offset = SquashFSImage.NO_FRAGMENT, 0
+        old = self._reuse_inode(node, rel_path)
+        if old is not None:
+            self.stats["reused"] += 1
+            node.blocks_start = self._copy_blocks(old)
+            node.block_sizes = list(old.block_sizes)
+            tail = self._old_fragment_tail(old)
+            if tail:
+                node.fragment, node.frag_offset = self._add_fragment(tail)
+            return
+        self.stats["compressed"] += 1
+        node.blocks_start = self.out.tell()
+        node.block_sizes = []
+        with open(node.path, "rb") as src_f:
+            while True:
+                data = src_f.read(self.block_size)
+                if not data:
+                    break
+                if len(data) < self.block_size:
+                    node.fragment, node.frag_offset = self._add_fragment(data)
+                    break
+                if data.count(0) == len(data):
+                    node.block_sizes.append(0)
+                else:
+                    node.block_sizes.append(self._write_data_block(data)[1])
+
+    def _write_all_data(self, node, src_dir):
+        for child in node.children:
+            if stat.S_ISDIR(child.st.st_mode):
+                self._write_all_data(child, src_dir)
+            elif stat.S_ISREG(child.st.st_mode) and child.link_of is None:
+                self._write_file_data(child, "/" + os.path.relpath(child.path, src_dir))
+
+    def _inode_header(self, node, itype):
+        st = node.st
+        return struct.pack(
+            SquashFSImage.INODE_HEADER_FMT,
+            itype,
+            stat.S_IMODE(st.st_mode),
+            self._id_index(st.st_uid),
+            self._id_index(st.st_gid),
+            int(st.st_mtime) & 0xFFFFFFFF,
+            node.number,
+        )
+
+    def _write_inode(self, node, inodes):
+        st = node.st
+        mode = st.st_mode
+        xattr = self._xattr_index(node.xattrs)
+        # the extended inode types are the basic ones + 7
+        ext = 0 if xattr == self.NO_XATTR else 7
+        node.ref = inodes.ref()
+        if stat.S_ISREG(mode):
+            node.basic_type = SquashFSImage.INODE_FILE
+            blocks = struct.pack("<%dI" % len(node.block_sizes), *node.block_sizes)
+            if (
+                node.nlink == 1
+                and not ext
+                and node.blocks_start < 1 << 32
+                and st.st_size < 1 << 32
+            ):
+                data = struct.pack(
+                    "<IIII",
+                    node.blocks_start,
+                    node.fragment,
+                    node.frag_offset,
+                    st.st_size,
+                )
+            else:
+                ext = 7
+                data = struct.pack(
+                    "<QQQIIII",
+                    node.blocks_start,
+                    st.st_size,
+                    0,
+                    node.nlink,
+                    node.fragment,
+                    node.frag_offset,
+                    xattr,
+                )
+            data += blocks
+        elif stat.S_ISLNK(mode):
+            node.basic_type = SquashFSImage.INODE_SYMLINK
+            target = os.fsencode(os.readlink(node.path))
+            data = struct.pack("<II", node.nlink, len(target)) + target
+            if ext:
+                data += struct.pack("<I", xattr)
+        elif stat.S_ISBLK(mode) or stat.S_ISCHR(mode):
+            if stat.S_ISBLK(mode):
+                node.basic_type = SquashFSImage.INODE_BLKDEV
+            else:
+                node.basic_type = SquashFSImage.INODE_CHRDEV
+            major, minor = os.major(st.st_rdev), os.minor(st.st_rdev)
+            rdev = (minor & 0xFF) | (major << 8) | ((minor & ~0xFF) << 12)
+            data = struct.pack("<II", node.nlink, rdev)
+            if ext:
+                data += struct.pack("<I", xattr)
+        elif stat.S_ISFIFO(mode) or stat.S_ISSOCK(mode):
+            if stat.S_ISFIFO(mode):
+                node.basic_type = SquashFSImage.INODE_FIFO
+            else:
+                node.basic_type = SquashFSImage.INODE_SOCKET
+            data = struct.pack("<I", node.nlink)
+            if ext:
+                data += struct.pack("<I", xattr)
+        else:
+            raise ValueError("Unsupported file type", node.path)
+        inodes.write(self._inode_header(node, node.basic_type + ext) + data)
+
+    def _write_dir(self, node, inodes, dirs, parent_number):
+        subdirs = 0
+        for child in node.children:
+            if stat.S_ISDIR(child.st.st_mode):
+                self._write_dir(child, inodes, dirs, node.number)
+                subdirs += 1
+                continue
+            target = child.link_of or child
+            if target.ref is None:
+                self._write_inode(target, inodes)
+        start_block, offset = dirs.tell()
+        listing = bytearray()
+        hdr_at, count, base_start, base_number = None, 0, None, None
+        for child in node.children:
+            target = child.link_of or child
+            c_start, c_offset = target.ref >> 16, target.ref & 0xFFFF
+            if (
+                hdr_at is None
+                or count == 256
+                or c_start != base_start
+                or abs(target.number - base_number) > 32767
+            ):
+                if hdr_at is not None:
+                    struct.pack_into("<I", listing, hdr_at, count - 1)
+                hdr_at, count = len(listing), 0
+                base_start, base_number = c_start, target.number
+                listing += struct.pack(
+                    SquashFSImage.DIR_HEADER_FMT, 0, c_start, base_number
+                )
+            name = os.fsencode(child.name)
+            listing += struct.pack(
+                SquashFSImage.DIR_ENTRY_FMT,
+                c_offset,
+                target.number - base_number,
+                target.basic_type,
+                len(name) - 1,
+            )
+            listing += name
+            count += 1
+        if hdr_at is not None:
+            struct.pack_into("<I", listing, hdr_at, count - 1)
+        dirs.write(listing)
+        file_size = len(listing) + 3
+        xattr = self._xattr_index(node.xattrs)
+        node.ref = inodes.ref()
+        node.basic_type = SquashFSImage.INODE_DIR
+        if file_size < 1 << 16 and xattr == self.NO_XATTR:
+            data = self._inode_header(node, SquashFSImage.INODE_DIR) + struct.pack(
+                "<IIHHI", start_block, subdirs + 2, file_size, offset, parent_number
+            )
+        else:
+            data = self._inode_header(node, SquashFSImage.INODE_LDIR) + struct.pack(
+                "<IIIIHHI",
+                subdirs + 2,
+                file_size,
+                start_block,
+                parent_number,
+                0,
+                offset,
+                xattr,
+            )
+        inodes.write(data)
+
+    def _write_table(self, data):
+        """write data as metadata blocks followed by the block pointers,
+        returns the position of the pointers"""
+        md = self.MetadataWriter(self)
+        ptrs = []
+        base = self.out.tell()
+        for i in range(0, len(data), SquashFSImage.METADATA_SIZE):
+            ptrs.append(base + md.compressed_size)
+            md.write(data[i : i + SquashFSImage.METADATA_SIZE])
+        self.out.write(md.finish())
+        start = self.out.tell()
+        self.out.write(struct.pack("<%dQ" % len(ptrs), *ptrs))
+        return start
+
+    def _write_xattrs(self):
+        if not self.xattr_ids:
+            return self.INVALID_BLK
+        kv = self.MetadataWriter(self)
+        ids = bytearray()
+        for xattrs in sorted(self.xattr_ids, key=self.xattr_ids.get):
+            ref = kv.ref()
+            size = 0
+            for name, value in xattrs:
+                prefix, short = name.split(".", 1)
+                short = os.fsencode(short)
+                kv.write(
+                    struct.pack("<HH", self.XATTR_PREFIXES[prefix + "."], len(short))
+                    + short
+                    + struct.pack("<I", len(value))
+                    + value
+                )
+                size += len(os.fsencode(name)) + 1 + len(value)
+            ids += struct.pack("<QII", ref, len(xattrs), size)
+        kv_start = self.out.tell()
+        self.out.write(kv.finish())
+        md = self.MetadataWriter(self)
+        ptrs = []
+        base = self.out.tell()
+        for i in range(0, len(ids), SquashFSImage.METADATA_SIZE):
+            ptrs.append(base + md.compressed_size)
+            md.write(ids[i : i + SquashFSImage.METADATA_SIZE])
+        self.out.write(md.finish())
+        start = self.out.tell()
+        self.out.write(struct.pack("<QII", kv_start, len(self.xattr_ids), 0))
+        self.out.write(struct.pack("<%dQ" % len(ptrs), *ptrs))
+        return start
+
+    def write(self, src_dir):
+        self._compressor  # raises CompressorUnavailable before anything is written
+        root = self.scan(src_dir)
+        inode_count = self._number(root)
+        comp_options = self.comp_options
+        if comp_options is None and self.compression == "lz4":
+            # the kernel refuses lz4 images without the options block
+            comp_options = struct.pack(
+                "<HII", 8 | SquashFSImage.METADATA_UNCOMPRESSED, self.LZ4_LEGACY, 0
+            )
+        flags = 0
+        with open(self.out_path, "wb") as self.out:
+            self.out.write(b"\0" * SquashFSImage.SUPERBLOCK_SIZE)
+            if comp_options is not None:
+                self.out.write(comp_options)
+                flags |= SquashFSImage.FLAG_COMPRESSOR_OPTIONS
+            self._write_all_data(root, src_dir)
+            self._flush_fragment()
+            inodes = self.MetadataWriter(self)
+            dirs = self.MetadataWriter(self)
+            self._write_dir(root, inodes, dirs, inode_count + 1)
+            inode_table_start = self.out.tell()
+            self.out.write(inodes.finish())
+            directory_table_start = self.out.tell()
+            self.out.write(dirs.finish())
+            fragment_table_start = self._write_table(
+                b"".join(
+                    struct.pack(SquashFSImage.FRAGMENT_ENTRY_FMT, *f)
+                    for f in self.fragments
+                )
+            )
+            ids = sorted(self.ids, key=self.ids.get)
+            id_table_start = self._write_table(struct.pack("<%dI" % len(ids), *ids))
+            xattr_id_table_start = self._write_xattrs()
+            if xattr_id_table_start == self.INVALID_BLK:
+                flags |= SquashFSImage.FLAG_NO_XATTRS
+            bytes_used = self.out.tell()
+            self.out.write(b"\0" * (-bytes_used % 4096))
+            comp_id = dict((v, k) for k, v in SquashFSImage.COMPRESSORS.items())
+            self.out.seek(0)
+            self.out.write(
+                struct.pack(
+                    SquashFSImage.SUPERBLOCK_FMT,
+                    struct.unpack("<I", SquashFSImage.MAGIC)[0],
+                    inode_count,
+                    self.mkfs_time,
+                    self.block_size,
+                    len(self.fragments),
+                    comp_id[self.compression],
+                    self.block_size.bit_length() - 1,
+                    flags,
+                    len(ids),
+                    4,
+                    0,
+                    root.ref,
+                    bytes_used,
+                    id_table_start,
+                    xattr_id_table_start,
+                    inode_table_start,
+                    directory_table_start,
+                    fragment_table_start,
+                    self.INVALID_BLK,
+                )
+            )
+        return self.stats
+
+
+class SFSMetaIndex(object):
+    index_path = os.path.join(lbu_cache_dir, "sfs-meta.json")
+    max_file_size = int(os.environ.get("SFS_META_MAX_FILE", "65536"))
+    max_entries = int(os.environ.get("SFS_META_MAX_ENTRIES", "4096"))
+
+    def __init__(self, index_path=None):
+        if index_path is not None:
+            self.index_path = index_path
+        self.lock = threading.RLock()
+        self.dirty = False
+        self._save_registered = False
+
+    @cached_property
+    def entries(self):
+        try:
+            with open(self.index_path) as index_f:
+                return json.load(index_f)
+        except (IOError, ValueError) as e:
+            if not getattr(e, "errno", None) == errno.ENOENT:
+                debug("Ignoring unreadable SFS index %r: %s", self.index_path, e)
+            return {}
+
+    @staticmethod
+    def stat_key(st):
+        return "%d:%d:%d:%d" % (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def _mark_dirty(self):
+        self.dirty = True
+        if not self._save_registered:
+            self._save_registered = True
+            atexit.register(self.save)
+
+    def entry(self, path):
+        st = os.stat(path)
+        key = self.stat_key(st)
+        with self.lock:
+            ret = self.entries.get(key)
+            if ret is None or "superblock" not in ret:
+                with SquashFSImage(path) as img:
+                    superblock = img.superblock
+                ret = self.entries.setdefault(key, {})
+                ret.update(superblock=superblock, files={})
+                self._mark_dirty()
+            ret["used"] = int(time.time())
+        return ret
+
+    def cached_digest(self, st, algo):
+        with self.lock:
+            ent = self.entries.get(self.stat_key(st))
+            if ent is not None:
+                return ent.get("digests", {}).get(algo)
+
+    def store_digest(self, st, algo, digest):
+        with self.lock:
+            ent = self.entries.setdefault(self.stat_key(st), {})
+            ent.setdefault("digests", {})[algo] = digest
+            ent["used"] = int(time.time())
+            self._mark_dirty()
+
+    def header(self, path):
+        return self.entry(path)["superblock"]
+
+    def read_file(self, path, inner_path):
+        ent = self.entry(path)
+        inner_path = "/" + inner_path.lstrip("/")
+        with self.lock:
+            if inner_path in ent["files"]:
+                data = ent["files"][inner_path]
+                if data is None:
+                    raise FileNotFoundError(errno.ENOENT, "No such file", inner_path)
+                return data
+        with SquashFSImage(path) as img:
+            try:
+                data = img.read_file(inner_path).decode("utf8", "surrogateescape")
+            except FileNotFoundError:
+                data = None
+        with self.lock:
+            if data is None or len(data) <= self.max_file_size:
+                ent["files"][inner_path] = data
+                self._mark_dirty()
+        if data is None:
+            raise FileNotFoundError(errno.ENOENT, "No such file", inner_path)
+        return data
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            entries = dict(self.entries)
+            del self.entries
+            entries = dict(self.entries, **entries)
+            if len(entries) > self.max_entries:
+                for key in sorted(entries, key=lambda k: entries[k].get("used", 0))[
+                    : len(entries) - self.max_entries
+                ]:
+                    del entries[key]
+            tmp_path = "%s.%d.tmp" % (self.index_path, os.getpid())
+            try:
+                FSPath(self.index_path).parent_directory.makedirs()
+                with open(tmp_path, "w") as tmp_f:
+                    json.dump(entries, tmp_f)
+                os.rename(tmp_path, self.index_path)
+            except (IOError, OSError) as e:
+                warning("Cannot save SFS index %r: %s", self.index_path, e)
+            else:
+                self.dirty = False
+            self.entries = entries
+
+
+sfs_meta_index = SFSMetaIndex()
+
+
+class SFSBlockMap(object):
+    """per-block digests of an image, published as <image>.blocks so that
+    clients can assemble a new version from local images and fetch only the
+    blocks they lack"""
+
+    suffix = ".blocks"
+    version = 1
+    max_extent = 0x100000
+    cache_dir = os.path.join(lbu_cache_dir, "blocks")
+    cache_max = int(os.environ.get("SFS_BLOCKS_CACHE_MAX", "64"))
+
+    def __init__(self, size, sha256, mkfs_time, extents):
+        self.size = size
+        self.sha256 = sha256
+        self.mkfs_time = mkfs_time
+        self.extents = extents
+
+    @staticmethod
+    def digest(data):
+        return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+    @classmethod
+    def from_image(cls, path):
+        checksum = hashlib.sha256()
+        extents = []
+        with SquashFSImage(path) as img:
+            for offset, length in img.block_layout(cls.max_extent):
+                data = img.pread(length, offset)
+                checksum.update(data)
+                extents.append((offset, length, cls.digest(data)))
+            size = os.fstat(img.fobj.fileno()).st_size
+            mkfs_time = img.superblock["mkfs_time"]
+        return cls(size, checksum.hexdigest(), mkfs_time, extents)
+
+    def dumps(self):
+        return zlib.compress(
+            json.dumps(
+                dict(
+                    version=self.version,
+                    size=self.size,
+                    sha256=self.sha256,
+                    mkfs_time=self.mkfs_time,
+                    extents=self.extents,
+                )
+            ).encode("utf8")
+        )
+
+    @classmethod
+    def loads(cls, data):
+        d = json.loads(zlib.decompress(data).decode("utf8"))
+        if not d.get("version") == cls.version:
+            raise ValueError("Unsupported block map version: %r" % (d.get("version"),))
+        return cls(
+            d["size"], d["sha256"], d["mkfs_time"], [tuple(e) for e in d["extents"]]
+        )
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as f:
+            return cls.loads(f.read())
+
+    def save(self, path):
+        path_tmp = "%s.%d.tmp" % (path, os.getpid())
+        with open(path_tmp, "wb") as f:
+            f.write(self.dumps())
+        os.rename(path_tmp, path)
+
+    @classmethod
+    def fetch(cls, url):
+        try:
+            with http_pool.request("GET", url + cls.suffix) as resp:
+                return cls.loads(resp.read())
+        except urllib.error.HTTPError as e:
+            if e.code == 404:
+                return
+            raise
+
+    @classmethod
+    def _prune_cache(cls):
+        try:
+            entries = [
+                os.path.join(cls.cache_dir, n)
+                for n in os.listdir(cls.cache_dir)
+                if n.endswith(cls.suffix)
+            ]
+            entries.sort(key=lambda p: os.stat(p).st_mtime, reverse=True)
+            for old_entry in entries[cls.cache_max :]:
+                os.unlink(old_entry)
+        except OSError as e:
+            debug("Could not prune block map cache: %s", e)
+
+    @classmethod
+    def for_local(cls, path, compute=True):
+        """the published or cached block map of path, generated and cached
+        when missing unless compute is false"""
+        st = os.stat(path)
+        try:
+            bmap = cls.load(path + cls.suffix)
+        except (IOError, ValueError, zlib.error):
+            pass
+        else:
+            if bmap.size == st.st_size and bmap.mkfs_time == sfs_stamp_file(path):
+                return bmap
+        cache_path = os.path.join(
+            cls.cache_dir,
+            hashlib.md5(SFSMetaIndex.stat_key(st).encode("utf8")).hexdigest()
+            + cls.suffix,
+        )
+        try:
+            bmap = cls.load(cache_path)
+        except (IOError, ValueError, zlib.error):
+            pass
+        else:
+            # entries are pruned by mtime, keep the used ones
+            try:
+                os.utime(cache_path)
+            except OSError:
+                pass
+            return bmap
+        if not compute:
+            return
+        bmap = cls.from_image(path)
+        try:
+            if not os.path.exists(cls.cache_dir):
+                os.makedirs(cls.cache_dir, 0o755)
+            bmap.save(cache_path)
+        except OSError as e:
+            debug("Could not cache block map of %s: %s", path, e)
+        else:
+            cls._prune_cache()
+        return bmap
+
+
+class SFSManifest(object):
+    """(path, mode, size, mtime, digest) of every entry of an image, sorted by
+    path. make_sfs stores it in the image and next to it as <image>.manifest,
+    so that two images can be compared without reading their contents"""
+
+    suffix = ".manifest"
+    magic = b"LBUM"
+    version = 1
+    HEADER_FMT = "<4sHII"
+    ENTRY_FMT = "<HIQI"
+    FIELDS = ("mode", "size", "mtime", "digest")
+    hash_jobs = int(os.environ.get("SFS_MANIFEST_JOBS", "4"))
+    no_digest = b"\0" * 16
+
+    TYPE_MODES = {
+        SquashFSImage.INODE_DIR: stat.S_IFDIR,
+        SquashFSImage.INODE_FILE: stat.S_IFREG,
+        SquashFSImage.INODE_SYMLINK: stat.S_IFLNK,
+        SquashFSImage.INODE_BLKDEV: stat.S_IFBLK,
+        SquashFSImage.INODE_CHRDEV: stat.S_IFCHR,
+        SquashFSImage.INODE_FIFO: stat.S_IFIFO,
+        SquashFSImage.INODE_SOCKET: stat.S_IFSOCK,
+    }
+
+    def __init__(self, entries, mkfs_time=0):
+        self.entries = entries
+        self.mkfs_time = mkfs_time
+
+    @staticmethod
+    def digest(data):
+        return hashlib.blake2b(data, digest_size=16).digest()
+
+    @staticmethod
+    def file_digest(path):
+        return bytes.fromhex(_file_digest(path, "blake2b", digest_size=16))
+
+    @staticmethod
+    def excluded(rel_path, patterns):
+        """mksquashfs -wildcards semantics: patterns are anchored at the top
+        unless prefixed with "... ", excluding a directory excludes its
+        contents"""
+        parts = rel_path.split("/")
+        for pattern in patterns:
+            anchored = not pattern.startswith("... ")
+            pat_parts = pattern[0 if anchored else 4 :].strip("/").split("/")
+            for start in range(1 if anchored else len(parts)):
+                if len(parts) - start >= len(pat_parts) and all(
+                    fnmatch.fnmatchcase(p, pp)
+                    for p, pp in zip(parts[start:], pat_parts)
+                ):
+                    return True
+        return False
+
+    @classmethod
+    def from_dir(cls, top, exclude=()):
+        skip = SFSBuilder.MANIFEST_PATH.lstrip("/")
+        entries = []
+        files = []
+        todo = [""]
+        while todo:
+            rel_dir = todo.pop()
+            for dir_ent in os.scandir(os.path.join(top, rel_dir)):
+                rel_path = os.path.join(rel_dir, dir_ent.name)
+                if rel_path == skip or (exclude and cls.excluded(rel_path, exclude)):
+                    continue
+                st = dir_ent.stat(follow_symlinks=False)
+                size, digest = st.st_size, cls.no_digest
+                if stat.S_ISDIR(st.st_mode):
+                    size = 0
+                    todo.append(rel_path)
+                elif stat.S_ISREG(st.st_mode):
+                    files.append((len(entries), dir_ent.path))
+                elif stat.S_ISLNK(st.st_mode):
+                    digest = cls.digest(os.fsencode(os.readlink(dir_ent.path)))
+                elif stat.S_ISBLK(st.st_mode) or stat.S_ISCHR(st.st_mode):
+                    size = st.st_rdev
+                else:
+                    size = 0
+                entries.append(
+                    [
+                        os.fsencode("/" + rel_path),
+                        st.st_mode,
+                        size,
+                        int(st.st_mtime) & 0xFFFFFFFF,
+                        digest,
+                    ]
+                )
+        with concurrent.futures.ThreadPoolExecutor(cls.hash_jobs) as pool:
+            digests = pool.map(cls.file_digest, [f[1] for f in files])
+            for (idx, _), digest in zip(files, digests):
+                entries[idx][4] = digest
+        return cls(sorted(tuple(e) for e in entries))
+
+    @classmethod
+    def from_image(cls, path):
+        skip = SFSBuilder.MANIFEST_PATH
+        entries = []
+        with SquashFSImage(path) as img:
+            for rel_path, inode in img.walk_paths():
+                if rel_path == skip:
+                    continue
+                basic_type = (inode.type - 1) % 7 + 1
+                mode = cls.TYPE_MODES[basic_type] | inode.mode
+                size, digest = 0, cls.no_digest
+                if inode.is_file:
+                    size = inode.file_size
+                    checksum = hashlib.blake2b(digest_size=16)
+                    for data in img.iter_inode_data(inode):
+                        checksum.update(data)
+                    digest = checksum.digest()
+                elif inode.is_symlink:
+                    target = os.fsencode(inode.target)
+                    size, digest = len(target), cls.digest(target)
+                elif basic_type in (img.INODE_BLKDEV, img.INODE_CHRDEV):
+                    major = (inode.rdev >> 8) & 0xFFF
+                    minor = (inode.rdev & 0xFF) | ((inode.rdev >> 12) & 0xFFF00)
+                    size = os.makedev(major, minor)
+                entries.append((os.fsencode(rel_path), mode, size, inode.mtime, digest))
+            mkfs_time = img.superblock["mkfs_time"]
+        return cls(sorted(entries), mkfs_time)
+
+    @classmethod
+    def for_image(cls, path, compute=True):
+        try:
+            manifest = cls.load(path + cls.suffix)
+        except (IOError, ValueError, zlib.error):
+            pass
+        else:
+            if manifest.mkfs_time == sfs_stamp_file(path):
+                return manifest
+        try:
+            with SquashFSImage(path) as img:
+                return cls.loads(img.read_file(SFSBuilder.MANIFEST_PATH))
+        except (OSError, ValueError, zlib.error) as e:
+            debug("No stored manifest in %s: %s", path, e)
+        if compute:
+            info("Generating manifest of %s", path)
+            return cls.from_image(path)
+
+    @classmethod
+    def for_path(cls, path):
+        if os.path.isdir(path):
+            return cls.from_dir(path)
+        return cls.for_image(path)
+
+    def dumps(self):
+        body = []
+        for path, mode, size, mtime, digest in self.entries:
+            body.append(struct.pack(self.ENTRY_FMT, len(path), mode, size, mtime))
+            body.append(path)
+            body.append(digest)
+        return struct.pack(
+            self.HEADER_FMT, self.magic, self.version, self.mkfs_time, len(self.entries)
+        ) + zlib.compress(b"".join(body))
+
+    @classmethod
+    def loads(cls, data):
+        hdr_size = struct.calcsize(cls.HEADER_FMT)
+        magic, version, mkfs_time, count = struct.unpack(
+            cls.HEADER_FMT, data[:hdr_size]
+        )
+        if not magic == cls.magic:
+            raise ValueError("Not a SFS manifest")
+        if not version == cls.version:
+            raise ValueError("Unsupported manifest version: %r" % (version,))
+        body = zlib.decompress(data[hdr_size:])
+        ent_size = struct.calcsize(cls.ENTRY_FMT)
+        entries = []
+        pos = 0
+        for _ in range(count):
+            path_len, mode, size, mtime = struct.unpack_from(cls.ENTRY_FMT, body, pos)
+            pos += ent_size
+            path = body[pos : pos + path_len]
+            pos += path_len
+            entries.append((path, mode, size, mtime, body[pos : pos + 16]))
+            pos += 16
+        return cls(entries, mkfs_time)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as f:
+            return cls.loads(f.read())
+
+    def save(self, path):
+        path_tmp = "%s.%d.tmp" % (path, os.getpid())
+        with open(path_tmp, "wb") as f:
+            f.write(self.dumps())
+        os.rename(path_tmp, path)
+
+    def diff(self, other, ignore=()):
+        """merge both sorted entry lists, yields ("-", path, None) for entries
+        only in self, ("+", path, None) for entries only in other and
+        ("~", path, fields) for entries that differ"""
+        fields = [
+            (idx + 1, name)
+            for idx, name in enumerate(self.FIELDS)
+            if name not in ignore
+        ]
+        old, new = self.entries, other.entries
+        i = j = 0
+        while i < len(old) or j < len(new):
+            if j >= len(new) or (i < len(old) and old[i][0] < new[j][0]):
+                yield "-", old[i][0].decode("utf8", "surrogateescape"), None
+                i += 1
+            elif i >= len(old) or new[j][0] < old[i][0]:
+                yield "+", new[j][0].decode("utf8", "surrogateescape"), None
+                j += 1
+            else:
+                changed = [
+                    name
+                    for idx, name in fields
+                    if not old[i][idx] == new[j][idx]
+                    # directory mtimes change with every rebuild
+                    and not (name == "mtime" and stat.S_ISDIR(new[j][1]))
+                ]
+                if changed:
+                    yield "~", new[j][0].decode("utf8", "surrogateescape"), changed
+                i += 1
+                j += 1
+
+
+class _CopyPipeline(object):
+    """reader -> hasher -> writer, each stage on its own thread with bounded
+    queues in between, so a slow disk flush does not stall the source"""
+
+    read_size = int(os.environ.get("SFS_PIPELINE_CHUNK", "0x100000"), 0)
+    depth = int(os.environ.get("SFS_PIPELINE_DEPTH", "8"))
+    poll_interval = 0.5
+
+    SYNC_FILE_RANGE_WAIT_BEFORE = 1
+    SYNC_FILE_RANGE_WRITE = 2
+    SYNC_FILE_RANGE_WAIT_AFTER = 4
+
+    def __init__(self, src_fobj, dst_fd, checksum, fsync_size=0, progress_cb=None):
+        self.src_fobj = src_fobj
+        self.dst_fd = dst_fd
+        self.checksum = checksum
+        # pipes (uploads) and devices have no page cache range to flush
+        if not stat.S_ISREG(os.fstat(dst_fd).st_mode):
+            fsync_size = 0
+        self.fsync_size = fsync_size
+        self.progress_cb = progress_cb
+        self.hash_q = queue.Queue(self.depth)
+        self.write_q = queue.Queue(self.depth)
+        self.aborted = threading.Event()
+        self.errors = []
+        self.head = None
+        self.stats = dict(
+            bytes=0,
+            seconds=0.0,
+            read_wait=0.0,
+            hash_wait=0.0,
+            write_wait=0.0,
+        )
+
+    def _fail(self, e):
+        self.errors.append(e)
+        self.aborted.set()
+
+    def _put(self, q, item, stage):
+        start = time.monotonic()
+        while True:
+            if self.aborted.is_set():
+                raise self.errors[0]
+            try:
+                q.put(item, timeout=self.poll_interval)
+                break
+            except queue.Full:
+                pass
+        self.stats[stage + "_wait"] += time.monotonic() - start
+
+    def _get(self, q, stage):
+        start = time.monotonic()
+        while True:
+            if self.aborted.is_set():
+                raise self.errors[0]
+            try:
+                item = q.get(timeout=self.poll_interval)
+                break
+            except queue.Empty:
+                pass
+        self.stats[stage + "_wait"] += time.monotonic() - start
+        return item
+
+    def _hash_stage(self):
+        try:
+            while True:
+                data = self._get(self.hash_q, "hash")
+                if data is not None:
+                    self.checksum.update(data)
+                self._put(self.write_q, data, "hash")
+                if data is None:
+                    break
+        except BaseException as e:
+            self._fail(e)
+
+    def _sync_range(self, start, length, flags):
+        if libc.sync_file_range(self.dst_fd, start, length, flags) < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, "sync_file_range: %s" % (os.strerror(err),))
+
+    def _writeback(self, start, length, prev_start, prev_length):
+        if libc is not None:
+            # start writeback of the new window, wait for the previous one
+            # only, which bounds dirty pages without a full fsync stall
+            try:
+                self._sync_range(start, length, self.SYNC_FILE_RANGE_WRITE)
+                if prev_length:
+                    self._sync_range(
+                        prev_start,
+                        prev_length,
+                        self.SYNC_FILE_RANGE_WAIT_BEFORE
+                        | self.SYNC_FILE_RANGE_WRITE
+                        | self.SYNC_FILE_RANGE_WAIT_AFTER,
+                    )
+                return
+            except OSError as e:
+                debug("Falling back to fsync: %s", e)
+        try:
+            os.fsync(self.dst_fd)
+        except OSError:
+            pass
+
+    def _write_stage(self):
+        try:
+            pos = synced = prev_synced = 0
+            while True:
+                data = self._get(self.write_q, "write")
+                if data is None:
+                    break
+                view = memoryview(data)
+                while view:
+                    view = view[os.write(self.dst_fd, view) :]
+                pos += len(data)
+                if self.fsync_size > 0 and pos - synced >= self.fsync_size:
+                    self._writeback(
+                        synced, pos - synced, prev_synced, synced - prev_synced
+                    )
+                    prev_synced, synced = synced, pos
+            if self.fsync_size > 0 and pos > 0:
+                try:
+                    os.fsync(self.dst_fd)
+                except OSError:
+                    pass
+        except BaseException as e:
+            self._fail(e)
+
+    def run(self):
+        start = time.monotonic()
+        stages = [
+            threading.Thread(target=self._hash_stage, daemon=True),
+            threading.Thread(target=self._write_stage, daemon=True),
+        ]
+        for stage in stages:
+            stage.start()
+        try:
+            if self.progress_cb:
+                self.progress_cb(0)
+            while True:
+                data = self.src_fobj.read(self.read_size)
+                if self.head is None:
+                    self.head = data
+                self._put(self.hash_q, data or None, "read")
+                if not data:
+                    break
+                self.stats["bytes"] += len(data)
+                if self.progress_cb:
+                    self.progress_cb(self.stats["bytes"])
+        except BaseException as e:
+            self._fail(e)
+        for stage in stages:
+            stage.join()
+        if self.errors:
+            raise self.errors[0]
+        self.stats["seconds"] = time.monotonic() - start
+        if self.progress_cb:
+            self.progress_cb(None)
+            if hasattr(self.progress_cb, "report_stats"):
+                self.progress_cb.report_stats(self.stats)
+        return self.stats
+
+
+def _remount_rw_prompt(mnt):
+    yesno = input(f"Try again with temporarily remounting {mnt} read-write? [Y/n] ")
+    if yesno == "" or yesno.lower().startswith("y"):
+        run_command(["mount", "-o", "remount,rw", mnt.path], as_user="root")
+        return True
+    return False
+
+
 class SFSFile(FSPath):
     UPTDCHECK_PATH = os.path.join(SFSBuilder.SFS_SRC_D, ".check-up-to-date")
     GET_LATEST_STAMP_PATH = os.path.join(SFSBuilder.SFS_SRC_D, ".get-latest-stamp")
@@ -2062,55 +5263,88 @@ class SFSFile(FSPath):
 
     progress_cb = None
     chunk_size = 8192
+    copy_extent = int(os.environ.get("SFS_COPY_EXTENT", "0x4000000"), 0)
+    delta_updates = not os.environ.get("SFS_DELTA", "1") == "0"
+    delta_range_max = int(os.environ.get("SFS_DELTA_RANGE_MAX", "0x800000"), 0)
     fsync_size = int(os.environ.get("SFS_FSYNC_SIZE", "0x1000000"), 0)
     auto_unmount = False
     checksum_algo = hashlib.sha256
     checksum_file = None
 
     class SFSBasename(str):
+        # [NN-]<stem>.sfs[.OLD][.<stamp>], parsed once per basename
+        name_re = re.compile(
+            r"(?s)(?P<name>(?:(?P<prio>[0-9][0-9])-)?(?P<stem>.*?))"
+            r"(?:\.sfs(?:(?P<old>\.OLD)?\.(?P<stamp>[0-9]+))?(?:(?!\.sfs).)*)?$"
+        )
+        Fields = collections.namedtuple("Fields", "prio stem name stamp old")
+
+        def __new__(cls, value):
+            if isinstance(value, cls):
+                return value
+            self = super(SFSFile.SFSBasename, cls).__new__(cls, value)
+            m = cls.name_re.match(self)
+            prio, stamp = m.group("prio"), m.group("stamp")
+            self.fields = cls.Fields(
+                None if prio is None else int(prio),
+                m.group("stem"),
+                m.group("name"),
+                None if stamp is None else int(stamp),
+                m.group("old") is not None,
+            )
+            return self
+
         def strip_down(self):
-            ret = self[3:] if fnmatch.fnmatch(self, "[0-9][0-9]-*") else self[:]
-            try:
-                ret = ret[: ret.rindex(".sfs")]
-            except ValueError:
-                pass
-            return ret
+            return self.fields.stem
 
         def prio(self):
-            if fnmatch.fnmatch(self, "[0-9][0-9]-*"):
-                return int(self[:2])
-            else:
-                return None
+            return self.fields.prio
 
         @repr_wrap(as_str=True)
         def __repr__(self):
             return "[%s] %r" % (self.prio(), self.strip_down())
 
+        @classmethod
+        def matcher(cls, pattern):
+            """function matching basenames against pattern like == does,
+            build it once when comparing many basenames"""
+            return cls._matcher(str(pattern))
+
+        @staticmethod
+        @functools.lru_cache(maxsize=256)
+        def _matcher(pattern):
+            pattern = SFSFile.SFSBasename(pattern)
+            pat = pattern.fields
+            if SFSDirectory.glob_chars_re.search(pattern):
+                name_match = re.compile(fnmatch.translate(pattern)).match
+            else:
+                name_match = str(pattern).__eq__
+
+            def match(basename):
+                basename = SFSFile.SFSBasename(basename)
+                if str.__eq__(basename, pattern):
+                    return True
+                fields = basename.fields
+                if pat.prio is not None and fields.prio is not None:
+                    if not fields.prio == pat.prio:
+                        return False
+                if fields.stem == pat.stem:
+                    return True
+                return bool(name_match(fields.name))
+
+            return match
+
         def __eq__(self, other):
-            if super(SFSFile.SFSBasename, self) == other:
-                return True
-            # print "Comparing %s to %r"%(self, other)
-            other = SFSFile.SFSBasename(other)
-            other_prio = other.prio()
-            if other_prio is not None:
-                self_prio = self.prio()
-                if self_prio is not None and not self_prio == other_prio:
-                    # print "Priority mismatch"
-                    return False
-            if self.strip_down() == other.strip_down():
-                return True
-            try:
-                without_sfs = self[: self.rindex(".sfs")]
-            except ValueError:
-                without_sfs = self
-            if fnmatch.fnmatch(without_sfs, str(other)):
-                return True
-            return False
+            return self.matcher(other)(self)
 
     def validate_sfs(self):
         if not self.isfile():
             return False
-        return self.open().read(4) == b"hsqs"
+        try:
+            self.sfs_header
+        except NotSFS:
+            return False
+        return True
 
     fn_ts_re = re.compile(r"^(.+?)(?:(\.OLD)?\.([0-9]+))+(?: \(deleted\))?$")
 
@@ -2134,9 +5368,17 @@ class SFSFile(FSPath):
     def basename(self):
         return self.SFSBasename(super(SFSFile, self).basename)
 
+    @cached_property
+    def sfs_header(self):
+        if isinstance(self, FSPathURLMixin):
+            return SquashFSImage.parse_superblock(
+                self.head_probe[0][: SquashFSImage.SUPERBLOCK_SIZE]
+            )
+        return sfs_meta_index.header(self.path)
+
     @cached_property
     def create_stamp(self):
-        return self._get_create_stamp(self.open().read(12))
+        return self.sfs_header["mkfs_time"]
 
     @staticmethod
     def _get_create_stamp(header):
@@ -2144,18 +5386,27 @@ class SFSFile(FSPath):
 
     @cached_property
     def mounted_path(self):  # pylint: disable=method-hidden
-        ldev = self.loop_dev
-        if ldev is None:
+        lentry = self.loop_entry
+        if lentry is None:
             return
-        mentry = global_mountinfo.find_dev(ldev)
+        mentry = global_mountinfo.find_dev(dev_id=lentry["st_rdev"])
         if mentry is None:
             return
         return MountPoint(mentry["mnt"])
 
+    def read_meta_file(self, path):
+        if not isinstance(self, FSPathURLMixin):
+            try:
+                return sfs_meta_index.read_file(self.path, path)
+            except NotSFS as e:
+                debug("Reading %r from %r needs mounting: %s", path, self.path, e)
+        with self.open_file(path, "r") as meta_f:
+            return meta_f.read()
+
     @cached_property
     def git_source(self):
         try:
-            git_source = self.open_file(self.GIT_SOURCE_PATH, "r").read().strip()
+            git_source = self.read_meta_file(self.GIT_SOURCE_PATH).strip()
         except IOError:
             return
         if "#" in git_source:
@@ -2167,10 +5418,17 @@ class SFSFile(FSPath):
     @cached_property
     def git_commit(self):
         try:
-            return self.open_file(self.GIT_COMMIT_PATH, "r").read().strip()
+            return self.read_meta_file(self.GIT_COMMIT_PATH).strip()
         except IOError:
             pass
 
+    @cached_property
+    def build_profile(self):
+        try:
+            return self.read_meta_file(SFSBuilder.BUILD_PROFILE_PATH).split("\n", 1)[0]
+        except IOError:
+            return
+
     @cached_property
     def git_branch(self):
         if self.git_source is None:
@@ -2181,7 +5439,7 @@ class SFSFile(FSPath):
             pass
 
         # should be executed quite rarely..
-        return self.open_file(self.GIT_SOURCE_PATH).read().strip().rsplit("#", 1)[1]
+        return self.read_meta_file(self.GIT_SOURCE_PATH).strip().rsplit("#", 1)[1]
 
     @cached_property
     def git_repo(self):
@@ -2203,9 +5461,7 @@ class SFSFile(FSPath):
         )
 
         try:
-            run_env.update(
-                _load_build_env(self.open_file(self.BUILD_ENV_PATH, "r").read())
-            )
+            run_env.update(_load_build_env(self.read_meta_file(self.BUILD_ENV_PATH)))
         except IOError:
             pass
 
@@ -2220,7 +5476,7 @@ class SFSFile(FSPath):
                 return self.git_repo.last_stamp
 
         try:
-            self.open_file(self.GET_LATEST_STAMP_PATH)
+            self.read_meta_file(self.GET_LATEST_STAMP_PATH)
         except IOError:
             pass
         else:
@@ -2229,7 +5485,7 @@ class SFSFile(FSPath):
             )
 
         try:
-            self.open_file(self.UPTDCHECK_PATH)
+            self.read_meta_file(self.UPTDCHECK_PATH)
         except IOError:
             return self.create_stamp
         else:
@@ -2268,15 +5524,30 @@ class SFSFile(FSPath):
         self.mounted_path = mnt
         return mnt
 
-    def rebuild_and_replace(self, source=None, env=None):
-        builder = SFSBuilder(self, source)
+    def rebuild_and_replace(self, source=None, env=None, builder=None):
+        if builder is None:
+            builder = SFSBuilder(self, source)
         extra_binds = os.environ.get("BUILD_EXTRA_BINDS")
         if extra_binds:
             for bind_def in extra_binds.split(" "):
                 builder.bind_dirs.append(LXC.BindEntry.from_strdef(bind_def))
         if env is not None:
             builder.run_env.update(**env)
-        builder.build()
+        cache_key = None
+        if build_cache.enabled and not (
+            extra_binds
+            or os.environ.get("PRE_BUILD_SHELL")
+            or os.environ.get("POST_BUILD_SHELL")
+        ):
+            cache_key = builder.build_cache_key()
+            if cache_key is not None and build_cache.fetch(cache_key, self):
+                return
+        try:
+            builder.build()
+        finally:
+            builder.release()
+        if cache_key is not None:
+            build_cache.store(cache_key, self)
 
     def replace_with(self, other, progress_cb=None):
         dst_temp = FSPath("%s.NEW.%s" % (self.path, os.getpid()))
@@ -2284,62 +5555,351 @@ class SFSFile(FSPath):
         try:
             dst_fobj = dst_temp.open("wb")
         except OSError as e:
-            if e.errno == errno.EROFS and sys.stdin.isatty():
+            if (
+                e.errno == errno.EROFS
+                and sys.stdin.isatty()
+                # parallel copies of update-sfs get remounted before they start
+                and threading.current_thread() is threading.main_thread()
+            ):
                 remount_mnt = dst_temp.parent_directory.mountpoint
-                yesno = input(
-                    f"Try again with temporarily remounting {remount_mnt} read-write? [Y/n] "
-                )
-                if yesno == "" or yesno.lower().startswith("y"):
-                    run_command(
-                        ["mount", "-o", "remount,rw", remount_mnt.path], as_user="root"
-                    )
-                    dst_fobj = dst_temp.open("wb")
-                else:
+                if not _remount_rw_prompt(remount_mnt):
                     raise
+                dst_fobj = dst_temp.open("wb")
             else:
                 raise
-        create_stamp = None
-        not_synced = 0
-        checksum = self.checksum_algo()
-        with other.open() as src_fobj:
-            nbytes = 0
-            if progress_cb:
-                progress_cb(nbytes)
-            while True:
-                data = src_fobj.read(self.chunk_size)
-                if not data:
-                    break
-                if create_stamp is None:
-                    create_stamp = self._get_create_stamp(data)
-                nbytes += len(data)
-                dst_fobj.write(data)
-                not_synced += len(data)
-                checksum.update(data)
-                if self.fsync_size > 0 and not_synced >= self.fsync_size:
-                    dst_fobj.flush()
-                    try:
-                        os.fsync(dst_fobj.fileno())
-                    except OSError:
-                        pass
-                    not_synced = 0
+        block_map = delta = None
+        if (
+            isinstance(other, FSPathURLMixin)
+            and not isinstance(self, FSPathURLMixin)
+            and self.delta_updates
+        ):
+            try:
+                block_map = SFSBlockMap.fetch(other.path)
+            except (urllib.error.URLError, ValueError, zlib.error) as e:
+                warning("Ignoring block map of %s: %s", other.path, e)
+            if block_map is not None:
+                try:
+                    delta = self._fetch_delta(
+                        other, block_map, dst_temp, dst_fobj, progress_cb
+                    )
+                except (IOError, NotSFS) as e:
+                    warning("Delta update failed, fetching the whole file: %s", e)
+                    os.ftruncate(dst_fobj.fileno(), 0)
+                    block_map = None
+        if delta is not None:
+            create_stamp, checksum = delta
+        elif (
+            isinstance(other, FSPathURLMixin)
+            and not isinstance(self, FSPathURLMixin)
+            and dl.dl_segments > 1
+        ):
+            create_stamp, checksum = self._fetch_segmented(
+                other, dst_temp, dst_fobj, progress_cb
+            )
+        elif (
+            not isinstance(other, FSPathURLMixin)
+            and not isinstance(self, FSPathURLMixin)
+            and other.isfile()
+        ):
+            # reflinks, preallocation and reading back need a local destination
+            create_stamp, checksum = self._copy_local(
+                other, dst_temp, dst_fobj, progress_cb
+            )
+        else:
+            create_stamp, checksum = self._copy_from(other, dst_fobj, progress_cb)
+        dst_fobj.close()
+        self.replace_file(dst_temp, create_stamp)
+        if not isinstance(self, FSPathURLMixin):
+            # keep a published block map in step with the image it describes
+            block_map_path = self.path + SFSBlockMap.suffix
+            if block_map is not None:
+                block_map.save(block_map_path)
+            elif os.path.exists(block_map_path):
+                os.unlink(block_map_path)
+        info("File digest: %s", checksum.hexdigest())
+        if self.checksum_file:
+            self.checksum_file.update(self, checksum.hexdigest())
+        if remount_mnt is not None:
+            if self.checksum_file:
+                self.checksum_file.flush()
+            run_command(["mount", "-o", "remount,ro", remount_mnt.path], as_user="root")
+        sfs_finder.register_sfs(self)
+
+    def _delta_seeds(self):
+        """(path, compute) of the images to take blocks from: the target and
+        its old versions are worth hashing, siblings only with a block map at
+        hand"""
+        seeds = [(self.path, True)]
+        seeds.extend(
+            (seed, True)
+            for seed in sorted(
+                glob.glob(glob.escape(self.path) + ".OLD*"), reverse=True
+            )
+        )
+        seeds.extend(
+            (seed, False)
+            for seed in sorted(
+                glob.glob(os.path.join(glob.escape(self._parent_path), "*.sfs"))
+            )
+        )
+        ret = []
+        seen = set()
+        for seed, compute in seeds:
+            if not os.path.isfile(seed):
+                continue
+            st = os.stat(seed)
+            if (st.st_dev, st.st_ino) not in seen:
+                seen.add((st.st_dev, st.st_ino))
+                ret.append((seed, compute))
+        return ret
+
+    def _fetch_delta(self, other, block_map, dst_temp, dst_fobj, progress_cb):
+        if not (
+            block_map.size == other.file_size
+            and block_map.mkfs_time == other.create_stamp
+        ):
+            raise IOError("Block map of %s does not match the image" % (other.path,))
+        wanted = set(e[2] for e in block_map.extents)
+        found = {}
+        for seed, compute in self._delta_seeds():
+            try:
+                seed_map = SFSBlockMap.for_local(seed, compute)
+            except (IOError, NotSFS) as e:
+                debug("Not using %s as delta seed: %s", seed, e)
+                continue
+            if seed_map is None:
+                continue
+            for offset, length, digest in seed_map.extents:
+                if digest in wanted and digest not in found:
+                    found[digest] = (seed, offset)
+
+        fd = dst_fobj.fileno()
+        try:
+            os.posix_fallocate(fd, 0, block_map.size)
+        except OSError:
+            os.ftruncate(fd, block_map.size)
+        if progress_cb:
+            progress_cb(0)
+        done = [0]
+        progress_lock = threading.Lock()
+
+        def advance(nbytes):
+            with progress_lock:
+                done[0] += nbytes
                 if progress_cb:
-                    progress_cb(nbytes)
-            if progress_cb:
-                progress_cb(None)
+                    progress_cb(done[0])
+
+        seed_fds = {}
+        ranges = []
+        try:
+            for offset, length, digest in block_map.extents:
+                if digest in found:
+                    seed, seed_offset = found[digest]
+                    if seed not in seed_fds:
+                        seed_fds[seed] = os.open(seed, os.O_RDONLY)
+                    data = os.pread(seed_fds[seed], length, seed_offset)
+                    if SFSBlockMap.digest(data) == digest:
+                        os.pwrite(fd, data, offset)
+                        advance(length)
+                        continue
+                if (
+                    ranges
+                    and ranges[-1][-1][0] + ranges[-1][-1][1] == offset
+                    and sum(e[1] for e in ranges[-1]) + length <= self.delta_range_max
+                ):
+                    ranges[-1].append((offset, length, digest))
+                else:
+                    ranges.append([(offset, length, digest)])
+        finally:
+            for seed_fd in seed_fds.values():
+                os.close(seed_fd)
+        reused = done[0]
+
+        def fetch_range(extents):
+            start = extents[0][0]
+            size = extents[-1][0] + extents[-1][1] - start
+            data = other.read_range(start, size, ranged_only=True)[0]
+            for offset, length, digest in extents:
+                if (
+                    not SFSBlockMap.digest(
+                        data[offset - start : offset - start + length]
+                    )
+                    == digest
+                ):
+                    raise IOError(
+                        "Block at %d of %s does not match its digest"
+                        % (offset, other.path)
+                    )
+            os.pwrite(fd, data, start)
+            advance(size)
+
+        info(
+            "Delta update of %s: %d of %d bytes from local images, fetching %d ranges",
+            self.path,
+            reused,
+            block_map.size,
+            len(ranges),
+        )
+        with concurrent.futures.ThreadPoolExecutor(max(dl.dl_segments, 1)) as pool:
+            for future in [pool.submit(fetch_range, r) for r in ranges]:
+                future.result()
+        if progress_cb:
+            progress_cb(None)
+        if self.fsync_size > 0:
+            try:
+                os.fsync(fd)
+            except OSError:
+                pass
+
+        checksum = self.checksum_algo()
+        with dst_temp.open("rb") as f:
+            create_stamp = self._get_create_stamp(f.read(self.chunk_size))
+            with mmap.mmap(f.fileno(), 0, prot=mmap.PROT_READ) as mm:
+                checksum.update(mm)
+        if checksum.name == "sha256" and not checksum.hexdigest() == block_map.sha256:
+            raise IOError("Assembled %s does not match its sha256" % (other.path,))
+        return create_stamp, checksum
+
+    def _fetch_segmented(self, other, dst_temp, dst_fobj, progress_cb):
+        dst_fobj.flush()
+        fd = dst_fobj.fileno()
+        if dl.dl_segmented(other.path, fd, progress_cb) is None:
+            return self._copy_from(other, dst_fobj, progress_cb)
+        if self.fsync_size > 0:
+            try:
+                os.fsync(fd)
+            except OSError:
+                pass
+        # segments arrive out of order, so digest the assembled file
+        checksum = self.checksum_algo()
+        with dst_temp.open("rb") as f:
+            create_stamp = self._get_create_stamp(f.read(self.chunk_size))
+            with mmap.mmap(f.fileno(), 0, prot=mmap.PROT_READ) as mm:
+                checksum.update(mm)
+        return create_stamp, checksum
+
+    FICLONE = 0x40049409
+
+    def _copy_extents(self, src_fd, dst_fd, size, extent_cb):
+        copy_funcs = ["copy_file_range", "sendfile"]
+        if not hasattr(os, "copy_file_range"):
+            copy_funcs.pop(0)
+        pos = 0
+        not_synced = 0
+        while pos < size:
+            count = min(self.copy_extent, size - pos)
+            try:
+                if copy_funcs[0] == "copy_file_range":
+                    copied = os.copy_file_range(src_fd, dst_fd, count, pos, pos)
+                else:
+                    os.lseek(dst_fd, pos, os.SEEK_SET)
+                    copied = os.sendfile(dst_fd, src_fd, pos, count)
+            except OSError as e:
+                if len(copy_funcs) > 1 and e.errno in (
+                    errno.EXDEV,
+                    errno.ENOSYS,
+                    errno.EINVAL,
+                    errno.EOPNOTSUPP,
+                ):
+                    debug("%s failed (%s), falling back", copy_funcs.pop(0), e)
+                    continue
+                raise
+            if copied == 0:
+                raise IOError(
+                    "Source truncated while copying at %d of %d" % (pos, size)
+                )
+            extent_cb(pos, pos + copied)
+            pos += copied
+            not_synced += copied
+            if self.fsync_size > 0 and not_synced >= self.fsync_size:
+                try:
+                    os.fsync(dst_fd)
+                except OSError:
+                    pass
+                not_synced = 0
         if self.fsync_size > 0 and not_synced > 0:
-            dst_fobj.flush()
             try:
-                os.fsync(dst_fobj.fileno())
+                os.fsync(dst_fd)
             except OSError:
                 pass
-        dst_fobj.close()
-        self.replace_file(dst_temp, create_stamp)
-        info("File digest: %s", checksum.hexdigest())
-        if self.checksum_file:
-            self.checksum_file.update(self, checksum.hexdigest())
-        if remount_mnt is not None:
-            run_command(["mount", "-o", "remount,ro", remount_mnt.path], as_user="root")
-        sfs_finder.register_sfs(self)
+
+    def _copy_local(self, other, dst_temp, dst_fobj, progress_cb):
+        dst_fobj.flush()
+        dst_fd = dst_fobj.fileno()
+        with other.open() as src_fobj:
+            src_fd = src_fobj.fileno()
+            size = os.fstat(src_fd).st_size
+            if size == 0:
+                return self._copy_from(other, dst_fobj, progress_cb)
+            create_stamp = self._get_create_stamp(os.pread(src_fd, self.chunk_size, 0))
+            if progress_cb:
+                progress_cb(0)
+            try:
+                fcntl.ioctl(dst_fd, self.FICLONE, src_fd)
+            except OSError:
+                cloned = False
+                try:
+                    os.posix_fallocate(dst_fd, 0, size)
+                except OSError:
+                    os.ftruncate(dst_fd, size)
+            else:
+                debug("Reflinked %s", other.path)
+                cloned = True
+
+            # digest what landed in the destination while the copy goes on
+            checksum = self.checksum_algo()
+            extents = queue.Queue()
+            hash_error = []
+            with dst_temp.open("rb") as dst_r, mmap.mmap(
+                dst_r.fileno(), size, prot=mmap.PROT_READ
+            ) as mm:
+
+                def hash_extents():
+                    try:
+                        with memoryview(mm) as mv:
+                            while True:
+                                extent = extents.get()
+                                if extent is None:
+                                    break
+                                checksum.update(mv[extent[0] : extent[1]])
+                    except Exception as e:
+                        hash_error.append(e)
+
+                hasher = threading.Thread(target=hash_extents, daemon=True)
+                hasher.start()
+
+                def extent_cb(start, end):
+                    extents.put((start, end))
+                    if progress_cb:
+                        progress_cb(end)
+
+                try:
+                    if cloned:
+                        extent_cb(0, size)
+                    else:
+                        self._copy_extents(src_fd, dst_fd, size, extent_cb)
+                finally:
+                    extents.put(None)
+                    hasher.join()
+            if hash_error:
+                raise hash_error[0]
+        if progress_cb:
+            progress_cb(None)
+        return create_stamp, checksum
+
+    def _copy_from(self, other, dst_fobj, progress_cb):
+        checksum = self.checksum_algo()
+        dst_fobj.flush()
+        with other.open() as src_fobj:
+            pipeline = _CopyPipeline(
+                src_fobj, dst_fobj.fileno(), checksum, self.fsync_size, progress_cb
+            )
+            stats = pipeline.run()
+        debug("Copy stats for %s: %r", other.path, stats)
+        create_stamp = None
+        if pipeline.head:
+            create_stamp = self._get_create_stamp(pipeline.head)
+        return create_stamp, checksum
 
     @cached_property
     def needs_update(self):
@@ -2466,12 +6026,7 @@ class MountPoint(FSPath):
 
     @cached_property
     def mountinfo(self):
-        for e in global_mountinfo:
-            try:
-                if os.path.samefile(e["mnt"], self.path):
-                    return e
-            except OSError:
-                continue
+        return global_mountinfo.find_mnt(self.path)
 
     @cached_property
     def aufs_si(self):
@@ -2531,11 +6086,10 @@ class MountPoint(FSPath):
         loop_name = source.split(os.path.sep)[-1]
         if not loop_name.startswith("loop"):
             raise NotLoopDev("Mountpoint does not seem to be loop device", loop_name)
-        return (
-            open(os.path.join("/sys/block", loop_name, "loop/backing_file"))
-            .read()
-            .rstrip("\n")
-        )
+        entry = loop_devs.find_name(loop_name)
+        if entry is None:
+            raise IOError(errno.ENOENT, "Loop device is not attached", loop_name)
+        return entry["backing_file"]
 
     def mount_combined(self, parts, **kwargs):
         dirs = []
@@ -2571,12 +6125,14 @@ class MountPoint(FSPath):
                 ["%s=rw" % (rw_mount.path,)] + ["%s=ro" % (d,) for d in reversed(dirs)]
             )
             kwargs.setdefault("dirs", dirs_arg)
+            self.upper_dir = rw_mount.path
         elif kwargs["fs_type"] == "overlay":
             kwargs.setdefault("lowerdir", ":".join(reversed(dirs)))
             rw_mount.join("upper").makedirs(sudo=True)
             kwargs.setdefault("upperdir", "%s/upper" % (rw_mount.path,))
             rw_mount.join("work").makedirs(sudo=True)
             kwargs.setdefault("workdir", "%s/work" % (rw_mount.path,))
+            self.upper_dir = kwargs["upperdir"]
         else:
             raise NotImplementedError(
                 "combined fs_type=%r is not implemented" % (kwargs["fs_type"])
@@ -2641,8 +6197,63 @@ class SourceList(FSPath):
             self.run_env = {}
 
 
+class _BuildGraph(object):
+    """runs named steps once the steps they depend on are done, at most
+    `jobs` at a time; steps added earlier start first"""
+
+    def __init__(self, jobs=1):
+        self.jobs = max(1, jobs)
+        self.steps = {}
+
+    def add(self, name, func, deps=()):
+        self.steps[name] = (func, set(deps))
+
+    def run(self):
+        pending = list(self.steps)
+        for name in pending:
+            unknown = self.steps[name][1].difference(self.steps)
+            if unknown:
+                raise ValueError(
+                    "Build step %s depends on unknown %r" % (name, sorted(unknown))
+                )
+        done = set()
+        running = {}
+        failed = None
+        with concurrent.futures.ThreadPoolExecutor(self.jobs) as pool:
+            while pending or running:
+                if failed is None:
+                    for name in pending[:]:
+                        if len(running) >= self.jobs:
+                            break
+                        func, deps = self.steps[name]
+                        if deps <= done:
+                            pending.remove(name)
+                            debug("Starting build step %s", name)
+                            running[pool.submit(func)] = name
+                    if pending and not running:
+                        raise ValueError("Dependency cycle between %r" % (pending,))
+                if not running:
+                    break
+                finished, _ = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for fut in finished:
+                    name = running.pop(fut)
+                    try:
+                        fut.result()
+                    except BaseException as e:
+                        warning("Build step %s failed: %s", name, e)
+                        if failed is None:
+                            failed = e
+                    else:
+                        done.add(name)
+        if failed is not None:
+            raise failed
+
+
 class BootDirBuilder(FSPath):
     dist_dirname = "sfs"
+    jobs = int(os.environ.get("LBU_BUILD_JOBS", "1"))
     build_targets = set(
         os.environ.get("LBU_BUILD_TARGETS", "efi sfs ramdisk grubconf vmlinuz").split()
     )
@@ -2715,8 +6326,16 @@ class BootDirBuilder(FSPath):
             d.mount("mkrd-rw", fs_type="tmpfs", mode="0755")
         return d
 
-    @cached_property
+    # also held by the steps using the container, it is shared between them
+    _build_lxc_lock = threading.RLock()
+
+    @property
     def build_lxc(self):
+        with self._build_lxc_lock:
+            return self._build_lxc
+
+    @cached_property
+    def _build_lxc(self):
         bind_dirs = []
         sfs_parts = SFSBuilder.default_lxc_parts + [self.lxc_buildconf_d]
         if "ramdisk" in self.build_targets or "ramdisk_net" in self.build_targets:
@@ -2791,57 +6410,133 @@ class BootDirBuilder(FSPath):
         return SFSDirectory(self.join(self.dist_dirname))
 
     def build(self):
+        graph = _BuildGraph(self.jobs)
         if "sfs" in self.build_targets:
-            self.build_sfs()
+            self.add_sfs_steps(graph)
+        kernel_deps = []
+        if getattr(self.source_list, "kernel_sfs", None):
+            kernel_step = "sfs:" + self.source_list.kernel_sfs.lstrip("/")
+            if kernel_step in graph.steps:
+                kernel_deps.append(kernel_step)
+        lxc_deps = self._sfs_deps(graph, SFSBuilder.default_lxc_parts)
+        if "ramdisk" in self.build_targets or "ramdisk_net" in self.build_targets:
+            lxc_deps.extend(kernel_deps)
         if "vmlinuz" in self.build_targets:
-            self.build_vmlinuz()
+            graph.add("vmlinuz", self.build_vmlinuz, kernel_deps)
         if "ramdisk" in self.build_targets:
-            self.build_ramdisk()
+            graph.add("ramdisk", self.build_ramdisk, lxc_deps)
         if "ramdisk_net" in self.build_targets:
-            self.build_ramdisk(NET="1")
+            graph.add(
+                "ramdisk_net", functools.partial(self.build_ramdisk, NET="1"), lxc_deps
+            )
         if "efi" in self.build_targets:
-            self.build_efi()
+            graph.add("efi", self.build_efi, lxc_deps)
         if "grubconf" in self.build_targets:
-            self.build_grubconf()
+            graph.add("grubconf", self.build_grubconf)
         if self.iso_output:
-            self.dist_dir.prune_old_sfs()
-            lxc_iso = (
-                FSPath(self.LXC_DEST_ISO_PARENT)
-                .join(FSPath(self.iso_output).basename)
-                .path
-            )
-            if self.grub_pkgs:
-                self.build_lxc.apt_install(self.grub_pkgs)
-            self.build_lxc.run(
-                ["grub-mkrescue", "-o", lxc_iso, self.LXC_DEST_BOOTDIR],
-                show_output=True,
-            )
+            graph.add("iso", self.build_iso, list(graph.steps))
+        graph.run()
 
-    def build_sfs(self):
+    def build_iso(self):
+        self.dist_dir.prune_old_sfs()
+        lxc_iso = (
+            FSPath(self.LXC_DEST_ISO_PARENT).join(FSPath(self.iso_output).basename).path
+        )
+        if self.grub_pkgs:
+            self.build_lxc.apt_install(self.grub_pkgs)
+        self.build_lxc.run(
+            ["grub-mkrescue", "-o", lxc_iso, self.LXC_DEST_BOOTDIR],
+            show_output=True,
+        )
+
+    @staticmethod
+    def _sfs_deps(graph, parts):
+        deps = []
+        for name in graph.steps:
+            if not name.startswith("sfs:"):
+                continue
+            basename = SFSFile.SFSBasename(os.path.basename(name[4:]))
+            for part in parts:
+                if os.path.exists(part):
+                    continue
+                if any(
+                    SFSFile.SFSBasename.matcher(part_s)(basename)
+                    for part_s in part.split(",")
+                ):
+                    deps.append(name)
+                    break
+        return deps
+
+    @staticmethod
+    def _is_sfs_copy(src_url):
+        return os.path.isfile(src_url) or (
+            src_url.endswith(".sfs")
+            and (src_url.startswith("http://") or src_url.startswith("https://"))
+        )
+
+    def _plan_sfs(self, entry):
+        src_url, sfs_name, run_env = entry
+        if self._is_sfs_copy(src_url):
+            return None
+        dest_sfs = SFSFile(self.dist_dir.join(sfs_name.lstrip("/")))
+        if dest_sfs.exists and not dest_sfs.needs_update:
+            return None
+        builder = SFSBuilder(dest_sfs, src_url)
+        if isinstance(builder.source, GitRepo):
+            parts = builder.commit_lxc_parts
+        else:
+            parts = SFSBuilder.default_lxc_parts[:]
+        return builder, parts
+
+    def add_sfs_steps(self, graph):
         info("Building sfs files to %s", self.dist_dirname)
         source_list = self.source_list
-        for src_url, sfs_name in source_list:
-            info("Building: %s -> %s", src_url, sfs_name)
-            dest_sfs = SFSFile(self.dist_dir.join(sfs_name.lstrip("/")))
-            dest_sfs.parent_directory.makedirs()
-            if os.path.isfile(src_url) or (
-                src_url.endswith(".sfs")
-                and (src_url.startswith("http://") or src_url.startswith("https://"))
-            ):
-                src_sfs = SFSFile(src_url)
-                if not dest_sfs.exists or src_sfs.create_stamp > dest_sfs.create_stamp:
-                    dest_sfs.replace_with(src_sfs, pr_cls(src_sfs.file_size))
-                sfs_finder.register_sfs(dest_sfs)
-                continue
-            if dest_sfs.exists and not dest_sfs.needs_update:
-                info(
-                    "No change: %s is up to date (%s)",
-                    sfs_name,
-                    stamp2txt(dest_sfs.create_stamp),
-                )
-                sfs_finder.register_sfs(dest_sfs)
-                continue
-            dest_sfs.rebuild_and_replace(src_url, env=source_list.run_env)
+        entries = [
+            (src_url, sfs_name, source_list.run_env)
+            for src_url, sfs_name in source_list
+        ]
+        # sources are fetched up front so that LXC parts named in their
+        # commits can become dependencies between entries
+        with concurrent.futures.ThreadPoolExecutor(max(1, self.jobs)) as pool:
+            plans = list(pool.map(self._plan_sfs, entries))
+        for name in ["sfs:" + e[1] for e in entries]:
+            graph.add(name, None)
+        for entry, plan in zip(entries, plans):
+            name = "sfs:" + entry[1]
+            builder = deps = None
+            if plan is not None:
+                builder, parts = plan
+                deps = [d for d in self._sfs_deps(graph, parts) if not d == name]
+            graph.add(
+                name,
+                functools.partial(self.build_sfs_entry, *entry, builder=builder),
+                deps or (),
+            )
+
+    def build_sfs(self):
+        graph = _BuildGraph(self.jobs)
+        self.add_sfs_steps(graph)
+        graph.run()
+
+    def build_sfs_entry(self, src_url, sfs_name, run_env, builder=None):
+        info("Building: %s -> %s", src_url, sfs_name)
+        dest_sfs = SFSFile(self.dist_dir.join(sfs_name.lstrip("/")))
+        dest_sfs.parent_directory.makedirs()
+        if self._is_sfs_copy(src_url):
+            src_sfs = SFSFile(src_url)
+            if not dest_sfs.exists or src_sfs.create_stamp > dest_sfs.create_stamp:
+                dest_sfs.replace_with(src_sfs, pr_cls(src_sfs.file_size))
+            sfs_finder.register_sfs(dest_sfs)
+            return
+        if builder is None:
+            info(
+                "No change: %s is up to date (%s)",
+                sfs_name,
+                stamp2txt(dest_sfs.create_stamp),
+            )
+            sfs_finder.register_sfs(dest_sfs)
+            return
+        builder.target.rebuild_and_replace(src_url, env=run_env, builder=builder)
 
     def build_vmlinuz(self):
         info("Extracting vmlinuz-%s", self.kver)
@@ -2877,13 +6572,24 @@ class BootDirBuilder(FSPath):
         lxc_grub_dir = "%s%s" % (self.LXC_DEST_BOOTDIR, grub_prefix)
         lxc_efi_src = "/usr/lib/grub/%s" % (self.efi_arch,)
 
-        if self.grub_pkgs:
-            self.build_lxc.apt_install(self.grub_pkgs)
-        self.build_lxc.run(["cp", "-r", lxc_efi_src, lxc_grub_dir])
-        self.build_lxc.run(
-            ["grub-mkimage", "-o", lxc_efi_img, "-O", self.efi_arch, "-p", grub_prefix]
-            + self.efi_mods
-        )
+        with self._build_lxc_lock:
+            if self.grub_pkgs:
+                self.build_lxc.apt_install(self.grub_pkgs)
+            self.build_lxc.run_many(
+                [
+                    ["cp", "-r", lxc_efi_src, lxc_grub_dir],
+                    [
+                        "grub-mkimage",
+                        "-o",
+                        lxc_efi_img,
+                        "-O",
+                        self.efi_arch,
+                        "-p",
+                        grub_prefix,
+                    ]
+                    + self.efi_mods,
+                ]
+            )
 
     def build_ramdisk(self, **makeargs):
         info("Building ramdisk-%s", self.kver)
@@ -2892,12 +6598,13 @@ class BootDirBuilder(FSPath):
         if "RAMDISK_DESTDIR" not in makeargs:
             makeargs["RAMDISK_DESTDIR"] = "%s/" % (self.LXC_DEST_ARCH,)
         self.arch_dir.makedirs()
-        if self.mkrd_pkgs:
-            self.build_lxc.apt_install(self.mkrd_pkgs)
         cmd = ["make", "-C", self.LXC_MKRD_DIR] + [
             "%s=%s" % (k, makeargs[k]) for k in makeargs
         ]
-        self.build_lxc.run(cmd, env=self.run_env, show_output=True)
+        with self._build_lxc_lock:
+            if self.mkrd_pkgs:
+                self.build_lxc.apt_install(self.mkrd_pkgs)
+            self.build_lxc.run(cmd, env=self.run_env, show_output=True)
 
 
 @cli_func(desc="List AUFS/OverlayFS original components")
@@ -2932,6 +6639,7 @@ def sfs_info(filename):
         git_source=sfs.git_source,
         git_commit=sfs.git_commit,
         git_branch=sfs.git_branch,
+        build_profile=sfs.build_profile,
         curlink_sfs=sfs.curlink_sfs().path,
     )
     for k, v in list(ret.items()):
@@ -2940,6 +6648,270 @@ def sfs_info(filename):
     return ret
 
 
+@cli_func(desc="Show whether the SFS components of a mount are up to date")
+def update_status(directory="/"):
+    ret = {}
+    for path in list_components(directory):
+        if path.endswith("/"):
+            continue
+        sfs = SFSFile(path)
+        status = ret[path] = {}
+        try:
+            status["stamp"] = stamp2txt(sfs.create_stamp)
+            curlink = sfs.curlink_sfs()
+            if not curlink.realpath() == sfs.realpath():
+                status["needs_update"] = True
+                status["current_file"] = curlink.realpath().path
+                continue
+            status["needs_update"] = sfs.needs_update
+            if status["needs_update"]:
+                status["latest_stamp"] = stamp2txt(sfs.latest_stamp)
+        except Exception as e:
+            status["error"] = "%s: %s" % (e.__class__.__name__, e)
+    return ret
+
+
+class SFSCatalog(object):
+    """Keeps catalog query results of a long-running process (sfs-catalog-daemon)
+    and serves them over a Unix socket. Results are dropped when the mount table
+    (POLLPRI on mountinfo) or one of the SFS directories (inotify) change, and
+    are kept per stat of the paths given as arguments. Each client is served on
+    its own thread, update checks expire after update_ttl."""
+
+    socket_path = os.environ.get("LBU_CATALOG_SOCKET", "/run/lbu-catalog.sock")
+    timeout = float(os.environ.get("LBU_CATALOG_TIMEOUT", "30"))
+    # update checks depend on remote repositories, nothing to watch there
+    update_ttl = int(os.environ.get("LBU_CATALOG_UPDATE_TTL", "600"))
+    commands = ("locate-sfs", "list-components", "sfs-info", "update-status")
+
+    IN_ONLYDIR = 0x1000000
+    # IN_CLOSE_WRITE IN_MOVED_FROM IN_MOVED_TO IN_CREATE IN_DELETE
+    # IN_DELETE_SELF IN_MOVE_SELF
+    IN_DIR_CHANGES = 0x8 | 0x40 | 0x80 | 0x100 | 0x200 | 0x400 | 0x800
+
+    def __init__(self, socket_path=None):
+        if socket_path is not None:
+            self.socket_path = socket_path
+        self.results = {}
+        self.update_results = {}
+        self.update_lock = threading.Lock()
+        # sfs_finder and the results are shared by all client threads
+        self.lock = threading.Lock()
+        self.state = None
+        self.dirs_generation = 0
+        self.watched = set()
+        self.inotify_fd = None
+
+    def _init_inotify(self):
+        if libc is None:
+            return
+        try:
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except AttributeError:
+            return
+        if fd < 0:
+            warning("inotify_init1: %s", os.strerror(ctypes.get_errno()))
+            return
+        self.inotify_fd = fd
+
+    def _read_inotify(self):
+        try:
+            while os.read(self.inotify_fd, 65536):
+                self.dirs_generation += 1
+        except BlockingIOError:
+            pass
+
+    def _sfs_dirs(self):
+        ret = []
+        for top in sfs_finder._sfs_dirs:
+            for dir_path, dir_names, _ in os.walk(top):
+                ret.append(dir_path)
+                if dir_path[len(top) :].count("/") >= SFSDirectory.sfs_search_depth:
+                    dir_names[:] = []
+        return ret
+
+    def _watch_dirs(self):
+        self.watched = set(self._sfs_dirs())
+        if self.inotify_fd is None:
+            return
+        for dir_path in self.watched:
+            wd = libc.inotify_add_watch(
+                self.inotify_fd,
+                os.fsencode(dir_path),
+                self.IN_DIR_CHANGES | self.IN_ONLYDIR,
+            )
+            if wd < 0:
+                debug("Cannot watch %s: %s", dir_path, os.strerror(ctypes.get_errno()))
+
+    def _refresh_state(self):
+        global_mountinfo.refresh()
+        state = (global_mountinfo.generation, self.dirs_generation)
+        if self.inotify_fd is None:
+            dir_mtimes = []
+            for dir_path in sorted(self.watched):
+                try:
+                    dir_mtimes.append(os.stat(dir_path).st_mtime_ns)
+                except OSError:
+                    dir_mtimes.append(None)
+            state += tuple(dir_mtimes)
+        if state == self.state:
+            return
+        debug("SFS catalog changed, dropping %d results", len(self.results))
+        self.results.clear()
+        sfs_finder.sfs_list = []
+        clear_cached_properties(sfs_finder)
+        self._watch_dirs()
+        self.state = state
+
+    @staticmethod
+    def _arg_stat(cwd, arg):
+        # paths outside the watched directories change unnoticed
+        try:
+            return SFSMetaIndex.stat_key(os.stat(os.path.join(cwd, arg)))
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def _parse_argv(command, argv, cwd):
+        func = cli_func.commands[command]
+        args, kwargs = func._cli_parse_argv(argv)
+        if command != "locate-sfs":
+            # the other queries take paths, relative to the client
+            args = [os.path.join(cwd, arg) for arg in args]
+            kwargs = dict((k, os.path.join(cwd, v)) for k, v in kwargs.items())
+        return func, args, kwargs
+
+    def answer(self, command, argv, cwd="/"):
+        if command not in self.commands:
+            raise ValueError("Not a catalog query: %s" % (command,))
+        if command == "update-status":
+            return self.answer_update(argv, cwd)
+        func, args, kwargs = self._parse_argv(command, argv, cwd)
+        key = (
+            command,
+            tuple(args),
+            tuple(sorted(kwargs.items())),
+            tuple(self._arg_stat(cwd, arg) for arg in argv),
+        )
+        with self.lock:
+            self._refresh_state()
+            if key in self.results:
+                return self.results[key]
+            result = json.loads(json.dumps(func(*args, **kwargs), default=str))
+            self.results[key] = result
+            return result
+
+    def answer_update(self, argv, cwd="/"):
+        func, args, kwargs = self._parse_argv("update-status", argv, cwd)
+        key = (tuple(args), tuple(sorted(kwargs.items())))
+        with self.update_lock:
+            cached = self.update_results.get(key)
+            if cached is not None and time.time() < cached[0] + self.update_ttl:
+                return cached[1]
+            with self.lock:
+                self._refresh_state()
+                result = json.loads(json.dumps(func(*args, **kwargs), default=str))
+            self.update_results[key] = (time.time(), result)
+            return result
+
+    @staticmethod
+    def _send(conn, resp):
+        with conn:
+            try:
+                conn.sendall(json.dumps(resp).encode("utf8") + b"\n")
+            except OSError as e:
+                debug("Catalog client went away: %s", e)
+
+    @staticmethod
+    def _error(e):
+        return dict(error="%s: %s" % (e.__class__.__name__, e))
+
+    def _reply(self, conn, func, *args):
+        try:
+            resp = dict(result=func(*args))
+        except Exception as e:
+            resp = self._error(e)
+        self._send(conn, resp)
+
+    def _handle(self, conn):
+        # runs on its own thread, a slow client must not hold up the others
+        conn.settimeout(self.timeout)
+        try:
+            req = json.loads(conn.makefile("rb").readline())
+            query = (req["command"], req["args"], req.get("cwd", "/"))
+        except Exception as e:
+            self._send(conn, self._error(e))
+            return
+        self._reply(conn, self.answer, *query)
+
+    def serve(self):
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # queries run with the privileges of the daemon
+        old_umask = os.umask(0o077)
+        try:
+            server.bind(self.socket_path)
+        finally:
+            os.umask(old_umask)
+        server.listen(16)
+        # exit through the finally below to remove the socket
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        self._init_inotify()
+        poller = select.poll()
+        poller.register(server, select.POLLIN)
+        if self.inotify_fd is not None:
+            poller.register(self.inotify_fd, select.POLLIN)
+        info("Serving SFS catalog on %s", self.socket_path)
+        try:
+            while True:
+                for fd, _ in poller.poll():
+                    if fd == self.inotify_fd:
+                        self._read_inotify()
+                    else:
+                        threading.Thread(
+                            target=self._handle,
+                            args=(server.accept()[0],),
+                            daemon=True,
+                        ).start()
+        finally:
+            server.close()
+            os.unlink(self.socket_path)
+
+    def call(self, command, argv):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+            conn.settimeout(self.timeout)
+            conn.connect(self.socket_path)
+            req = dict(command=command, args=list(argv), cwd=os.getcwd())
+            conn.sendall(json.dumps(req).encode("utf8") + b"\n")
+            resp = json.loads(conn.makefile("rb").readline())
+        if "error" in resp:
+            raise RuntimeError(resp["error"])
+        return resp["result"]
+
+    def try_call(self, command, argv):
+        """(True, result) when a running daemon answered the query"""
+        if (
+            command not in self.commands
+            or "SFS_FIND_PATH" in os.environ
+            or not os.path.exists(self.socket_path)
+        ):
+            return False, None
+        try:
+            return True, self.call(command, argv)
+        except (OSError, ValueError, RuntimeError) as e:
+            debug("SFS catalog query failed, running locally: %s", e)
+            return False, None
+
+
+sfs_catalog = SFSCatalog()
+
+
+@cli_func(desc="Serve catalog queries on a Unix socket ($LBU_CATALOG_SOCKET)")
+def sfs_catalog_daemon(socket_path=None):
+    SFSCatalog(socket_path).serve()
+
+
 @cli_func(desc="Find out the primary SFS file")
 def get_root_sfs():
     test_file = FSPath("/bin/true")
@@ -2976,26 +6948,46 @@ def _root_command_out(cmd):
     return run_command(cmd)
 
 
-def _read_until_block(fobj):
-    old_flags = fcntl.fcntl(fobj, fcntl.F_GETFL)
-    fcntl.fcntl(fobj, fcntl.F_SETFL, old_flags | os.O_NONBLOCK)
-    buf = []
-    while True:
-        try:
-            d = fobj.read(1)
-        except IOError as e:
-            if e.errno == errno.EWOULDBLOCK:
-                break
-            else:
-                raise
-        if not d:
-            break
-        buf.append(d)
-    fcntl.fcntl(fobj, fcntl.F_SETFL, old_flags)
-    return "".join(buf) if isinstance(d, str) else b"".join(buf)
+class _CommandOutput(object):
+    read_size = int(os.environ.get("LBU_CMD_READ_SIZE", "65536"))
+
+    def __init__(self, fobj, log_tag, sys_f, show_output=False, line_cb=None):
+        self.fobj = fobj
+        self.log_tag = log_tag
+        self.sys_f = sys_f
+        self.show_output = show_output
+        self.line_cb = line_cb
+        self.buf = []
+        self.partial_line = b""
+        self.decoder = codecs.getincrementaldecoder("utf8")("replace")
+
+    def read(self):
+        data = os.read(self.fobj.fileno(), self.read_size)
+        if not data:
+            if self.line_cb and self.partial_line:
+                self.line_cb(self.log_tag, self.partial_line.decode("utf8", "replace"))
+            self.partial_line = b""
+            return False
+        self.buf.append(data)
+        if self.show_output:
+            self.sys_f.write(
+                self.decoder.decode(data).replace("\r\n", "\n").replace("\n", "\r\n")
+            )
+            self.sys_f.flush()
+        if self.line_cb:
+            lines = (self.partial_line + data).split(b"\n")
+            self.partial_line = lines.pop()
+            for line in lines:
+                self.line_cb(self.log_tag, line.decode("utf8", "replace"))
+        debug("%s: %r", self.log_tag, data.rstrip(b"\n"))
+        return True
+
+    @property
+    def data(self):
+        return b"".join(self.buf).rstrip(b"\n").decode("utf8")
 
 
-def run_command(cmd, cwd=None, show_output=False, env={}, as_user=None):
+def run_command(cmd, cwd=None, show_output=False, env={}, as_user=None, line_cb=None):
     if as_user is not None:
         if isinstance(as_user, int):
             as_user = pwd.getpwuid(as_user)
@@ -3019,36 +7011,21 @@ def run_command(cmd, cwd=None, show_output=False, env={}, as_user=None):
     proc = subprocess.Popen(
         cmd, env=cmd_env, cwd=cwd, stderr=subprocess.PIPE, stdout=subprocess.PIPE
     )
-    stdout_buf = []
-    stderr_buf = []
-    check_f = [proc.stdout, proc.stderr]
-    while check_f:
-        in_f = select.select(check_f, [], [], 1)[0]
-        if not in_f:
-            continue
-        for buf, f, log_tag, sys_f in (
-            (stdout_buf, proc.stdout, "stdout", sys.stdout),
-            (stderr_buf, proc.stderr, "stderr", sys.stderr),
-        ):
-            if f not in in_f:
-                continue
-            data = _read_until_block(f)
-            if not data:
-                check_f.remove(f)
-                continue
-            buf.append(data)
-            if show_output:
-                sys_f.write(
-                    data.decode("utf8").replace("\r\n", "\n").replace("\n", "\r\n")
-                )
-                sys_f.flush()
-            debug("%s: %r", log_tag, data.rstrip(b"\n"))
-    stderr_data = b"".join(stderr_buf).rstrip(b"\n").decode("utf8")
-    stdout_data = b"".join(stdout_buf).rstrip(b"\n").decode("utf8")
+    stdout = _CommandOutput(proc.stdout, "stdout", sys.stdout, show_output, line_cb)
+    stderr = _CommandOutput(proc.stderr, "stderr", sys.stderr, show_output, line_cb)
+    with selectors.DefaultSelector() as sel:
+        sel.register(proc.stdout, selectors.EVENT_READ, stdout)
+        sel.register(proc.stderr, selectors.EVENT_READ, stderr)
+        while sel.get_map():
+            for key, _ in sel.select():
+                if not key.data.read():
+                    sel.unregister(key.fileobj)
+    proc.stdout.close()
+    proc.stderr.close()
     rcode = proc.wait()
     if rcode:
-        raise CommandFailed(cmd, rcode, stderr_data, stdout_data)
-    return stdout_data
+        raise CommandFailed(cmd, rcode, stderr.data, stdout.data)
+    return stdout.data
 
 
 @cli_func(desc="Show single blkid(8) tag value for specified device")
@@ -3109,6 +7086,8 @@ _url_re = re.compile(r"^(?P<schema>https?|ftp)://.*")
 
 @cli_func(desc="Show file or URL-based SFS file create stamp")
 def sfs_stamp(src):
+    if Downloader.http_url_re.match(src):
+        return SFSFile(src).create_stamp
     if _url_re.match(src):
         with urllib.request.urlopen(src) as file_obj:
             return sfs_stamp_file(file_obj)
@@ -3116,6 +7095,75 @@ def sfs_stamp(src):
         return sfs_stamp_file(src)
 
 
+@cli_func(desc="Publish block maps (<sfs>.blocks) used for delta updates")
+def sfs_blockmap(*sfs_files):
+    for sfs_file in sfs_files:
+        block_map = SFSBlockMap.from_image(sfs_file)
+        block_map.save(sfs_file + SFSBlockMap.suffix)
+        info("%s: %d blocks", sfs_file, len(block_map.extents))
+
+
+@cli_func(desc="List differences between two SFS images or directories")
+def diff_sfs(src1, src2, ignore=""):
+    """<sfs1|dir1> <sfs2|dir2> [--ignore=mode,size,mtime,digest]"""
+    ignore = [f for f in ignore.split(",") if f]
+    diff = SFSManifest.for_path(src1).diff(SFSManifest.for_path(src2), ignore)
+    return [
+        "%s %s" % (change, path)
+        if fields is None
+        else "~ %s (%s)" % (path, ",".join(fields))
+        for change, path, fields in diff
+    ]
+
+
+def _sfs_dir_images(top):
+    ret = {}
+    for dir_path, dir_names, file_names in os.walk(top):
+        if "old" in dir_names:
+            dir_names.remove("old")
+        for file_name in sorted(file_names):
+            if file_name.endswith(".sfs"):
+                name = SFSFile.SFSBasename(file_name).strip_down()
+                ret.setdefault(name, os.path.join(dir_path, file_name))
+    return ret
+
+
+@cli_func(desc="Compare the SFS images found in two directories")
+def compare_sfs_dirs(dir1, dir2):
+    images1, images2 = _sfs_dir_images(dir1), _sfs_dir_images(dir2)
+    ret = []
+    for name in sorted(set(images1) | set(images2)):
+        if name not in images2:
+            ret.append("- %s" % (name,))
+            continue
+        if name not in images1:
+            ret.append("+ %s" % (name,))
+            continue
+        stamps = []
+        for path in (images1[name], images2[name]):
+            try:
+                stamps.append(sfs_stamp_file(path))
+            except (OSError, NotSFS) as e:
+                warning("Cannot read %s: %s", path, e)
+                stamps.append(None)
+        if stamps[0] == stamps[1] and None not in stamps:
+            continue
+        line = "~ %s %s -> %s" % tuple(
+            [name] + [stamp2txt(s) if s else "FAIL" for s in stamps]
+        )
+        manifests = [
+            SFSManifest.for_image(images1[name], compute=False),
+            SFSManifest.for_image(images2[name], compute=False),
+        ]
+        if None not in stamps and None not in manifests:
+            counts = dict.fromkeys("+-~", 0)
+            for change, _, _ in manifests[0].diff(manifests[1], ["mtime"]):
+                counts[change] += 1
+            line += ": %(+)d added, %(-)d removed, %(~)d changed" % counts
+        ret.append(line)
+    return ret
+
+
 @cli_func(desc="Rebuild a SFS file. Recognizes {PRE_,LAST_,}BUILD_SCRIPT vars.")
 def rebuild_sfs(target, source=None, *env_vars):
     sfs = SFSFile(target)
@@ -3176,35 +7224,126 @@ def gen_sfs_list(
 
 @cli_func(desc="Retrieve sfs creation stamp from file-like object")
 def sfs_stamp_file(f):
-    close = False
     if isinstance(f, str):
-        close = True
-        f = open(f, "rb")
-    try:
-        d = f.read(1024)
-    finally:
-        if close:
-            f.close()
+        return sfs_meta_index.header(f)["mkfs_time"]
+    d = f.read(1024)
     if d[:4] != b"hsqs":
         raise NotSFS("file does not have sqsh signature")
     return struct.unpack("<I", d[8 : 8 + 4])[0]
 
 
 def _update_sfs_parse_args(argv):
-    if argv[0] == "--no-act":
-        return [argv[1], True] + argv[2:], {}
-    else:
-        return [argv[0], False] + argv[1:], {}
+    argv = list(argv)
+    no_act = False
+    kwargs = {}
+    while argv and (argv[0] in ("--no-act", "--jobs") or argv[0].startswith("--jobs=")):
+        opt = argv.pop(0)
+        if opt == "--no-act":
+            no_act = True
+        elif opt == "--jobs":
+            kwargs["jobs"] = int(argv.pop(0))
+        else:
+            kwargs["jobs"] = int(opt[len("--jobs=") :])
+    return [argv[0], no_act] + argv[1:], kwargs
+
+
+def _update_sfs_check(dst_sfs, source_dir, git_locks):
+    if source_dir == "--auto-rebuild":
+        if dst_sfs.git_source:
+            info("Git repo for %s: %s", dst_sfs.basename, dst_sfs.git_source)
+            # checks of images built from the same repo must not pull it at once
+            with git_locks.setdefault(dst_sfs.git_source, threading.Lock()):
+                dst_sfs.latest_stamp
+        if dst_sfs.latest_stamp > dst_sfs.create_stamp:
+            return (
+                "rebuild",
+                None,
+                (
+                    info,
+                    "Rebuilding %s: %s > %s",
+                    dst_sfs.basename,
+                    stamp2txt(dst_sfs.latest_stamp),
+                    stamp2txt(dst_sfs.create_stamp),
+                ),
+            )
+        return (
+            None,
+            None,
+            (
+                info,
+                "Keeping %s: latest %s %s current: %s",
+                dst_sfs.basename,
+                stamp2txt(dst_sfs.latest_stamp),
+                "<" if dst_sfs.latest_stamp < dst_sfs.create_stamp else "=",
+                stamp2txt(dst_sfs.create_stamp),
+            ),
+        )
+    src_sfs = source_dir.find_sfs(dst_sfs.basename)
+    if src_sfs is None:
+        return (
+            None,
+            None,
+            (warning, "Not found from update source, skipping: %s", dst_sfs.basename),
+        )
+    elif src_sfs.create_stamp > dst_sfs.create_stamp:
+        return (
+            "replace",
+            src_sfs,
+            (
+                info,
+                "Replacing %s from %s: %s > %s",
+                dst_sfs.basename,
+                src_sfs.parent_directory,
+                stamp2txt(src_sfs.create_stamp),
+                stamp2txt(dst_sfs.create_stamp),
+            ),
+        )
+    elif src_sfs.create_stamp == dst_sfs.create_stamp:
+        return (
+            None,
+            None,
+            (
+                info,
+                "Keeping same %s: %s",
+                dst_sfs.basename,
+                stamp2txt(src_sfs.create_stamp),
+            ),
+        )
+    return (
+        None,
+        None,
+        (
+            warning,
+            "Keeping newer %s: %s < %s",
+            dst_sfs.basename,
+            stamp2txt(src_sfs.create_stamp),
+            stamp2txt(dst_sfs.create_stamp),
+        ),
+    )
+
+
+def _update_sfs_replace_quiet(dst_sfs, src_sfs):
+    start = time.time()
+    dst_sfs.replace_with(src_sfs)
+    info(
+        "Replaced %s: %d bytes in %.1fs",
+        dst_sfs.basename,
+        dst_sfs.file_size,
+        time.time() - start,
+    )
 
 
 @cli_func(
     parse_argv=_update_sfs_parse_args,
     desc="Update (or list only) a SFS collection (by defaults components of '/')",
 )
-def update_sfs(source_dir, no_act=False, *target_dirs):
-    """[--no-act] {--list | --auto-rebuild | <source_dir>} [<target_dirs>...]"""
+def update_sfs(source_dir, no_act=False, *target_dirs, jobs=None):
+    """[--no-act] [--jobs N] {--list | --auto-rebuild | <source_dir>} [<target_dirs>...]"""
     if not source_dir[:2] == "--":
         source_dir = SFSDirectory(source_dir)
+    if jobs is None:
+        jobs = os.environ.get("SFS_UPDATE_JOBS", "1")
+    jobs = int(jobs)
     target_dirs = list(map(SFSDirectory, target_dirs))
     if not target_dirs:
         fn_ts_re = re.compile(r"^(.+)\.([0-9]+)$")
@@ -3222,12 +7361,45 @@ def update_sfs(source_dir, no_act=False, *target_dirs):
                     lbe = lbe_bn
             target_dirs.append(SFSDirectory(lbe))
     skip_sfs = set(os.environ.get("SFS_UPDATE_SKIP", "").split(","))
+    remounted = {}
+    try:
+        with concurrent.futures.ThreadPoolExecutor(jobs) as pool:
+            _update_sfs_dirs(
+                source_dir, no_act, target_dirs, skip_sfs, jobs, pool, remounted
+            )
+    finally:
+        # only once all copies into them are done
+        mounts = [mnt for mnt in remounted.values() if mnt is not None]
+        if mounts:
+            ChecksumFile.flush_all()
+        for mnt in mounts:
+            run_command(["mount", "-o", "remount,ro", mnt.path], as_user="root")
+    ChecksumFile.flush_all()
+
+
+def _update_sfs_remount_rw(dst_sfs, remounted):
+    """asks once per read-only mount from the main thread, workers must not
+    prompt or remount themselves"""
+    if isinstance(dst_sfs, FSPathURLMixin) or not sys.stdin.isatty():
+        return
+    parent = dst_sfs.parent_directory
+    if not os.statvfs(parent.path).f_flag & os.ST_RDONLY:
+        return
+    mnt = parent.mountpoint
+    if mnt.path not in remounted:
+        remounted[mnt.path] = mnt if _remount_rw_prompt(mnt) else None
+
+
+def _update_sfs_dirs(source_dir, no_act, target_dirs, skip_sfs, jobs, pool, remounted):
+    git_locks = {}
+    running = []
     for target_dir in target_dirs:
         last_dir = None
         target_dir_all_sfs = target_dir.all_sfs
         # make sure more basic lower-level SFS files (like 00-*) get rebuilt first
         if isinstance(target_dir, SFSDirectoryAufs):
             target_dir_all_sfs = reversed(target_dir_all_sfs)
+        todo = []
         for sfs in target_dir_all_sfs:
             if not sfs.parent_directory == last_dir:
                 last_dir = sfs.parent_directory
@@ -3258,56 +7430,88 @@ def update_sfs(source_dir, no_act=False, *target_dirs):
             elif cksum_file is None:
                 cksum_file = ChecksumFile.find_in_parents_of(dst_sfs)
             else:
-                cksum_file = ChecksumFile(cksum_file)
+                cksum_file = ChecksumFile.shared(cksum_file)
             if cksum_file:
                 dst_sfs.checksum_file = cksum_file
-            if source_dir == "--auto-rebuild":
-                if dst_sfs.git_source:
-                    info("Git repo for %s: %s", dst_sfs.basename, dst_sfs.git_source)
-                if dst_sfs.latest_stamp > dst_sfs.create_stamp:
-                    info(
-                        "Rebuilding %s: %s > %s",
-                        dst_sfs.basename,
-                        stamp2txt(dst_sfs.latest_stamp),
-                        stamp2txt(dst_sfs.create_stamp),
-                    )
-                    if not no_act:
-                        dst_sfs.rebuild_and_replace()
-                else:
-                    info(
-                        "Keeping %s: latest %s %s current: %s",
-                        dst_sfs.basename,
-                        stamp2txt(dst_sfs.latest_stamp),
-                        "<" if dst_sfs.latest_stamp < dst_sfs.create_stamp else "=",
-                        stamp2txt(dst_sfs.create_stamp),
-                    )
+            todo.append(dst_sfs)
+        if jobs > 1:
+            checks = pool.map(
+                lambda dst_sfs: _update_sfs_check(dst_sfs, source_dir, git_locks), todo
+            )
+        else:
+            checks = (
+                _update_sfs_check(dst_sfs, source_dir, git_locks) for dst_sfs in todo
+            )
+        for dst_sfs, (action, src_sfs, log_rec) in zip(todo, checks):
+            log_rec[0](*log_rec[1:])
+            if action is None or no_act:
                 continue
-            src_sfs = source_dir.find_sfs(dst_sfs.basename)
-            if src_sfs is None:
-                warning("Not found from update source, skipping: %s", dst_sfs.basename)
-            elif src_sfs.create_stamp > dst_sfs.create_stamp:
-                info(
-                    "Replacing %s from %s: %s > %s",
-                    dst_sfs.basename,
-                    src_sfs.parent_directory,
-                    stamp2txt(src_sfs.create_stamp),
-                    stamp2txt(dst_sfs.create_stamp),
-                )
-                if not no_act:
-                    dst_sfs.replace_with(src_sfs, progress_cb=pr_cls(src_sfs.file_size))
-            elif src_sfs.create_stamp == dst_sfs.create_stamp:
-                info(
-                    "Keeping same %s: %s",
-                    dst_sfs.basename,
-                    stamp2txt(src_sfs.create_stamp),
-                )
+            if action == "rebuild":
+                dst_sfs.rebuild_and_replace()
+            elif jobs > 1:
+                _update_sfs_remount_rw(dst_sfs, remounted)
+                running.append(pool.submit(_update_sfs_replace_quiet, dst_sfs, src_sfs))
             else:
-                warning(
-                    "Keeping newer %s: %s < %s",
-                    dst_sfs.basename,
-                    stamp2txt(src_sfs.create_stamp),
-                    stamp2txt(dst_sfs.create_stamp),
-                )
+                dst_sfs.replace_with(src_sfs, progress_cb=pr_cls(src_sfs.file_size))
+    for f in running:
+        f.result()
+
+
+@cli_func(desc="Verify SFS images against sha256sum.txt files in parent directories")
+def verify_sfs(path, jobs=None):
+    if jobs is not None:
+        jobs = int(jobs)
+    root = os.path.realpath(path)
+    cksum_files = {}
+    by_cksum_file = {}
+    unlisted = []
+    for sfs in SFSDirectory(path).all_sfs:
+        sfs_dir = sfs.parent_directory.path
+        if sfs_dir not in cksum_files:
+            cksum_files[sfs_dir] = ChecksumFile.find_in_parents_of(sfs)
+        cksum_file = cksum_files[sfs_dir]
+        if cksum_file is None or cksum_file.get(sfs) is None:
+            unlisted.append(sfs.path)
+        else:
+            by_cksum_file.setdefault(cksum_file.path, (cksum_file, []))[1].append(
+                cksum_file.relpath(sfs)
+            )
+    ret = []
+    failed = missing = 0
+    for cksum_file, names in by_cksum_file.values():
+        base_dir = cksum_file.parent_directory.path
+        # listed images under the verified tree that are gone
+        names.extend(
+            name
+            for name in cksum_file.entries
+            if name.endswith(".sfs")
+            and name not in names
+            and os.path.realpath(os.path.join(base_dir, name)).startswith(root + os.sep)
+        )
+        for name, ok in sorted(cksum_file.verify(names, jobs).items()):
+            if ok:
+                ret.append("%s: OK" % (os.path.join(base_dir, name),))
+            elif ok is None:
+                ret.append("%s: MISSING" % (os.path.join(base_dir, name),))
+                missing += 1
+            else:
+                ret.append("%s: FAILED" % (os.path.join(base_dir, name),))
+                failed += 1
+    ret.extend("%s: NOT LISTED" % (sfs_path,) for sfs_path in unlisted)
+    if failed or missing:
+        for line in ret:
+            if not line.endswith(": OK"):
+                warning("%s", line)
+        raise FilesystemError(
+            "Verification failed: %d mismatched, %d missing, %d not listed"
+            % (failed, missing, len(unlisted))
+        )
+    info(
+        "All %d listed images OK, %d not listed",
+        sum(len(n) for _, n in by_cksum_file.values()),
+        len(unlisted),
+    )
+    return ret
 
 
 @cli_func(desc="Build SFS directory from sources")
@@ -3333,10 +7537,12 @@ def dl_file(source, fname=None, cache_dir=None):
 
 
 @cli_func(desc="Build a bootable directory")
-def build_boot_dir(path, source_list, dist_name="sfs", iso_output=None):
+def build_boot_dir(path, source_list, dist_name="sfs", iso_output=None, jobs=None):
     builder = BootDirBuilder(
         path, source_list_url=source_list, dist_dirname=dist_name, iso_output=iso_output
     )
+    if jobs is not None:
+        builder.jobs = int(jobs)
     builder.build()
 
 